@@ -0,0 +1,224 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from repository import booked_slots
+from cluster import BOT_CLUSTER, VersionWatch
+
+logger = logging.getLogger('availability')
+
+WORK_START = int(os.getenv("WORK_START", 9))
+WORK_END = int(os.getenv("WORK_END", 19))
+TIME_SLOT_STEP = int(os.getenv("TIME_SLOT_STEP", 60))
+AVAILABILITY_CACHE_SIZE = int(os.getenv("AVAILABILITY_CACHE_SIZE", 512))  # Дней (мастер, дата) в кэше
+
+MINUTES_IN_DAY = 24 * 60
+
+
+def to_minutes(time_str):
+    """Переводит 'ЧЧ:ММ' в минуты от начала суток"""
+    hours, minutes = time_str.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+@lru_cache(maxsize=MINUTES_IN_DAY)
+def format_minutes(minutes):
+    """Переводит минуты от начала суток в 'ЧЧ:ММ'"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _range_mask(start, end):
+    """Битовая маска минут [start, end)"""
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+
+@lru_cache(maxsize=64)
+def _grid_mask(day_start, day_end, step):
+    """Маска допустимых начал слотов с шагом step от начала рабочего дня"""
+    mask = 0
+    for minute in range(day_start, day_end, step):
+        mask |= 1 << minute
+    return mask
+
+
+def _iter_bits(mask):
+    """Номера установленных битов по возрастанию"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class DaySchedule:
+    """Занятость мастера на один день.
+
+    Бит i маски busy означает, что минута i суток занята. Поиск свободных
+    начал для услуги длительностью D выполняется целочисленными сдвигами
+    маски за O(log D) операций, без перебора записей для каждого слота.
+    """
+
+    __slots__ = ('busy', 'day_start', 'day_end')
+
+    def __init__(self, intervals=(), day_start=WORK_START * 60, day_end=WORK_END * 60):
+        self.busy = 0
+        self.day_start = day_start
+        self.day_end = day_end
+        for start, end in intervals:
+            self.occupy(start, end)
+
+    def occupy(self, start, end):
+        """Помечает интервал [start, end) занятым"""
+        self.busy |= _range_mask(max(start, 0), min(end, MINUTES_IN_DAY))
+
+    def free_mask(self):
+        """Маска свободных рабочих минут"""
+        return _range_mask(self.day_start, self.day_end) & ~self.busy
+
+    def start_mask(self, duration):
+        """Маска минут, с которых помещается услуга длительностью duration"""
+        run = self.free_mask()
+        length = 1
+        while length < duration and run:
+            shift = min(length, duration - length)
+            run &= run >> shift
+            length += shift
+        return run
+
+    def free_starts(self, duration, step=TIME_SLOT_STEP, not_before=0):
+        """Свободные начала (в минутах) по сетке слотов"""
+        mask = self.start_mask(duration) & _grid_mask(self.day_start, self.day_end, step)
+        if not_before > 0:
+            mask &= ~((1 << not_before) - 1)
+        return list(_iter_bits(mask))
+
+
+def _load_intervals(master_id, date):
+    """Читает интервалы активных записей мастера на дату"""
+    intervals = {}
+    for appointment_id, start, duration in booked_slots(master_id, date):
+        intervals[appointment_id] = (start, start + duration)
+    return intervals
+
+
+class DayEntry:
+    """Закэшированный день мастера: записи, маска занятости и маски начал по длительностям"""
+
+    __slots__ = ('intervals', 'schedule', 'starts')
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self.schedule = DaySchedule(intervals.values())
+        self.starts = {}
+
+    def start_mask(self, duration):
+        mask = self.starts.get(duration)
+        if mask is None:
+            mask = self.starts[duration] = self.schedule.start_mask(duration)
+        return mask
+
+    def add(self, appointment_id, start, end):
+        self.intervals[appointment_id] = (start, end)
+        self.schedule.occupy(start, end)
+        self.starts.clear()
+
+    def remove(self, appointment_id):
+        if self.intervals.pop(appointment_id, None) is None:
+            return False
+        self.schedule = DaySchedule(self.intervals.values())
+        self.starts.clear()
+        return True
+
+
+class AvailabilityCache:
+    """LRU-кэш занятости по ключу (мастер, дата) с масками по длительности услуги.
+
+    Записи и отмены обновляют закэшированный день на месте, поэтому
+    повторные открытия выбора времени не обращаются к БД. В кластерном
+    режиме watch следит за счетчиком data_versions('appointments'), и
+    изменения из других процессов сбрасывают кэш.
+    """
+
+    def __init__(self, capacity=AVAILABILITY_CACHE_SIZE, watch=None):
+        self.capacity = capacity
+        self.watch = watch
+        self.hits = 0
+        self.misses = 0
+        self._days = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, master_id, date):
+        key = (master_id, date)
+        if self.watch is not None and self.watch.changed():
+            self.invalidate()
+        with self._lock:
+            entry = self._days.get(key)
+            if entry is not None:
+                self._days.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        intervals = _load_intervals(master_id, date)
+        with self._lock:
+            self.misses += 1
+            entry = self._days.get(key)
+            if entry is None:
+                entry = self._days[key] = DayEntry(intervals)
+                if len(self._days) > self.capacity:
+                    self._days.popitem(last=False)
+            return entry
+
+    def free_starts(self, master_id, date, duration, step=TIME_SLOT_STEP, not_before=0):
+        """Свободные начала (в минутах) для услуги на дату"""
+        entry = self._entry(master_id, date)
+        with self._lock:
+            mask = entry.start_mask(duration)
+            schedule = entry.schedule
+        mask &= _grid_mask(schedule.day_start, schedule.day_end, step)
+        if not_before > 0:
+            mask &= ~((1 << not_before) - 1)
+        return list(_iter_bits(mask))
+
+    def on_booked(self, appointment_id, master_id, date, time_str, duration):
+        """Учитывает новую запись в закэшированном дне"""
+        start = to_minutes(time_str)
+        with self._lock:
+            entry = self._days.get((master_id, date))
+            if entry is not None:
+                entry.add(appointment_id, start, start + duration)
+
+    def on_canceled(self, appointment_id, master_id=None, date=None):
+        """Освобождает интервал отмененной записи"""
+        with self._lock:
+            if master_id is not None and date is not None:
+                entry = self._days.get((master_id, date))
+                if entry is not None:
+                    entry.remove(appointment_id)
+                return
+            for entry in self._days.values():
+                if entry.remove(appointment_id):
+                    return
+
+    def invalidate(self, master_id=None, date=None):
+        """Сбрасывает кэш целиком или для одного дня мастера"""
+        with self._lock:
+            if master_id is None:
+                self._days.clear()
+            else:
+                self._days.pop((master_id, date), None)
+
+    def get_stats(self):
+        with self._lock:
+            return {'days': len(self._days), 'hits': self.hits, 'misses': self.misses}
+
+
+# Общий кэш занятости
+AVAILABILITY = AvailabilityCache(watch=VersionWatch('appointments') if BOT_CLUSTER else None)
+
+
+def get_free_slots(master_id, date, duration, not_before=0):
+    """Возвращает свободное время начала ('ЧЧ:ММ') для услуги на дату"""
+    starts = AVAILABILITY.free_starts(master_id, date, duration, not_before=not_before)
+    return [format_minutes(m) for m in starts]
@@ -0,0 +1,71 @@
+import logging
+from collections import namedtuple
+from storage import STORAGE, get_db_connection
+from availability import AVAILABILITY, to_minutes, format_minutes
+from repository import SERVICE_DURATION, find_conflict
+from timeutil import appointment_span
+
+logger = logging.getLogger('booking')
+
+# ok=True: запись создана (appointment_id); ok=False: время занято записью conflict
+ReservationResult = namedtuple('ReservationResult', 'ok appointment_id conflict')
+
+
+def normalize_time(time_str):
+    """Приводит время к виду 'ЧЧ:ММ' с ведущим нулем"""
+    return format_minutes(to_minutes(time_str))
+
+
+def reserve_slot(client_id, client_name, phone, master_id, service_id, date, time_str):
+    """Атомарно бронирует время мастера.
+
+    В SQLite проверка пересечения с активными записями и вставка выполняются
+    в одной транзакции BEGIN IMMEDIATE, поэтому две параллельные брони одного
+    времени не пройдут обе. В PostgreSQL то же гарантирует ограничение
+    исключения appointments_no_overlap: проигравшая вставка отклоняется, и
+    пересечение ищется заново. Длительность берется из справочника услуг и
+    фиксируется в записи: end_time и start_ts/end_ts (UNIX-время), по
+    которым идут проверки пересечений и напоминания.
+    """
+    time_str = normalize_time(time_str)
+    start = to_minutes(time_str)
+
+    try:
+        with get_db_connection() as conn:
+            conn.begin_write()
+            duration = SERVICE_DURATION.scalar((service_id,), conn)
+            if duration is None:
+                raise ValueError(f"Услуга #{service_id} не найдена")
+            end_time = format_minutes(start + duration)
+            start_ts, end_ts = appointment_span(date, time_str, duration)
+
+            conflict = find_conflict(master_id, start_ts, end_ts, conn)
+            if conflict is None:
+                appointment_id = STORAGE.insert_returning_id(
+                    conn,
+                    """INSERT INTO appointments
+                       (client_id, client_name, phone, master_id, service_id, date, time, end_time,
+                        start_ts, end_ts)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (client_id, client_name, phone, master_id, service_id, date, time_str, end_time,
+                     start_ts, end_ts))
+            else:
+                conn.rollback()
+    except Exception as e:
+        if not STORAGE.is_overlap_error(e):
+            raise
+        # Параллельная бронь успела раньше: вставку отклонило ограничение исключения
+        with get_db_connection() as conn:
+            conflict = find_conflict(master_id, start_ts, end_ts, conn)
+        if conflict is None:
+            raise
+
+    if conflict:
+        logger.info(f"Время {date} {time_str} мастера #{master_id} занято записью #{conflict.appointment_id}")
+        AVAILABILITY.on_booked(conflict.appointment_id, master_id, date, conflict.time,
+                               to_minutes(conflict.end_time) - to_minutes(conflict.time))
+        return ReservationResult(False, None, conflict)
+
+    AVAILABILITY.on_booked(appointment_id, master_id, date, time_str, duration)
+    logger.info(f"Запись #{appointment_id} создана: мастер #{master_id}, {date} {time_str}-{end_time}")
+    return ReservationResult(True, appointment_id, None)
@@ -1,38 +1,63 @@
 import telebot
 from telebot import types
-import sqlite3
 import datetime
 import re
 import threading
 import time
-import openpyxl
-from openpyxl import Workbook
 import os
-import gspread
-from google.oauth2.service_account import Credentials
-import pytz
 import logging
 from dotenv import load_dotenv
 import json
 import shlex
+import atexit
+from collections import namedtuple
+import repository
+from storage import STORAGE, get_db_connection, get_pool_stats
+from catalog import CATALOG
+from availability import AVAILABILITY, get_free_slots
+from booking import reserve_slot
+from reminders import ReminderScheduler
+from cluster import BOT_CLUSTER, BOT_PROCESSES, LeaderLease, VersionWatch, supervise
+from dispatcher import MessageDispatcher, PRIORITY_REMINDER
+from router import MessageRouter
+from state_store import BookingState, create_state_store
+from export import ExcelExporter, STATUS_LABELS
+from lifecycle import AppointmentLifecycle
+from timeutil import SALON_TZ, format_date
+from executor import configure_execution, BOT_EXECUTION_MODE, BOT_WORKERS
+from webhook import WebhookServer, register_webhook, WEBHOOK_URL
+from sheets import (init_google_sheet, sync_all_to_google, sync_changes_to_google,
+                    verify_row_index, SHEET_CLIENT, SHEET_SYNC, SHEET_WRITE_LOCK)
 
 # Загрузка переменных окружения
 load_dotenv()
 
 # Настройки из config.py
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_CHAT_IDS = json.loads(os.getenv("ADMIN_CHAT_IDS", "[]"))
+ADMIN_CHAT_IDS = frozenset(json.loads(os.getenv("ADMIN_CHAT_IDS", "[]")))
 WORK_START = int(os.getenv("WORK_START", 9))
 WORK_END = int(os.getenv("WORK_END", 19))
 TIME_SLOT_STEP = int(os.getenv("TIME_SLOT_STEP", 60))
 MIN_BOOKING_TIME = int(os.getenv("MIN_BOOKING_TIME", 60))
-GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
-GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "K1")
 SALON_ADDRESS = os.getenv("SALON_ADDRESS", "ул. Примерная, 123")
 SALON_PHONE = os.getenv("SALON_PHONE", "+7 (3532) 123-456")
+BOT_UPDATE_MODE = os.getenv("BOT_UPDATE_MODE", "polling")  # polling или webhook
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 10))     # Записей на странице админ-списка
 
 # Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=BOT_EXECUTION_MODE == 'pool', num_threads=BOT_WORKERS)
+
+# Пул обработчиков с порядком по чатам (None в режимах pool и sync)
+HANDLER_POOL = configure_execution(bot)
+
+# Сервер вебхука (только в режиме BOT_UPDATE_MODE=webhook)
+WEBHOOK_SERVER = None
+
+# Исходящие сообщения с ограничением частоты
+DISPATCHER = MessageDispatcher(bot)
+
+# Выгрузка записей в Excel в фоновом потоке
+EXPORTER = ExcelExporter(bot, DISPATCHER)
 
 # Настройка логгирования
 logging.basicConfig(
@@ -43,259 +68,87 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Часовой пояс для Оренбурга (UTC+5)
-ORENBURG_TZ = pytz.timezone('Asia/Yekaterinburg')
+ORENBURG_TZ = SALON_TZ
 
-# Словарь для хранения состояния пользователей
-USER_STATE = {}
+# Состояния диалогов пользователей (память или SQLite, см. STATE_BACKEND)
+STATES = create_state_store()
+
+# Выбор обработчика текстовых сообщений по кнопке и шагу сценария
+ROUTER = MessageRouter(STATES.get_step, ADMIN_CHAT_IDS)
 
 # --- Вспомогательные функции ---
-def get_db_connection():
-    """Создает соединение с БД с таймаутом"""
-    return sqlite3.connect('salon.db', timeout=10)
+def reply(chat_id, text, **kwargs):
+    """Отправляет ответ пользователю через диспетчер с наивысшим приоритетом"""
+    return DISPATCHER.reply(chat_id, text, **kwargs)
 
 def get_masters():
-    """Получает список мастеров из БД"""
+    """Получает список мастеров из кэша справочников"""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM masters WHERE is_active = 1")
-            return c.fetchall()
+        return CATALOG.masters()
     except Exception as e:
         logger.error(f"Ошибка получения мастеров: {e}")
-        return []
+        return ()
 
 def get_services():
-    """Получает список услуг из БД"""
+    """Получает список услуг из кэша справочников"""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, name, duration, price FROM services WHERE is_active = 1")
-            return c.fetchall()
+        return CATALOG.services()
     except Exception as e:
         logger.error(f"Ошибка получения услуг: {e}")
-        return []
+        return ()
 
 def save_appointment(chat_id, state):
-    """Сохраняет запись в БД"""
+    """Бронирует время и сохраняет запись в БД.
+    
+    Возвращает ReservationResult или None при ошибке.
+    """
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('''INSERT INTO appointments 
-                        (client_id, client_name, phone, master_id, service_id, date, time) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                    (chat_id, state['client_name'], state['phone'], 
-                     state['master_id'], state['service_id'], state['date'], state['time']))
-            conn.commit()
-            return c.lastrowid
+        result = reserve_slot(chat_id, state.client_name, state.phone,
+                              state.master_id, state.service_id, state.date, state.time)
+        if result.ok:
+            REMINDERS.schedule(result.appointment_id, state.date, state.time)
+        return result
     except Exception as e:
         logger.error(f"Ошибка сохранения записи: {e}")
         return None
 
-# --- Google Sheets Integration ---
-def get_google_sheet():
-    """Аутентификация и доступ к таблице"""
-    try:
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        creds = Credentials.from_service_account_file(
-            'credentials.json',
-            scopes=scope
-        )
-        
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(GOOGLE_SHEET_ID)
-        return sheet.worksheet(GOOGLE_SHEET_NAME)
-    except Exception as e:
-        logger.error(f"Ошибка доступа к Google Sheets: {e}")
-        return None
-
-def init_google_sheet():
-    """Инициализация структуры таблицы"""
-    try:
-        worksheet = get_google_sheet()
-        if not worksheet:
-            return
-            
-        headers = [
-            "ID", "Дата записи", "Время", "Клиент", "Телефон",
-            "Мастер", "Услуга", "Длительность", "Цена", "Статус", "Причина отмены"
-        ]
-        worksheet.clear()
-        worksheet.append_row(headers)
-        logger.info("Google Sheet инициализирована")
-    except Exception as e:
-        logger.error(f"Ошибка инициализации Google Sheet: {e}")
-
-def update_google_sheet(appointment_id, action="add", reason=""):
-    """Обновляет Google Sheets при изменениях"""
-    try:
-        worksheet = get_google_sheet()
-        if not worksheet:
-            return
-            
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT 
-                        a.id, a.date, a.time, a.client_name, a.phone,
-                        m.name, s.name, s.duration, s.price, a.status, a.cancel_reason
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id
-                        WHERE a.id = ?""", (appointment_id,))
-            appointment = c.fetchone()
-        
-        if not appointment:
-            return
-        
-        row = list(appointment)
-        row[1] = datetime.datetime.strptime(row[1], '%Y-%m-%d').strftime('%d.%m.%Y')
-        
-        if action == "add":
-            worksheet.append_row(row)
-        elif action == "update":
-            cell = worksheet.find(str(appointment_id))
-            if cell:
-                for i, value in enumerate(row, start=1):
-                    worksheet.update_cell(cell.row, i, value)
-        elif action == "cancel":
-            cell = worksheet.find(str(appointment_id))
-            if cell:
-                # Обновляем статус и причину отмены
-                worksheet.update_cell(cell.row, 10, "Отменено")
-                worksheet.update_cell(cell.row, 11, reason)
-                
-    except Exception as e:
-        logger.error(f"Ошибка обновления Google Sheet: {e}")
+# --- Автоматические напоминания ---
+def send_reminder(appointment, reminder_type):
+    """Отправляет напоминание за 12 часов или за 1 час до записи"""
+    app_id, client_id, client_name, date_str, time_str, master_name, service_name = appointment
+    
+    hours_text = "12 часов" if reminder_type == 12 else "1 час"
+    message = (
+        f"⏰ Напоминание о записи!\n\n"
+        f"Здравствуйте, {client_name}!\n"
+        f"Через {hours_text} у вас запись к мастеру {master_name}\n"
+        f"Услуга: {service_name}\n"
+        f"Время: {time_str}\n\n"
+        f"📍 Адрес: {SALON_ADDRESS}\n"
+        f"📱 Контакты: {SALON_PHONE}\n\n"
+        f"Если не можете прийти, отмените запись через меню 'Мои записи'"
+    )
+    
+    def on_error(chat_id, e):
+        # Если бот заблокирован, помечаем запись как отмененную
+        if "bot was blocked" in str(e).lower():
+            logger.warning(f"Клиент {client_id} заблокировал бота, отменяем запись")
+            repository.cancel_appointment(app_id, reason="Клиент заблокировал бота")
+            AVAILABILITY.on_canceled(app_id)
+            REMINDERS.cancel(app_id)
+            SHEET_SYNC.enqueue(app_id)
+        else:
+            logger.error(f"Ошибка отправки напоминания за {reminder_type} часов: {e}")
+            REMINDERS.retry(app_id, reminder_type)
+    
+    DISPATCHER.send(client_id, message, priority=PRIORITY_REMINDER, on_error=on_error)
+    logger.info(f"Напоминание за {reminder_type} часов клиенту {client_id} поставлено в очередь")
 
-def sync_all_to_google():
-    """Полная синхронизация с Google Sheets"""
-    try:
-        worksheet = get_google_sheet()
-        if not worksheet:
-            return
-            
-        worksheet.clear()
-        headers = [
-            "ID", "Дата записи", "Время", "Клиент", "Телефон",
-            "Мастер", "Услуга", "Длительность", "Цена", "Статус", "Причина отмены"
-        ]
-        worksheet.append_row(headers)
-        
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT 
-                        a.id, a.date, a.time, a.client_name, a.phone,
-                        m.name, s.name, s.duration, s.price, a.status, a.cancel_reason
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id""")
-            appointments = c.fetchall()
-        
-        batch = []
-        for app in appointments:
-            row = list(app)
-            row[1] = datetime.datetime.strptime(row[1], '%Y-%m-%d').strftime('%d.%m.%Y')
-            batch.append(row)
-        
-        if batch:
-            worksheet.append_rows(batch)
-        
-        logger.info("Полная синхронизация с Google Sheets выполнена")
-    except Exception as e:
-        logger.error(f"Ошибка полной синхронизации: {e}")
+REMINDERS = ReminderScheduler(send_reminder, ORENBURG_TZ,
+                              watch=VersionWatch('appointments') if BOT_CLUSTER else None)
 
-# --- Автоматические напоминания (исправленная версия) ---
-def send_reminders():
-    """Функция отправки напоминаний за 12 часов и за 1 час до записи"""
-    while True:
-        try:
-            # Текущее время в Оренбурге
-            now = datetime.datetime.now(ORENBURG_TZ)
-            logger.info(f"Проверка напоминаний в {now}")
-            
-            # Получаем все активные записи
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute("""SELECT 
-                            a.id, a.client_id, a.client_name, a.date, a.time,
-                            m.name, s.name
-                            FROM appointments a
-                            JOIN masters m ON a.master_id = m.id
-                            JOIN services s ON a.service_id = s.id
-                            WHERE a.status = 'active'""")
-                appointments = c.fetchall()
-            
-            for app in appointments:
-                app_id, client_id, client_name, date_str, time_str, master_name, service_name = app
-                
-                # Создаем объект datetime для записи
-                appointment_datetime = ORENBURG_TZ.localize(
-                    datetime.datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
-                )
-                
-                # Вычисляем разницу во времени
-                time_diff = appointment_datetime - now
-                hours_diff = time_diff.total_seconds() / 3600
-                
-                # Определяем тип напоминания (12 часов или 1 час)
-                reminder_type = None
-                if 11.5 <= hours_diff <= 12.5:
-                    reminder_type = 12
-                elif 0.5 <= hours_diff <= 1.5:
-                    reminder_type = 1
-                
-                if not reminder_type:
-                    continue
-                
-                # Формируем сообщение в зависимости от типа напоминания
-                if reminder_type == 12:
-                    message = (
-                        f"⏰ Напоминание о записи!\n\n"
-                        f"Здравствуйте, {client_name}!\n"
-                        f"Через 12 часов у вас запись к мастеру {master_name}\n"
-                        f"Услуга: {service_name}\n"
-                        f"Время: {time_str}\n\n"
-                        f"📍 Адрес: {SALON_ADDRESS}\n"
-                        f"📱 Контакты: {SALON_PHONE}\n\n"
-                        f"Если не можете прийти, отмените запись через меню 'Мои записи'"
-                    )
-                else:
-                    message = (
-                        f"⏰ Напоминание о записи!\n\n"
-                        f"Здравствуйте, {client_name}!\n"
-                        f"Через 1 час у вас запись к мастеру {master_name}\n"
-                        f"Услуга: {service_name}\n"
-                        f"Время: {time_str}\n\n"
-                        f"📍 Адрес: {SALON_ADDRESS}\n"
-                        f"📱 Контакты: {SALON_PHONE}\n\n"
-                        f"Если не можете прийти, отмените запись через меню 'Мои записи'"
-                    )
-                
-                try:
-                    # Отправляем напоминание
-                    bot.send_message(client_id, message)
-                    logger.info(f"Отправлено напоминание за {reminder_type} часов клиенту {client_id}")
-                    
-                except Exception as e:
-                    # Если бот заблокирован, помечаем запись как отмененную
-                    if "bot was blocked" in str(e).lower():
-                        logger.warning(f"Клиент {client_id} заблокировал бота, отменяем запись")
-                        with get_db_connection() as conn:
-                            c = conn.cursor()
-                            c.execute("UPDATE appointments SET status='canceled' WHERE id=?", (app_id,))
-                            conn.commit()
-                    else:
-                        logger.error(f"Ошибка отправки напоминания за {reminder_type} часов: {e}")
-            
-            # Проверяем каждые 30 минут
-            time.sleep(1800)
-            
-        except Exception as e:
-            logger.error(f"Ошибка в потоке напоминаний: {e}")
-            time.sleep(60)
+# Завершение прошедших записей и перенос старых в архив
+LIFECYCLE = AppointmentLifecycle(ORENBURG_TZ)
 
 # --- Основные обработчики бота ---
 def show_main_menu(chat_id):
@@ -305,7 +158,7 @@ def show_main_menu(chat_id):
     markup.add(types.KeyboardButton('📋 Мои записи'))
     markup.add(types.KeyboardButton('ℹ️ О салоне'))
     
-    bot.send_message(
+    reply(
         chat_id,
         "👋 Добро пожаловать в наш салон красоты!\n"
         "Выберите действие:",
@@ -317,7 +170,10 @@ def start(message):
     """Обработчик команды /start"""
     show_main_menu(message.chat.id)
 
-@bot.message_handler(func=lambda message: message.text == 'ℹ️ О салоне')
+# Все текстовые кнопки и шаги сценариев обрабатываются маршрутизатором
+ROUTER.attach(bot)
+
+@ROUTER.text('ℹ️ О салоне', interrupt=True)
 def about_salon(message):
     """Информация о салоне"""
     text = (
@@ -328,9 +184,9 @@ def about_salon(message):
         f"Мы предлагаем широкий спектр услуг по уходу за ногтями и кожей рук. "
         f"Наши мастера - профессионалы с большим опытом работы."
     )
-    bot.send_message(message.chat.id, text)
+    reply(message.chat.id, text)
 
-@bot.message_handler(func=lambda message: message.text == '📅 Записаться')
+@ROUTER.text('📅 Записаться', interrupt=True)
 def start_booking(message):
     """Начало процесса записи"""
     show_masters(message.chat.id)
@@ -340,26 +196,26 @@ def show_masters(chat_id):
     try:
         masters = get_masters()
         if not masters:
-            bot.send_message(chat_id, "❌ В данный момент нет доступных мастеров")
+            reply(chat_id, "❌ В данный момент нет доступных мастеров")
             return
         
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        for master_id, name in masters:
-            markup.add(types.KeyboardButton(f"Мастер {name}"))
+        for master in masters:
+            markup.add(types.KeyboardButton(master.label))
         
         markup.add(types.KeyboardButton('↩️ Назад'))
-        bot.send_message(chat_id, "👩‍🎨 Выберите мастера:", reply_markup=markup)
-        USER_STATE[chat_id] = {'step': 'select_master'}
+        reply(chat_id, "👩‍🎨 Выберите мастера:", reply_markup=markup)
+        STATES.begin(chat_id, 'select_master')
     except Exception as e:
         logger.error(f"Ошибка показа мастеров: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
+        reply(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
 
-@bot.message_handler(func=lambda message: message.text == '↩️ Назад')
+@ROUTER.text('↩️ Назад', interrupt=True)
 def back_to_main(message):
     """Возврат в главное меню"""
     show_main_menu(message.chat.id)
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'select_master')
+@ROUTER.step('select_master')
 def select_master(message):
     """Обрабатывает выбор мастера"""
     try:
@@ -367,50 +223,41 @@ def select_master(message):
             show_main_menu(message.chat.id)
             return
             
-        masters = get_masters()
-        selected = None
-        
-        for master_id, name in masters:
-            if f"Мастер {name}" in message.text:
-                selected = (master_id, name)
-                break
+        selected = CATALOG.find_master(message.text)
         
         if selected:
-            USER_STATE[message.chat.id] = {
-                'step': 'select_service',
-                'master_id': selected[0],
-                'master_name': selected[1]
-            }
+            STATES.begin(
+                message.chat.id, 'select_service',
+                master_id=selected.id,
+                master_name=selected.name
+            )
             show_services(message.chat.id)
         else:
-            bot.send_message(message.chat.id, "❌ Пожалуйста, выберите мастера из списка")
+            reply(message.chat.id, "❌ Пожалуйста, выберите мастера из списка")
             show_masters(message.chat.id)
     except Exception as e:
         logger.error(f"Ошибка выбора мастера: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
 
 def show_services(chat_id):
     """Показывает список услуг"""
     try:
         services = get_services()
         if not services:
-            bot.send_message(chat_id, "❌ В данный момент нет доступных услуг")
+            reply(chat_id, "❌ В данный момент нет доступных услуг")
             return
         
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        for service_id, name, duration, price in services:
-            hours = duration // 60
-            minutes = duration % 60
-            duration_str = f"{hours}ч {minutes}мин" if hours else f"{minutes}мин"
-            markup.add(types.KeyboardButton(f"{name} ({duration_str}) - {price}₽"))
+        for service in services:
+            markup.add(types.KeyboardButton(service.label))
         
         markup.add(types.KeyboardButton('↩️ Назад'))
-        bot.send_message(chat_id, "💅 Выберите услугу:", reply_markup=markup)
+        reply(chat_id, "💅 Выберите услугу:", reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка показа услуг: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
+        reply(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'select_service')
+@ROUTER.step('select_service')
 def select_service(message):
     """Обрабатывает выбор услуги"""
     try:
@@ -418,53 +265,47 @@ def select_service(message):
             show_masters(message.chat.id)
             return
             
-        services = get_services()
-        selected = None
-        
-        for service_id, name, duration, price in services:
-            if name in message.text:
-                selected = (service_id, name, duration, price)
-                break
+        selected = CATALOG.find_service(message.text)
         
         if selected:
-            USER_STATE[message.chat.id].update({
-                'step': 'get_name',
-                'service_id': selected[0],
-                'service_name': selected[1],
-                'duration': selected[2],
-                'price': selected[3]
-            })
-            bot.send_message(
+            STATES.update(
+                message.chat.id,
+                step='get_name',
+                service_id=selected.id,
+                service_name=selected.name,
+                duration=selected.duration,
+                price=selected.price
+            )
+            reply(
                 message.chat.id, 
                 "📝 Введите ваше имя:",
                 reply_markup=types.ReplyKeyboardRemove()
             )
         else:
-            bot.send_message(message.chat.id, "❌ Пожалуйста, выберите услугу из списка")
+            reply(message.chat.id, "❌ Пожалуйста, выберите услугу из списка")
             show_services(message.chat.id)
     except Exception as e:
         logger.error(f"Ошибка выбора услуги: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'get_name')
+@ROUTER.step('get_name')
 def get_client_name(message):
     """Получает имя клиента"""
     try:
         name = message.text.strip()
         if name and 2 <= len(name) <= 50:
-            USER_STATE[message.chat.id]['client_name'] = name
-            USER_STATE[message.chat.id]['step'] = 'get_phone'
-            bot.send_message(
+            STATES.update(message.chat.id, client_name=name, step='get_phone')
+            reply(
                 message.chat.id, 
                 "📱 Введите ваш телефон (пример: +79161234567):"
             )
         else:
-            bot.send_message(message.chat.id, "❌ Имя должно быть от 2 до 50 символов. Введите ваше имя:")
+            reply(message.chat.id, "❌ Имя должно быть от 2 до 50 символов. Введите ваше имя:")
     except Exception as e:
         logger.error(f"Ошибка получения имени: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'get_phone')
+@ROUTER.step('get_phone')
 def get_client_phone(message):
     """Получает телефон клиента"""
     try:
@@ -474,18 +315,17 @@ def get_client_phone(message):
         # Проверяем российские номера
         if len(cleaned_phone) == 11 and cleaned_phone.startswith(('7', '8')):
             formatted_phone = f"+7{cleaned_phone[1:]}"
-            USER_STATE[message.chat.id]['phone'] = formatted_phone
-            USER_STATE[message.chat.id]['step'] = 'select_date'
+            STATES.update(message.chat.id, phone=formatted_phone, step='select_date')
             show_calendar(message.chat.id)
         else:
-            bot.send_message(
+            reply(
                 message.chat.id, 
                 "❌ Неверный формат телефона. Пример: +79161234567 или 89161234567\n" 
                 "Пожалуйста, введите телефон еще раз:"
             )
     except Exception as e:
         logger.error(f"Ошибка получения телефона: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
 
 def show_calendar(chat_id):
     """Показывает календарь на 7 дней"""
@@ -499,13 +339,13 @@ def show_calendar(chat_id):
             markup.add(types.KeyboardButton(btn_text))
         
         markup.add(types.KeyboardButton('↩️ Назад'))
-        bot.send_message(chat_id, "📅 Выберите дату:", reply_markup=markup)
-        USER_STATE[chat_id]['step'] = 'select_date'
+        reply(chat_id, "📅 Выберите дату:", reply_markup=markup)
+        STATES.update(chat_id, step='select_date')
     except Exception as e:
         logger.error(f"Ошибка показа календаря: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
+        reply(chat_id, "❌ Произошла ошибка. Попробуйте позже.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'select_date')
+@ROUTER.step('select_date')
 def select_date(message):
     """Обрабатывает выбор даты"""
     try:
@@ -532,80 +372,37 @@ def select_date(message):
                 selected_date = None
         
         if selected_date and selected_date >= today:
-            USER_STATE[message.chat.id]['date'] = selected_date.strftime("%Y-%m-%d")
-            USER_STATE[message.chat.id]['step'] = 'select_time'
+            STATES.update(message.chat.id, date=selected_date.strftime("%Y-%m-%d"), step='select_time')
             show_time_slots(message.chat.id)
         else:
-            bot.send_message(message.chat.id, "❌ Неверная дата! Используйте формат ДД.ММ")
+            reply(message.chat.id, "❌ Неверная дата! Используйте формат ДД.ММ")
             show_calendar(message.chat.id)
     except:
-        bot.send_message(message.chat.id, "❌ Неверный формат даты! Используйте ДД.ММ")
+        reply(message.chat.id, "❌ Неверный формат даты! Используйте ДД.ММ")
         show_calendar(message.chat.id)
 
 def show_time_slots(chat_id):
     """Показывает доступные временные слоты с учетом текущего времени"""
     try:
-        state = USER_STATE[chat_id]
-        master_id = state['master_id']
-        selected_date = state['date']
-        service_duration = state['duration']
+        state = STATES.get(chat_id)
+        master_id = state.master_id
+        selected_date = state.date
+        service_duration = state.duration
         
         # Текущее время в Оренбурге
         now = datetime.datetime.now(ORENBURG_TZ)
         today = now.date()
         selected_date_obj = datetime.datetime.strptime(selected_date, '%Y-%m-%d').date()
         
-        # Получаем занятые слоты из БД
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT a.time, s.duration 
-                       FROM appointments a
-                       JOIN services s ON a.service_id = s.id
-                       WHERE master_id=? AND date=? AND status='active'""", 
-                     (master_id, selected_date))
-            booked_slots = c.fetchall()
-        
-        # Генерируем доступные слоты
-        available_slots = []
-        current_time = datetime.time(WORK_START, 0)
-        end_time = datetime.time(WORK_END, 0)
-        
         # Если выбрана сегодняшняя дата, начинаем с текущего времени + минимальный интервал
+        not_before = 0
         if selected_date_obj == today:
-            min_time = (now + datetime.timedelta(minutes=MIN_BOOKING_TIME)).time()
-            if min_time > current_time:
-                current_time = min_time
+            min_dt = now + datetime.timedelta(minutes=MIN_BOOKING_TIME)
+            not_before = min_dt.hour * 60 + min_dt.minute + (1 if min_dt.second else 0)
+            if min_dt.date() > today:
+                not_before = 24 * 60
         
-        while current_time < end_time:
-            slot_str = current_time.strftime("%H:%M")
-            
-            # Рассчитываем время окончания услуги
-            current_dt = datetime.datetime.combine(datetime.date.today(), current_time)
-            end_service_dt = current_dt + datetime.timedelta(minutes=service_duration)
-            end_service_time = end_service_dt.time()
-            
-            # Проверяем, что услуга помещается в рабочее время
-            if end_service_time > end_time:
-                current_time = (current_dt + datetime.timedelta(minutes=TIME_SLOT_STEP)).time()
-                continue
-            
-            # Проверяем пересечение с занятыми слотами
-            slot_free = True
-            for booked_time, booked_duration in booked_slots:
-                booked_time = datetime.datetime.strptime(booked_time, "%H:%M").time()
-                booked_end_dt = datetime.datetime.combine(datetime.date.today(), booked_time) + datetime.timedelta(minutes=booked_duration)
-                booked_end_time = booked_end_dt.time()
-                
-                # Проверка пересечения временных интервалов
-                if not (end_service_time <= booked_time or current_time >= booked_end_time):
-                    slot_free = False
-                    break
-            
-            if slot_free:
-                available_slots.append(slot_str)
-            
-            # Переходим к следующему слоту
-            current_time = (current_dt + datetime.timedelta(minutes=TIME_SLOT_STEP)).time()
+        available_slots = get_free_slots(master_id, selected_date, service_duration, not_before)
         
         # Создаем клавиатуру
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=4)
@@ -615,15 +412,15 @@ def show_time_slots(chat_id):
         markup.add(types.KeyboardButton('↩️ Назад'))
         
         if available_slots:
-            bot.send_message(chat_id, "⏰ Выберите время:", reply_markup=markup)
+            reply(chat_id, "⏰ Выберите время:", reply_markup=markup)
         else:
-            bot.send_message(chat_id, "😢 На этот день нет свободных слотов")
+            reply(chat_id, "😢 На этот день нет свободных слотов")
             show_calendar(chat_id)
     except Exception as e:
         logger.error(f"Ошибка показа слотов времени: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Попробуйте выбрать другую дату.")
+        reply(chat_id, "❌ Произошла ошибка. Попробуйте выбрать другую дату.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'select_time')
+@ROUTER.step('select_time')
 def select_time(message):
     """Обрабатывает выбор времени"""
     try:
@@ -633,118 +430,111 @@ def select_time(message):
             
         time_str = message.text
         if re.match(r'^\d{1,2}:\d{2}$', time_str):
-            USER_STATE[message.chat.id]['time'] = time_str
+            STATES.update(message.chat.id, time=time_str)
             confirm_booking(message.chat.id)
         else:
-            bot.send_message(message.chat.id, "❌ Неверный формат времени! Используйте ЧЧ:ММ")
+            reply(message.chat.id, "❌ Неверный формат времени! Используйте ЧЧ:ММ")
             show_time_slots(message.chat.id)
     except Exception as e:
         logger.error(f"Ошибка выбора времени: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
 
 def confirm_booking(chat_id):
     """Показывает подтверждение записи"""
     try:
-        state = USER_STATE[chat_id]
+        state = STATES.get(chat_id)
         
         # Форматируем дату
-        date_obj = datetime.datetime.strptime(state['date'], '%Y-%m-%d')
+        date_obj = datetime.datetime.strptime(state.date, '%Y-%m-%d')
         formatted_date = date_obj.strftime('%d.%m.%Y')
         
         # Создаем сообщение без номера записи
         text = (
             f"✅ Подтвердите запись:\n\n"
-            f"👩‍🎨 Мастер: {state['master_name']}\n"
-            f"💅 Услуга: {state['service_name']} - {state['price']}₽\n"
-            f"⏱ Длительность: {state['duration']} мин\n"
+            f"👩‍🎨 Мастер: {state.master_name}\n"
+            f"💅 Услуга: {state.service_name} - {state.price}₽\n"
+            f"⏱ Длительность: {state.duration} мин\n"
             f"📅 Дата: {formatted_date}\n"
-            f"⏰ Время: {state['time']}\n"
-            f"👤 Имя: {state['client_name']}\n"
-            f"📱 Телефон: {state['phone']}"
+            f"⏰ Время: {state.time}\n"
+            f"👤 Имя: {state.client_name}\n"
+            f"📱 Телефон: {state.phone}"
         )
         
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
         markup.add(types.KeyboardButton('Да, подтверждаю'))
         markup.add(types.KeyboardButton('Отменить запись'))
         
-        bot.send_message(chat_id, text, reply_markup=markup)
-        USER_STATE[chat_id]['step'] = 'confirmation'
+        reply(chat_id, text, reply_markup=markup)
+        STATES.update(chat_id, step='confirmation')
     except Exception as e:
         logger.error(f"Ошибка подтверждения записи: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Попробуйте снова.")
+        reply(chat_id, "❌ Произошла ошибка. Попробуйте снова.")
 
-@bot.message_handler(func=lambda message: USER_STATE.get(message.chat.id, {}).get('step') == 'confirmation')
+@ROUTER.step('confirmation')
 def finalize_booking(message):
     """Завершает процесс записи и показывает главное меню"""
     try:
         chat_id = message.chat.id
         
         if message.text == 'Да, подтверждаю':
-            appointment_id = save_appointment(chat_id, USER_STATE[chat_id])
+            state = STATES.get(chat_id)
+            result = save_appointment(chat_id, state)
             
-            if appointment_id:
+            if result and not result.ok:
+                # Время успели занять: предлагаем выбрать другое из обновленного кэша
+                reply(chat_id, "😢 Это время только что заняли. Выберите другое время.")
+                STATES.update(chat_id, step='select_time')
+                show_time_slots(chat_id)
+                return
+            
+            if result:
+                appointment_id = result.appointment_id
                 # Отправляем сообщение об успехе
-                bot.send_message(
+                reply(
                     chat_id, 
                     "🎉 Запись успешно сохранена! Ждем вас в салоне.",
                     reply_markup=types.ReplyKeyboardRemove()
                 )
                 
                 # Отправляем уведомление администраторам
-                state = USER_STATE[chat_id]
                 admin_msg = (
                     f"📝 Новая запись! (#{appointment_id})\n"
-                    f"👤 Клиент: {state['client_name']}\n"
-                    f"📱 Тел: {state['phone']}\n"
-                    f"👩‍🎨 Мастер: {state['master_name']}\n"
-                    f"💅 Услуга: {state['service_name']}\n"
-                    f"📅 {state['date']} {state['time']}"
+                    f"👤 Клиент: {state.client_name}\n"
+                    f"📱 Тел: {state.phone}\n"
+                    f"👩‍🎨 Мастер: {state.master_name}\n"
+                    f"💅 Услуга: {state.service_name}\n"
+                    f"📅 {state.date} {state.time}"
                 )
                 
-                for admin_id in ADMIN_CHAT_IDS:
-                    try:
-                        bot.send_message(admin_id, admin_msg)
-                    except Exception as e:
-                        logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+                DISPATCHER.broadcast(ADMIN_CHAT_IDS, admin_msg)
                 
-                # Обновляем Google Sheets
-                update_google_sheet(appointment_id, "add")
+                # Ставим запись в очередь выгрузки в Google Sheets
+                SHEET_SYNC.enqueue(appointment_id)
             else:
-                bot.send_message(chat_id, "❌ Ошибка при сохранении записи")
+                reply(chat_id, "❌ Ошибка при сохранении записи")
         else:
-            bot.send_message(chat_id, "❌ Запись отменена", reply_markup=types.ReplyKeyboardRemove())
+            reply(chat_id, "❌ Запись отменена", reply_markup=types.ReplyKeyboardRemove())
         
         # Очищаем состояние
-        if chat_id in USER_STATE:
-            del USER_STATE[chat_id]
+        STATES.delete(chat_id)
             
         # Всегда показываем главное меню после завершения
         show_main_menu(chat_id)
         
     except Exception as e:
         logger.error(f"Ошибка завершения записи: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка. Пожалуйста, начните заново.")
+        reply(chat_id, "❌ Произошла ошибка. Пожалуйста, начните заново.")
         show_main_menu(chat_id)
 
 # --- Просмотр и отмена записей пользователем ---
-@bot.message_handler(func=lambda message: message.text == '📋 Мои записи')
+@ROUTER.text('📋 Мои записи')
 def view_my_bookings(message):
     """Показывает активные записи пользователя с порядковыми номерами"""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('''SELECT 
-                        a.id, a.date, a.time, m.name, s.name 
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id
-                        WHERE a.client_id = ? AND a.status = 'active'
-                        ORDER BY a.date, a.time''',
-                    (message.chat.id,))
-            bookings = c.fetchall()
+        bookings = repository.client_appointments(message.chat.id)
         
         if not bookings:
-            bot.send_message(message.chat.id, "📭 У вас нет активных записей")
+            reply(message.chat.id, "📭 У вас нет активных записей")
             return
         
         response = "📋 Ваши активные записи:\n\n"
@@ -752,24 +542,23 @@ def view_my_bookings(message):
         
         # Используем порядковый номер вместо ID записи
         for idx, booking in enumerate(bookings, 1):
-            app_id, date, time, master, service = booking
-            date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
+            date_formatted = format_date(booking.date)
             
             response += (
                 f"🔹 <b>Запись #{idx}</b>\n"
-                f"⏰ {date_formatted} в {time}\n"
-                f"👩‍🎨 Мастер: {master}\n"
-                f"💅 Услуга: {service}\n"
+                f"⏰ {date_formatted} в {booking.time}\n"
+                f"👩‍🎨 Мастер: {booking.master_name}\n"
+                f"💅 Услуга: {booking.service_name}\n"
                 f"——————————————\n"
             )
             
             # Используем реальный ID записи в callback_data
             markup.add(types.InlineKeyboardButton(
                 text=f"❌ Отменить запись #{idx}",
-                callback_data=f"cancel_{app_id}"
+                callback_data=f"cancel_{booking.id}"
             ))
         
-        bot.send_message(
+        reply(
             message.chat.id, 
             response, 
             reply_markup=markup,
@@ -777,60 +566,48 @@ def view_my_bookings(message):
         )
     except Exception as e:
         logger.error(f"Ошибка показа записей пользователя: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
+        reply(message.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('cancel_'))
 def cancel_booking_callback(call):
     """Обрабатывает отмену записи клиентом"""
     try:
         # Получаем реальный ID записи из callback_data
-        appointment_id = call.data.split('_')[1]
+        appointment_id = int(call.data.split('_')[1])
         chat_id = call.message.chat.id
         
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            
-            # Проверяем принадлежность записи
-            c.execute("SELECT id, date, time FROM appointments WHERE id=? AND client_id=?", 
-                      (appointment_id, chat_id))
-            appointment = c.fetchone()
-            
-            if not appointment:
-                bot.answer_callback_query(call.id, "❌ Запись не найдена или не принадлежит вам")
-                return
-                
-            # Обновляем статус записи
-            c.execute("UPDATE appointments SET status='canceled' WHERE id=?", (appointment_id,))
-            conn.commit()
-            
-            # Обновляем Google Sheets
-            update_google_sheet(appointment_id, "update")
-            
-            # Форматируем дату для сообщения
-            app_id, date, time = appointment
-            date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
-            
-            # Уведомляем пользователя (без номера записи)
-            bot.answer_callback_query(call.id, "✅ Запись отменена")
-            bot.send_message(
-                chat_id, 
-                f"❌ Ваша запись на {date_formatted} в {time} отменена"
-            )
-            
-            # Уведомляем администраторов
-            for admin_id in ADMIN_CHAT_IDS:
-                try:
-                    bot.send_message(
-                        admin_id, 
-                        f"❌ Клиент отменил запись #{appointment_id}\n"
-                        f"Дата: {date} {time}\n"
-                        f"ID клиента: {chat_id}"
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
-            
-            # Обновляем список записей
-            view_my_bookings(call.message)
+        # Отменяем только активную запись этого клиента
+        appointment = repository.cancel_appointment(appointment_id, client_id=chat_id)
+        if not appointment:
+            bot.answer_callback_query(call.id, "❌ Запись не найдена или не принадлежит вам")
+            return
+        
+        AVAILABILITY.on_canceled(appointment.id, appointment.master_id, appointment.date)
+        REMINDERS.cancel(appointment.id)
+        
+        # Ставим запись в очередь выгрузки в Google Sheets
+        SHEET_SYNC.enqueue(appointment.id)
+        
+        # Форматируем дату для сообщения
+        date_formatted = format_date(appointment.date)
+        
+        # Уведомляем пользователя (без номера записи)
+        bot.answer_callback_query(call.id, "✅ Запись отменена")
+        reply(
+            chat_id, 
+            f"❌ Ваша запись на {date_formatted} в {appointment.time} отменена"
+        )
+        
+        # Уведомляем администраторов
+        DISPATCHER.broadcast(
+            ADMIN_CHAT_IDS,
+            f"❌ Клиент отменил запись #{appointment_id}\n"
+            f"Дата: {appointment.date} {appointment.time}\n"
+            f"ID клиента: {chat_id}"
+        )
+        
+        # Обновляем список записей
+        view_my_bookings(call.message)
             
     except Exception as e:
         logger.error(f"Ошибка отмены записи: {e}")
@@ -841,7 +618,7 @@ def cancel_booking_callback(call):
 def admin_panel(message):
     """Панель администратора"""
     if message.chat.id not in ADMIN_CHAT_IDS:
-        bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+        reply(message.chat.id, "⛔ Доступ запрещен")
         return
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -850,141 +627,364 @@ def admin_panel(message):
     btn3 = types.KeyboardButton('Экспорт в Excel')
     btn4 = types.KeyboardButton('Синхронизировать с Google')
     markup.add(btn1, btn2, btn3, btn4)
-    bot.send_message(message.chat.id, "Админ-панель:", reply_markup=markup)
+    reply(message.chat.id, "Админ-панель:", reply_markup=markup)
+
+# Фильтр админ-списка записей (status=None - все статусы)
+AppointmentFilter = namedtuple('AppointmentFilter', 'status master_id date_from date_to')
+
+def page_callback(flt, direction, row):
+    """callback_data кнопки листания: фильтр, направление и ключ (date, time, id).
+
+    Формат apg:<a|*>:<мастер>:<с ГГГГММДД>:<по ГГГГММДД>:<n|p>:<ГГГГММДД>:<ЧЧММ>:<id>
+    укладывается в лимит Telegram 64 байта.
+    """
+    return ':'.join((
+        'apg',
+        'a' if flt.status == 'active' else '*',
+        str(flt.master_id or 0),
+        (flt.date_from or '').replace('-', ''),
+        (flt.date_to or '').replace('-', ''),
+        direction,
+        row.date.replace('-', ''),
+        row.time.replace(':', ''),
+        str(row.id),
+    ))
+
+def parse_page_callback(data):
+    """Разбирает callback_data листания. Возвращает (фильтр, after, before)"""
+    _, status, master_id, date_from, date_to, direction, date, time_, appointment_id = data.split(':')
+
+    def iso_date(value):
+        return f"{value[:4]}-{value[4:6]}-{value[6:]}" if value else None
+
+    flt = AppointmentFilter('active' if status == 'a' else None, int(master_id) or None,
+                            iso_date(date_from), iso_date(date_to))
+    key = (iso_date(date), f"{time_[:2]}:{time_[2:]}", int(appointment_id))
+    return (flt, key, None) if direction == 'n' else (flt, None, key)
+
+def render_appointments_page(flt, after=None, before=None):
+    """Текст и кнопки листания одной страницы админ-списка записей"""
+    page = repository.appointments_page(flt.status, flt.master_id, flt.date_from, flt.date_to,
+                                        after=after, before=before, limit=ADMIN_PAGE_SIZE)
+    if not page.rows and (after or before):
+        # Записи за ключом исчезли (отмена, архив): возвращаемся к началу
+        page = repository.appointments_page(flt.status, flt.master_id, flt.date_from, flt.date_to,
+                                            limit=ADMIN_PAGE_SIZE)
 
-def get_appointments(status='active'):
-    """Получает записи из БД"""
+    title = "Активные записи" if flt.status == 'active' else "Все записи"
+    filters = []
+    if flt.master_id:
+        master = CATALOG.master_by_id(flt.master_id)
+        filters.append(f"мастер {master.name if master else flt.master_id}")
+    if flt.date_from or flt.date_to:
+        filters.append(f"{flt.date_from or '…'} — {flt.date_to or '…'}")
+    if filters:
+        title += f" ({', '.join(filters)})"
+
+    if not page.rows:
+        return f"📋 {title}: записей нет", None
+
+    response = f"📋 {title}:\n\n"
+    for app in page.rows:
+        date_formatted = format_date(app.date)
+        response += (
+            f"🔹 #{app.id}\n"
+            f"👤 {app.client_name} | 📱 {app.phone}\n"
+            f"👩‍🎨 Мастер: {app.master_name}\n"
+            f"💅 Услуга: {app.service_name}\n"
+            f"⏰ {date_formatted} в {app.time}\n"
+        )
+        if flt.status is None:
+            response += f"📌 {STATUS_LABELS.get(app.status, app.status)}\n"
+        response += "————————————————\n"
+
+    buttons = []
+    if page.has_prev:
+        buttons.append(types.InlineKeyboardButton("◀️ Назад", callback_data=page_callback(flt, 'p', page.rows[0])))
+    if page.has_next:
+        buttons.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=page_callback(flt, 'n', page.rows[-1])))
+    markup = None
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.row(*buttons)
+    return response, markup
+
+def show_appointments_page(chat_id, flt):
+    """Отправляет первую страницу админ-списка записей"""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            if status == 'all':
-                c.execute("""SELECT 
-                            a.id, a.client_name, a.phone, 
-                            m.name, s.name, a.date, a.time 
-                            FROM appointments a
-                            JOIN masters m ON a.master_id = m.id
-                            JOIN services s ON a.service_id = s.id
-                            ORDER BY a.date, a.time""")
-            else:
-                c.execute("""SELECT 
-                            a.id, a.client_name, a.phone, 
-                            m.name, s.name, a.date, a.time 
-                            FROM appointments a
-                            JOIN masters m ON a.master_id = m.id
-                            JOIN services s ON a.service_id = s.id
-                            WHERE a.status = 'active'
-                            ORDER BY a.date, a.time""")
-            return c.fetchall()
+        text, markup = render_appointments_page(flt)
+        reply(chat_id, text, reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка получения записей: {e}")
-        return []
+        reply(chat_id, "❌ Ошибка получения записей")
 
-@bot.message_handler(func=lambda message: message.text == 'Активные записи' and message.chat.id in ADMIN_CHAT_IDS)
+@ROUTER.text('Активные записи', admin=True)
 def show_active_appointments(message):
-    """Показывает активные записи"""
-    appointments = get_appointments()
-    
-    if not appointments:
-        bot.send_message(message.chat.id, "Активных записей нет")
+    """Показывает активные записи постранично"""
+    show_appointments_page(message.chat.id, AppointmentFilter('active', None, None, None))
+
+@ROUTER.text('Все записи', admin=True)
+def show_all_appointments(message):
+    """Показывает все записи постранично"""
+    show_appointments_page(message.chat.id, AppointmentFilter(None, None, None, None))
+
+def parse_appointment_filter(args, status='active'):
+    """Разбирает аргументы [all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [мастер] в фильтр записей.
+
+    Ошибка формата - ValueError с текстом для пользователя.
+    """
+    try:
+        parts = shlex.split(args)
+    except ValueError:
+        raise ValueError("❌ Не закрыта кавычка в имени мастера")
+    if parts and parts[0] == 'all':
+        status = None
+        parts = parts[1:]
+
+    dates = []
+    while parts and len(dates) < 2 and re.fullmatch(r'\d{4}-\d{2}-\d{2}', parts[0]):
+        try:
+            datetime.datetime.strptime(parts[0], '%Y-%m-%d')
+        except ValueError:
+            raise ValueError("❌ Неверная дата, используйте ГГГГ-ММ-ДД")
+        dates.append(parts.pop(0))
+    # Одна дата - записи за этот день
+    date_from, date_to = (dates + dates)[:2] if dates else (None, None)
+
+    master_id = None
+    if parts:
+        master = CATALOG.find_master(' '.join(parts))
+        if not master:
+            raise ValueError(f"❌ Мастер '{' '.join(parts)}' не найден")
+        master_id = master.id
+
+    return AppointmentFilter(status, master_id, date_from, date_to)
+
+def command_filter(message, command):
+    """Фильтр из аргументов команды или None (ошибка уже отправлена)"""
+    try:
+        return parse_appointment_filter(message.text.partition(' ')[2])
+    except ValueError as e:
+        reply(message.chat.id, f"{e}\n\nФормат команды:\n"
+                               f"/{command} [all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [\"Имя мастера\"]")
+        return None
+
+@bot.message_handler(commands=['appointments'])
+def filter_appointments(message):
+    """Список записей с фильтром по датам и мастеру"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
         return
-    
-    response = "📋 Активные записи:\n\n"
-    for app in appointments:
-        app_id, client_name, phone, master_name, service_name, date, time = app
-        date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
-        response += (
-            f"🔹 #{app_id}\n"
-            f"👤 {client_name} | 📱 {phone}\n"
-            f"👩‍🎨 Мастер: {master_name}\n"
-            f"💅 Услуга: {service_name}\n"
-            f"⏰ {date_formatted} в {time}\n"
-            f"————————————————\n"
+
+    flt = command_filter(message, 'appointments')
+    if flt:
+        show_appointments_page(message.chat.id, flt)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('apg:'))
+def appointments_page_callback(call):
+    """Листает админ-список записей, редактируя то же сообщение"""
+    if call.message.chat.id not in ADMIN_CHAT_IDS:
+        bot.answer_callback_query(call.id, "⛔ Доступ запрещен")
+        return
+
+    try:
+        flt, after, before = parse_page_callback(call.data)
+        text, markup = render_appointments_page(flt, after, before)
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Ошибка листания записей: {e}")
+        bot.answer_callback_query(call.id, "❌ Не удалось показать страницу")
+
+def start_export(chat_id, flt):
+    """Ставит выгрузку в Excel в очередь фонового потока"""
+    waiting = EXPORTER.submit(chat_id, flt.status, flt.master_id, flt.date_from, flt.date_to)
+    if waiting is None:
+        # Данные не менялись: готовый файл уже отправлен из кэша
+        return
+    if waiting:
+        reply(chat_id, f"⏳ Готовлю файл, перед ним в очереди выгрузок: {waiting}")
+    else:
+        reply(chat_id, "⏳ Готовлю файл, пришлю его, как только он будет готов")
+
+@ROUTER.text('Экспорт в Excel', admin=True)
+def export_to_excel(message):
+    """Экспорт расписания в Excel (все записи)"""
+    start_export(message.chat.id, AppointmentFilter(None, None, None, None))
+
+@bot.message_handler(commands=['export'])
+def export_filtered(message):
+    """Экспорт в Excel с фильтром по статусу, датам и мастеру"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
+
+    flt = command_filter(message, 'export')
+    if flt:
+        start_export(message.chat.id, flt)
+
+@ROUTER.text('Синхронизировать с Google', admin=True)
+def sync_google_sheet(message):
+    """Ручная синхронизация изменений с Google Sheets"""
+    run_as_leader('syncsheet', message.chat.id)
+
+def sync_sheet_job(chat_id):
+    try:
+        changed = sync_changes_to_google()
+        SHEET_SYNC.flush()
+        reply(
+            chat_id,
+            f"✅ Google Sheets синхронизирована (изменено записей: {changed}, "
+            f"в очереди: {SHEET_SYNC.pending()})"
         )
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
+        reply(chat_id, f"❌ Ошибка синхронизации: {str(e)}")
+
+@bot.message_handler(commands=['verifysheet'])
+def verify_google_sheet(message):
+    """Сверяет индекс строк с листом Google Sheets"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
     
-    bot.send_message(message.chat.id, response)
+    run_as_leader('verifysheet', message.chat.id)
 
-@bot.message_handler(func=lambda message: message.text == 'Все записи' and message.chat.id in ADMIN_CHAT_IDS)
-def show_all_appointments(message):
-    """Показывает все записи"""
-    appointments = get_appointments('all')
+def verify_sheet_job(chat_id):
+    try:
+        worksheet = SHEET_CLIENT.worksheet()
+        with SHEET_WRITE_LOCK:
+            drift = verify_row_index(worksheet)
+        if drift:
+            reply(chat_id, f"🔧 Индекс строк восстановлен, исправлено записей: {drift}")
+        else:
+            reply(chat_id, "✅ Индекс строк совпадает с таблицей")
+    except Exception as e:
+        logger.error(f"Ошибка проверки Google Sheets: {e}")
+        SHEET_CLIENT.handle_error(e)
+        reply(chat_id, f"❌ Ошибка проверки: {str(e)}")
+
+@bot.message_handler(commands=['rebuildsheet'])
+def rebuild_google_sheet(message):
+    """Полная пересборка Google Sheets из БД (восстановление)"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
+    
+    run_as_leader('rebuildsheet', message.chat.id)
+
+def rebuild_sheet_job(chat_id):
+    reply(chat_id, "⏳ Пересобираю таблицу целиком...")
+    if sync_all_to_google():
+        reply(chat_id, "✅ Таблица пересобрана")
+    else:
+        reply(chat_id, "❌ Не удалось пересобрать таблицу, подробности в логе")
+
+@bot.message_handler(commands=['dbstats'])
+def show_db_stats(message):
+    """Показывает статистику пула соединений с БД"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
     
-    if not appointments:
-        bot.send_message(message.chat.id, "Записей нет")
+    stats = get_pool_stats()
+    cache_stats = AVAILABILITY.get_stats()
+    dispatch_stats = DISPATCHER.get_stats()
+    state_stats = STATES.get_stats()
+    export_stats = EXPORTER.get_stats()
+    lifecycle_stats = LIFECYCLE.get_stats()
+    reply(
+        message.chat.id,
+        f"🗄 Пул соединений БД ({STORAGE.dialect})\n\n"
+        f"Соединений: {stats['in_use']} занято / {stats['idle']} свободно (макс. {stats['size']})\n"
+        f"Открыто всего: {stats['created']}\n"
+        f"Выдач соединений: {stats['checkouts']}\n"
+        f"Ожидание: в среднем {stats['avg_wait_ms']} мс, максимум {stats['max_wait_ms']} мс\n"
+        f"Повторов при блокировке: {stats['busy_retries']} (неудачных: {stats['busy_failures']})\n\n"
+        f"Кэш занятости: {cache_stats['days']} дней, "
+        f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n"
+        f"Исходящие: в очереди {dispatch_stats['queued']}, отправлено {dispatch_stats['sent']}, "
+        f"ошибок {dispatch_stats['failed']}, пауз по 429: {dispatch_stats['throttled']}\n"
+        f"Диалоги ({state_stats['backend']}): {state_stats['size']} из {state_stats['max_size']}, "
+        f"истекло {state_stats['expired']}, вытеснено {state_stats['evicted']}\n"
+        f"Выгрузки: новых {export_stats['exported']}, из кэша {export_stats['reused']}, "
+        f"ошибок {export_stats['failed']}; в кэше {export_stats['cache']['files']} файлов, "
+        f"{export_stats['cache']['size_mb']} МБ\n"
+        f"Жизненный цикл: завершено {lifecycle_stats['completed']}, в архив {lifecycle_stats['archived']}, "
+        f"последний обход {lifecycle_stats['last_run'] or '—'}"
+    )
+
+@bot.message_handler(commands=['workerstats'])
+def show_worker_stats(message):
+    """Показывает загрузку пула обработчиков обновлений"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
         return
     
-    response = "📋 Все записи:\n\n"
-    for app in appointments:
-        app_id, client_name, phone, master_name, service_name, date, time = app
-        date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
-        response += (
-            f"🔹 #{app_id}\n"
-            f"👤 {client_name} | 📱 {phone}\n"
-            f"👩‍🎨 Мастер: {master_name}\n"
-            f"💅 Услуга: {service_name}\n"
-            f"⏰ {date_formatted} в {time}\n"
-            f"————————————————\n"
+    text = f"⚙️ Обработка обновлений ({BOT_UPDATE_MODE}, {BOT_EXECUTION_MODE})\n\n"
+    if WEBHOOK_SERVER is not None:
+        hook = WEBHOOK_SERVER.get_stats()
+        text += (
+            f"Вебхук: в очереди {hook['queued']} из {hook['capacity']}, принято {hook['received']}\n"
+            f"Отклонено: по секрету {hook['rejected']}, при переполнении {hook['overflows']}, "
+            f"повторов {hook['duplicates']}\n\n"
         )
+    if HANDLER_POOL is None:
+        reply(message.chat.id, text + "Статистика пула недоступна в этом режиме")
+        return
     
-    bot.send_message(message.chat.id, response)
+    stats = HANDLER_POOL.get_stats()
+    reply(
+        message.chat.id,
+        text +
+        f"Потоков: {stats['busy']} занято из {stats['workers']}\n"
+        f"В очереди: {stats['queued']} (максимум {stats['max_queued']}), чатов: {stats['chats']}\n"
+        f"Обработано: {stats['processed']} (ошибок: {stats['failed']}, медленных: {stats['slow']})\n"
+        f"Ожидание в очереди: в среднем {stats['avg_wait_ms']} мс\n"
+        f"Время обработки: в среднем {stats['avg_latency_ms']} мс, "
+        f"p95 {stats['p95_latency_ms']} мс, максимум {stats['max_latency_ms']} мс"
+    )
 
-@bot.message_handler(func=lambda message: message.text == 'Экспорт в Excel' and message.chat.id in ADMIN_CHAT_IDS)
-def export_to_excel(message):
-    """Экспорт расписания в Excel"""
-    appointments = get_appointments('all')
-    
-    if not appointments:
-        bot.send_message(message.chat.id, "Нет записей для экспорта")
+@bot.message_handler(commands=['querystats'])
+def show_query_stats(message):
+    """Показывает самые затратные запросы к БД"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
+
+    stats = repository.get_stats()
+    if not stats:
+        reply(message.chat.id, "Запросов к БД еще не было")
+        return
+
+    lines = [
+        f"{item['name']}: {item['calls']} вызовов, всего {item['total_ms']} мс, "
+        f"в среднем {item['avg_ms']} мс, максимум {item['max_ms']} мс"
+        for item in stats[:10]
+    ]
+    reply(message.chat.id, "🔎 Запросы к БД\n\n" + "\n".join(lines))
+
+@bot.message_handler(commands=['sheetstats'])
+def show_sheet_stats(message):
+    """Показывает расход квоты Google Sheets"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
         return
     
-    try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Расписание"
-        
-        headers = ["ID", "Дата", "Время", "Клиент", "Телефон", "Мастер", "Услуга", "Статус"]
-        ws.append(headers)
-        
-        for app in appointments:
-            app_id, client_name, phone, master_name, service_name, date, time = app
-            date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
-            ws.append([app_id, date_formatted, time, client_name, phone, master_name, service_name, "Активна"])
-        
-        for col in range(1, len(headers) + 1):
-            cell = ws.cell(row=1, column=col)
-            cell.font = openpyxl.styles.Font(bold=True)
-        
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column].width = adjusted_width
-        
-        filename = f"schedule_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        wb.save(filename)
-        
-        with open(filename, 'rb') as file:
-            bot.send_document(message.chat.id, file, caption="📊 Расписание записей")
-        
-        os.remove(filename)
-    except Exception as e:
-        logger.error(f"Ошибка экспорта в Excel: {e}")
-        bot.send_message(message.chat.id, f"❌ Ошибка при экспорте: {str(e)}")
+    stats = SHEET_CLIENT.get_stats()
+    reply(
+        message.chat.id,
+        f"📊 Google Sheets\n\n"
+        f"Подключено: {'да' if stats['connected'] else 'нет'} (подключений: {stats['connects']})\n"
+        f"Обновлений токена: {stats['auth_refreshes']}\n"
+        f"Запросов к API: {stats['api_calls']} (ошибок: {stats['api_errors']})\n"
+        f"В очереди на выгрузку: {SHEET_SYNC.pending()}"
+    )
 
-@bot.message_handler(func=lambda message: message.text == 'Синхронизировать с Google' and message.chat.id in ADMIN_CHAT_IDS)
-def sync_google_sheet(message):
-    """Ручная синхронизация с Google Sheets"""
-    try:
-        sync_all_to_google()
-        bot.send_message(message.chat.id, "✅ Google Sheets успешно синхронизирована")
-    except Exception as e:
-        logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
-        bot.send_message(message.chat.id, f"❌ Ошибка синхронизации: {str(e)}")
+@bot.message_handler(commands=['reloadcatalog'])
+def reload_catalog(message):
+    """Сбрасывает кэш мастеров и услуг"""
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        return
+    
+    CATALOG.invalidate()
+    snapshot = CATALOG.snapshot()
+    reply(
+        message.chat.id,
+        f"✅ Справочники обновлены: {len(snapshot.masters)} мастеров, {len(snapshot.services)} услуг"
+    )
 
 # --- Команды администрирования записей ---
 @bot.message_handler(commands=['cancel'])
@@ -997,60 +997,41 @@ def admin_cancel_appointment(message):
         # Формат команды: /cancel <ID_записи> <Причина>
         parts = message.text.split(' ', 2)
         if len(parts) < 3:
-            bot.send_message(message.chat.id, "❌ Формат команды: /cancel <ID_записи> <Причина>")
+            reply(message.chat.id, "❌ Формат команды: /cancel <ID_записи> <Причина>")
             return
             
         appointment_id = int(parts[1])
         reason = parts[2]
         
-        # Получаем детали записи
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT 
-                        a.client_id, a.client_name, a.date, a.time,
-                        m.name, s.name
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id
-                        WHERE a.id = ? AND a.status = 'active'""", (appointment_id,))
-            appointment = c.fetchone()
-            
+        # Отменяем запись и получаем ее детали
+        appointment = repository.cancel_appointment(appointment_id, reason=reason)
         if not appointment:
-            bot.send_message(message.chat.id, "❌ Активная запись с таким ID не найдена")
+            reply(message.chat.id, "❌ Активная запись с таким ID не найдена")
             return
             
-        client_id, client_name, date, time, master_name, service_name = appointment
-        
-        # Обновляем статус записи
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""UPDATE appointments 
-                       SET status='canceled', cancel_reason = ?
-                       WHERE id=?""", (reason, appointment_id))
-            conn.commit()
+        AVAILABILITY.on_canceled(appointment_id, appointment.master_id, appointment.date)
+        REMINDERS.cancel(appointment_id)
         
         # Уведомляем клиента
-        date_formatted = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
-        try:
-            bot.send_message(
-                client_id,
-                f"❗ Ваша запись отменена администратором\n\n"
-                f"⏰ {date_formatted} в {time}\n"
-                f"👩‍🎨 Мастер: {master_name}\n"
-                f"💅 Услуга: {service_name}\n\n"
-                f"Причина: {reason}\n\n"
-                f"Пожалуйста, запишитесь на другое время."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить клиента {client_id}: {e}")
+        date_formatted = format_date(appointment.date)
+        DISPATCHER.send(
+            appointment.client_id,
+            f"❗ Ваша запись отменена администратором\n\n"
+            f"⏰ {date_formatted} в {appointment.time}\n"
+            f"👩‍🎨 Мастер: {appointment.master_name}\n"
+            f"💅 Услуга: {appointment.service_name}\n\n"
+            f"Причина: {reason}\n\n"
+            f"Пожалуйста, запишитесь на другое время.",
+            on_error=lambda chat_id, e: logger.error(f"Не удалось уведомить клиента {chat_id}: {e}")
+        )
         
-        # Обновляем Google Sheets
-        update_google_sheet(appointment_id, "cancel", reason)
-        bot.send_message(message.chat.id, f"✅ Запись #{appointment_id} отменена. Клиент уведомлен.")
+        # Ставим запись в очередь выгрузки в Google Sheets
+        SHEET_SYNC.enqueue(appointment_id)
+        reply(message.chat.id, f"✅ Запись #{appointment_id} отменена. Клиент уведомлен.")
         
     except Exception as e:
         logger.error(f"Ошибка отмены записи администратором: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при обработке команды")
+        reply(message.chat.id, "❌ Ошибка при обработке команды")
 
 @bot.message_handler(commands=['addappointment'])
 def admin_add_appointment(message):
@@ -1063,7 +1044,7 @@ def admin_add_appointment(message):
         parts = shlex.split(message.text)[1:]
         
         if len(parts) < 6:
-            bot.send_message(message.chat.id, "❌ Формат команды:\n"
+            reply(message.chat.id, "❌ Формат команды:\n"
                           "/addappointment \"Имя клиента\" \"Телефон\" \"Имя мастера\" \"Услуга\" ГГГГ-ММ-ДД ЧЧ:ММ")
             return
             
@@ -1074,90 +1055,146 @@ def admin_add_appointment(message):
             datetime.datetime.strptime(date, '%Y-%m-%d')
             datetime.datetime.strptime(time, '%H:%M')
         except ValueError:
-            bot.send_message(message.chat.id, "❌ Неверный формат даты или времени\n"
+            reply(message.chat.id, "❌ Неверный формат даты или времени\n"
                           "Используйте: ГГГГ-ММ-ДД и ЧЧ:ММ")
             return
         
-        # Ищем мастера и услугу в БД
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            
-            # Поиск мастера
-            c.execute("SELECT id FROM masters WHERE name = ?", (master_name,))
-            master = c.fetchone()
-            if not master:
-                bot.send_message(message.chat.id, f"❌ Мастер '{master_name}' не найден")
-                return
-            master_id = master[0]
-            
-            # Поиск услуги
-            c.execute("SELECT id, duration FROM services WHERE name = ?", (service_name,))
-            service = c.fetchone()
-            if not service:
-                bot.send_message(message.chat.id, f"❌ Услуга '{service_name}' не найдена")
-                return
-            service_id = service[0]
-            duration = service[1]
-            
-            # Проверка доступности времени
-            c.execute("""SELECT 1 FROM appointments 
-                      WHERE master_id = ? AND date = ? AND time = ? AND status = 'active'""",
-                      (master_id, date, time))
-            if c.fetchone():
-                bot.send_message(message.chat.id, "❌ Это время уже занято")
-                return
+        # Ищем мастера и услугу в справочниках
+        master = CATALOG.snapshot().master_by_name.get(master_name)
+        if not master:
+            reply(message.chat.id, f"❌ Мастер '{master_name}' не найден")
+            return
+        master_id = master.id
+        
+        service = CATALOG.snapshot().service_by_name.get(service_name)
+        if not service:
+            reply(message.chat.id, f"❌ Услуга '{service_name}' не найдена")
+            return
+        service_id = service.id
+        duration = service.duration
         
-        # Создаем фейковый state
-        state = {
-            'client_name': client_name,
-            'phone': phone,
-            'master_id': master_id,
-            'service_id': service_id,
-            'date': date,
-            'time': time,
-            'duration': duration
-        }
+        # Создаем временное состояние сценария
+        state = BookingState(None, client_name=client_name, phone=phone, master_id=master_id,
+                             service_id=service_id, date=date, time=time, duration=duration)
         
         # Сохраняем запись (client_id=0 для системных записей)
-        appointment_id = save_appointment(0, state)
-        if appointment_id:
-            update_google_sheet(appointment_id, "add")
-            bot.send_message(message.chat.id, f"✅ Запись успешно создана! ID: {appointment_id}")
+        result = save_appointment(0, state)
+        if result and not result.ok:
+            reply(message.chat.id, f"❌ Это время уже занято (запись #{result.conflict.appointment_id} "
+                                              f"{result.conflict.time}-{result.conflict.end_time})")
+        elif result:
+            appointment_id = result.appointment_id
+            SHEET_SYNC.enqueue(appointment_id)
+            reply(message.chat.id, f"✅ Запись успешно создана! ID: {appointment_id}")
         else:
-            bot.send_message(message.chat.id, "❌ Ошибка при создании записи")
+            reply(message.chat.id, "❌ Ошибка при создании записи")
             
     except Exception as e:
         logger.error(f"Ошибка добавления записи администратором: {e}")
-        bot.send_message(message.chat.id, f"❌ Ошибка: {str(e)}")
+        reply(message.chat.id, f"❌ Ошибка: {str(e)}")
+
+# --- Ведущий процесс и фоновая синхронизация ---
+# Запись в Google Sheets и напоминания выполняет только ведущий процесс.
+# Остальные процессы передают ему команды админов через sync_state
+LEADER_JOBS = {
+    'syncsheet': sync_sheet_job,
+    'verifysheet': verify_sheet_job,
+    'rebuildsheet': rebuild_sheet_job,
+}
+
+def run_as_leader(job, chat_id):
+    """Выполняет задание здесь или передает его ведущему процессу"""
+    if LEADER.is_leader:
+        LEADER_JOBS[job](chat_id)
+        return
+    with get_db_connection() as conn:
+        conn.execute("""INSERT INTO sync_state (key, value) VALUES (?, ?)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value""",
+                     (f"job:{job}", str(chat_id)))
+    reply(chat_id, "⏳ Команда передана ведущему процессу, результат придет сообщением")
+
+def run_leader_jobs():
+    """Выполняет задания, переданные другими процессами"""
+    with get_db_connection() as conn:
+        conn.begin_write()
+        jobs = conn.execute("SELECT key, value FROM sync_state WHERE key LIKE 'job:%'").fetchall()
+        # Удаляем только прочитанные задания: новое могло появиться после SELECT
+        claimed = []
+        for key, chat_id in jobs:
+            if conn.execute("DELETE FROM sync_state WHERE key = ? AND value = ?", (key, chat_id)).rowcount:
+                claimed.append((key, chat_id))
+    for key, chat_id in claimed:
+        job = LEADER_JOBS.get(key[len('job:'):])
+        if job:
+            job(int(chat_id))
 
-# --- Фоновая синхронизация ---
 def background_sync():
-    """Фоновая синхронизация каждые 10 минут"""
-    while True:
+    """Фоновая дельта-синхронизация каждые 10 минут, пока процесс ведущий"""
+    next_sync = 0.0
+    while LEADER.is_leader:
         try:
-            sync_all_to_google()
-            time.sleep(600)  # 10 минут
+            if time.time() >= next_sync:
+                sync_changes_to_google()
+                next_sync = time.time() + 600  # 10 минут
+            if BOT_CLUSTER:
+                run_leader_jobs()
+            time.sleep(5)
         except Exception as e:
             logger.error(f"Ошибка фоновой синхронизации: {e}")
             time.sleep(60)
 
+def start_leader_jobs():
+    """Запускает фоновые задачи ведущего процесса"""
+    global SYNC_THREAD
+    try:
+        init_google_sheet()
+        logger.info("Google Sheets инициализирована")
+    except Exception as e:
+        logger.error(f"Ошибка инициализации Google Sheets: {e}")
+    
+    REMINDERS.start()
+    SHEET_SYNC.start()
+    LIFECYCLE.start()
+    if SYNC_THREAD is None or not SYNC_THREAD.is_alive():
+        SYNC_THREAD = threading.Thread(target=background_sync, name='background-sync', daemon=True)
+        SYNC_THREAD.start()
+
+def stop_leader_jobs():
+    """Останавливает фоновые задачи при потере статуса ведущего"""
+    REMINDERS.stop()
+    SHEET_SYNC.stop()
+    LIFECYCLE.stop()
+
+SYNC_THREAD = None
+LEADER = LeaderLease(on_elected=start_leader_jobs, on_demoted=stop_leader_jobs)
+
 # Запуск бота
 if __name__ == "__main__":
     # Инициализируем базу данных
     from database import init_db
     init_db()
     
-    # Инициализация Google Sheets
-    try:
-        init_google_sheet()
-        sync_all_to_google()
-        logger.info("Google Sheets инициализирована")
-    except Exception as e:
-        logger.error(f"Ошибка инициализации Google Sheets: {e}")
+    # Кластерный режим: этот процесс только запускает и перезапускает рабочие
+    if BOT_PROCESSES > 1 and not os.getenv("BOT_WORKER_ID"):
+        if BOT_UPDATE_MODE != 'webhook':
+            raise SystemExit("Несколько процессов поддерживаются только с BOT_UPDATE_MODE=webhook")
+        if WEBHOOK_URL:
+            register_webhook(bot)
+        supervise(BOT_PROCESSES, os.path.abspath(__file__))
+        raise SystemExit(0)
     
-    # Запускаем фоновые потоки
-    threading.Thread(target=send_reminders, daemon=True).start()
-    threading.Thread(target=background_sync, daemon=True).start()
+    # Запускаем фоновые потоки; задачи ведущего стартуют при избрании
+    STATES.start()
+    LEADER.start()
+    atexit.register(LEADER.stop)
     
-    logger.info("Бот запущен...")
-    bot.infinity_polling()
+    if BOT_UPDATE_MODE == 'webhook':
+        WEBHOOK_SERVER = WebhookServer(bot)
+        if WEBHOOK_URL and not os.getenv("BOT_WORKER_ID"):
+            register_webhook(bot)
+        logger.info("Бот запущен в режиме вебхука...")
+        WEBHOOK_SERVER.serve_forever()
+    else:
+        bot.remove_webhook()
+        logger.info("Бот запущен...")
+        bot.infinity_polling()
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+import logging
+from collections import namedtuple
+import repository
+from storage import get_db_connection
+
+logger = logging.getLogger('catalog')
+
+# Как часто сверять версию справочников с БД (сек)
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", 5))
+
+Master = namedtuple('Master', 'id name label')
+Service = namedtuple('Service', 'id name duration price label')
+
+
+def master_label(name):
+    """Текст кнопки мастера"""
+    return f"Мастер {name}"
+
+
+def service_label(name, duration, price):
+    """Текст кнопки услуги"""
+    hours = duration // 60
+    minutes = duration % 60
+    duration_str = f"{hours}ч {minutes}мин" if hours else f"{minutes}мин"
+    return f"{name} ({duration_str}) - {price}₽"
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок справочников с индексами для поиска"""
+
+    __slots__ = ('version', 'masters', 'services', 'master_by_id', 'master_by_name',
+                 'master_by_label', 'service_by_id', 'service_by_name', 'service_by_label')
+
+    def __init__(self, version, masters, services):
+        self.version = version
+        self.masters = tuple(masters)
+        self.services = tuple(services)
+        self.master_by_id = {m.id: m for m in self.masters}
+        self.master_by_name = {m.name: m for m in self.masters}
+        self.master_by_label = {m.label: m for m in self.masters}
+        self.service_by_id = {s.id: s for s in self.services}
+        self.service_by_name = {s.name: s for s in self.services}
+        self.service_by_label = {s.label: s for s in self.services}
+
+
+class CatalogCache:
+    """Кэш активных мастеров и услуг на весь процесс.
+
+    Снимок перечитывается при явной инвалидации или когда счетчик
+    data_versions('catalog'), который ведут триггеры, изменился в БД.
+    """
+
+    def __init__(self, ttl=CATALOG_TTL):
+        self.ttl = ttl
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Загружает справочники из БД"""
+        with get_db_connection() as conn:
+            version = repository.data_version('catalog', conn)
+            masters = [Master(m.id, m.name, master_label(m.name)) for m in repository.masters(conn=conn)]
+            services = [
+                Service(s.id, s.name, s.duration, s.price, service_label(s.name, s.duration, s.price))
+                for s in repository.services(conn=conn)
+            ]
+        logger.info(f"Справочники загружены (версия {version}): "
+                    f"{len(masters)} мастеров, {len(services)} услуг")
+        return CatalogSnapshot(version, masters, services)
+
+    def snapshot(self):
+        """Возвращает актуальный снимок справочников"""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.ttl:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and now - self._checked_at < self.ttl:
+                return snapshot
+            if snapshot is not None:
+                if repository.data_version('catalog') == snapshot.version:
+                    self._checked_at = now
+                    return snapshot
+            self._snapshot = self._load()
+            self._checked_at = now
+            return self._snapshot
+
+    def invalidate(self):
+        """Сбрасывает кэш, следующий запрос перечитает справочники"""
+        with self._lock:
+            self._snapshot = None
+            self._checked_at = 0.0
+
+    def masters(self):
+        return self.snapshot().masters
+
+    def services(self):
+        return self.snapshot().services
+
+    def find_master(self, text):
+        """Ищет мастера по тексту кнопки или имени"""
+        snapshot = self.snapshot()
+        text = (text or '').strip()
+        return snapshot.master_by_label.get(text) or snapshot.master_by_name.get(text)
+
+    def find_service(self, text):
+        """Ищет услугу по тексту кнопки или названию"""
+        snapshot = self.snapshot()
+        text = (text or '').strip()
+        return snapshot.service_by_label.get(text) or snapshot.service_by_name.get(text)
+
+    def master_by_id(self, master_id):
+        return self.snapshot().master_by_id.get(master_id)
+
+    def service_by_id(self, service_id):
+        return self.snapshot().service_by_id.get(service_id)
+
+
+# Общий кэш справочников
+CATALOG = CatalogCache()
@@ -0,0 +1,170 @@
+import os
+import sys
+import time
+import uuid
+import socket
+import signal
+import threading
+import subprocess
+import logging
+from storage import get_db_connection
+from repository import data_version
+
+logger = logging.getLogger('cluster')
+
+# Режим нескольких процессов бота с общей БД
+BOT_CLUSTER = os.getenv("BOT_CLUSTER", "0") == "1"                        # Несколько процессов на одной БД
+BOT_PROCESSES = int(os.getenv("BOT_PROCESSES", 1))                        # Сколько процессов запускать
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 30))               # Срок аренды лидера (сек)
+LEADER_LEASE_RENEW = float(os.getenv("LEADER_LEASE_RENEW", 10))           # Период продления (сек)
+CLUSTER_VERSION_CHECK = float(os.getenv("CLUSTER_VERSION_CHECK", 1))      # Проверка чужих изменений (сек)
+
+
+class VersionWatch:
+    """Отслеживает изменение счетчика data_versions не чаще раза в interval секунд"""
+
+    def __init__(self, name, interval=CLUSTER_VERSION_CHECK):
+        self.name = name
+        self.interval = interval
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def changed(self):
+        """True, если счетчик изменился с прошлой проверки (первая проверка - False)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.interval:
+                return False
+            self._checked_at = now
+        version = data_version(self.name)
+        with self._lock:
+            previous, self.version = self.version, version
+        return previous is not None and previous != version
+
+
+class LeaderLease:
+    """Выбор ведущего процесса через строку-аренду в общей БД.
+
+    Ведущий продлевает аренду каждые LEADER_LEASE_RENEW секунд; если он
+    завис или упал, через LEADER_LEASE_TTL секунд аренду забирает другой
+    процесс. Захват и продление выполняются одним условным UPDATE строки
+    аренды (в SQLite - в транзакции BEGIN IMMEDIATE), поэтому ведущий всегда один. Процесс, не сумевший
+    продлить аренду, считает себя ведомым сразу по истечении своего срока.
+    Вне кластерного режима процесс всегда ведущий.
+    """
+
+    def __init__(self, name='leader', enabled=BOT_CLUSTER, ttl=LEADER_LEASE_TTL,
+                 renew_every=LEADER_LEASE_RENEW, on_elected=None, on_demoted=None):
+        self.name = name
+        self.enabled = enabled
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._leader = False
+        self._valid_until = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        if not self.enabled:
+            return True
+        return self._leader and time.monotonic() < self._valid_until
+
+    def try_acquire(self):
+        """Захватывает или продлевает аренду. Возвращает True для ведущего"""
+        started = time.monotonic()
+        now = time.time()
+        with get_db_connection() as conn:
+            conn.begin_write()
+            conn.execute("""INSERT INTO leases (name, owner, expires_at) VALUES (?, '', 0)
+                         ON CONFLICT DO NOTHING""", (self.name,))
+            acquired = conn.execute("""UPDATE leases SET owner = ?, expires_at = ?
+                                    WHERE name = ? AND (owner = ? OR expires_at < ?)""",
+                                    (self.owner, now + self.ttl, self.name, self.owner, now)).rowcount
+        if acquired:
+            self._valid_until = started + self.ttl
+        return bool(acquired)
+
+    def release(self):
+        """Отдает аренду, чтобы другой процесс стал ведущим без ожидания"""
+        if not self.enabled or not self._leader:
+            return
+        try:
+            with get_db_connection() as conn:
+                conn.execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND owner = ?",
+                             (self.name, self.owner))
+        except Exception as e:
+            logger.error(f"Ошибка освобождения аренды {self.name}: {e}")
+        self._set_leader(False)
+
+    def _set_leader(self, leader):
+        if leader == self._leader:
+            return
+        self._leader = leader
+        callback = self.on_elected if leader else self.on_demoted
+        logger.info(f"Процесс {self.owner} {'стал ведущим' if leader else 'больше не ведущий'}")
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Ошибка обработчика смены ведущего: {e}")
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._set_leader(self.try_acquire())
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды {self.name}: {e}")
+                if not self.is_leader:
+                    self._set_leader(False)
+            self._stopped.wait(self.renew_every)
+
+    def start(self):
+        if not self.enabled:
+            self._set_leader(True)
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, name=f'lease-{self.name}', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.release()
+
+
+def supervise(processes, script, restart_delay=5):
+    """Запускает processes копий script и перезапускает упавшие"""
+    env = dict(os.environ, BOT_CLUSTER='1', BOT_PROCESSES='1')
+    children = {}
+    stopping = threading.Event()
+
+    def spawn(number):
+        child = subprocess.Popen([sys.executable, script], env=dict(env, BOT_WORKER_ID=str(number)))
+        children[number] = child
+        logger.info(f"Запущен процесс бота #{number} (pid {child.pid})")
+
+    def shutdown(signum, frame):
+        stopping.set()
+        for child in children.values():
+            child.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for number in range(processes):
+        spawn(number)
+
+    while not stopping.is_set():
+        for number, child in list(children.items()):
+            if child.poll() is not None and not stopping.is_set():
+                logger.error(f"Процесс бота #{number} завершился с кодом {child.returncode}, перезапуск")
+                time.sleep(restart_delay)
+                spawn(number)
+        stopping.wait(1)
+
+    for child in children.values():
+        child.wait()
@@ -1,6 +1,9 @@
-import sqlite3
 import logging
 from datetime import datetime, timedelta
+import repository
+from storage import get_db_connection
+from migrations import migrate
+from timeutil import appointment_span
 
 # Настройка логирования
 logging.basicConfig(
@@ -10,90 +13,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger('database')
 
-def get_db_connection():
-    """Создает и возвращает соединение с БД"""
-    conn = sqlite3.connect('salon.db', timeout=10)
-    conn.execute("PRAGMA foreign_keys = ON")  # Включаем поддержку внешних ключей
-    return conn
-
 def init_db():
-    """Инициализирует структуру базы данных"""
+    """Инициализирует структуру базы данных (применяет миграции)"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Таблица мастеров
-        c.execute('''CREATE TABLE IF NOT EXISTS masters (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL UNIQUE,
-                    is_active BOOLEAN DEFAULT 1)''')
-        
-        # Таблица услуг
-        c.execute('''CREATE TABLE IF NOT EXISTS services (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL UNIQUE,
-                    duration INTEGER DEFAULT 60 CHECK(duration > 0 AND duration <= 240),
-                    price REAL CHECK(price >= 0),
-                    is_active BOOLEAN DEFAULT 1)''')
-        
-        # Таблица записей
-        c.execute('''CREATE TABLE IF NOT EXISTS appointments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_id INTEGER NOT NULL,
-                    client_name TEXT NOT NULL,
-                    phone TEXT NOT NULL,
-                    master_id INTEGER NOT NULL,
-                    service_id INTEGER NOT NULL,
-                    date TEXT NOT NULL,  -- Формат: YYYY-MM-DD
-                    time TEXT NOT NULL,  -- Формат: HH:MM
-                    status TEXT DEFAULT 'active' CHECK(status IN ('active', 'canceled', 'completed')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    reminder_sent BOOLEAN DEFAULT 0,
-                    cancel_reason TEXT DEFAULT '',
-                    FOREIGN KEY(master_id) REFERENCES masters(id) ON DELETE RESTRICT,
-                    FOREIGN KEY(service_id) REFERENCES services(id) ON DELETE RESTRICT)''')
-
-        
-        
-        # Проверяем наличие столбца reminder_sent и добавляем если нужно
-        c.execute("PRAGMA table_info(appointments)")
-        columns = [col[1] for col in c.fetchall()]
-        
-        if 'reminder_sent' not in columns:
-            c.execute("ALTER TABLE appointments ADD COLUMN reminder_sent BOOLEAN DEFAULT 0")
-            logger.info("Добавлен столбец reminder_sent")
-
-        if 'cancel_reason' not in columns:
-            c.execute("ALTER TABLE appointments ADD COLUMN cancel_reason TEXT DEFAULT ''")
-            logger.info("Добавлен столбец cancel_reason")
-        
-        # Индексы для ускорения запросов
-        c.execute("CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments(date)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_appointments_master ON appointments(master_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_appointments_status ON appointments(status)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_appointments_reminder ON appointments(reminder_sent)")
-        
-        # Добавляем мастеров только если их нет
-        default_masters = [('Анна',), ('Мария',), ('Екатерина',)]
-        c.executemany("INSERT OR IGNORE INTO masters (name) VALUES (?)", default_masters)
-        
-        # Добавляем услуги только если их нет
-        default_services = [
-            ('Маникюр', 60, 1200),
-            ('Покрытие гель-лаком', 60, 1800),
-            ('Наращивание ногтей', 90, 2500),
-            ('Дизайн ногтей', 30, 500)
-        ]
-        c.executemany("INSERT OR IGNORE INTO services (name, duration, price) VALUES (?, ?, ?)", default_services)
-        
-        conn.commit()
-        logger.info("База данных успешно инициализирована")
+        version = migrate()
+        logger.info(f"База данных успешно инициализирована (версия схемы {version})")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
         raise
-    finally:
-        conn.close()
 
 def add_test_data():
     """Добавляет тестовые данные в БД"""
@@ -103,13 +30,15 @@ def add_test_data():
         
         # Тестовые записи
         test_appointments = [
-            (123456789, 'Иван Иванов', '+79161234567', 1, 1, '2023-12-15', '10:00'),
-            (987654321, 'Мария Петрова', '+79167654321', 2, 2, '2023-12-15', '11:30'),
+            (123456789, 'Иван Иванов', '+79161234567', 1, 1, '2023-12-15', '10:00', '11:00'),
+            (987654321, 'Мария Петрова', '+79167654321', 2, 2, '2023-12-15', '11:30', '12:30'),
         ]
         
         c.executemany('''INSERT INTO appointments 
-                      (client_id, client_name, phone, master_id, service_id, date, time)
-                      VALUES (?, ?, ?, ?, ?, ?, ?)''', test_appointments)
+                      (client_id, client_name, phone, master_id, service_id, date, time, end_time,
+                       start_ts, end_ts)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      [row + appointment_span(row[5], row[6], 60) for row in test_appointments])
         
         conn.commit()
         logger.info("Тестовые данные успешно добавлены")
@@ -118,220 +47,99 @@ def add_test_data():
     finally:
         conn.close()
 
+# Функции ниже сохранены для внешних скриптов; запросы живут в repository
+
 def get_masters(only_active=True):
     """Возвращает список мастеров"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        if only_active:
-            c.execute("SELECT id, name FROM masters WHERE is_active = 1")
-        else:
-            c.execute("SELECT id, name FROM masters")
-            
-        return c.fetchall()
+        return repository.masters(only_active)
     except Exception as e:
         logger.error(f"Ошибка получения мастеров: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_services(only_active=True):
     """Возвращает список услуг"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        if only_active:
-            c.execute("SELECT id, name, duration, price FROM services WHERE is_active = 1")
-        else:
-            c.execute("SELECT id, name, duration, price FROM services")
-            
-        return c.fetchall()
+        return repository.services(only_active)
     except Exception as e:
         logger.error(f"Ошибка получения услуг: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_appointments_by_master(master_id, date, status='active'):
-    """Возвращает записи мастера на указанную дату"""
+    """Возвращает записи мастера на указанную дату (время, длительность)"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        query = """SELECT a.time, s.duration 
-                   FROM appointments a
-                   JOIN services s ON a.service_id = s.id
-                   WHERE a.master_id = ? AND a.date = ? AND a.status = ?"""
-        c.execute(query, (master_id, date, status))
-        
-        return c.fetchall()
+        return [(f"{slot.start // 60:02d}:{slot.start % 60:02d}", slot.duration)
+                for slot in repository.booked_slots(master_id, date, status)]
     except Exception as e:
         logger.error(f"Ошибка получения записей мастера: {e}")
         return []
-    finally:
-        conn.close()
 
 def add_appointment(client_id, client_name, phone, master_id, service_id, date, time):
-    """Добавляет новую запись"""
+    """Добавляет новую запись, если время мастера свободно"""
+    from booking import reserve_slot
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''INSERT INTO appointments 
-                    (client_id, client_name, phone, master_id, service_id, date, time) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (client_id, client_name, phone, master_id, service_id, date, time))
-        
-        appointment_id = c.lastrowid
-        conn.commit()
-        logger.info(f"Запись #{appointment_id} успешно добавлена")
-        return appointment_id
+        result = reserve_slot(client_id, client_name, phone, master_id, service_id, date, time)
+        if not result.ok:
+            logger.warning(f"Время {date} {time} занято записью #{result.conflict.appointment_id}")
+            return None
+        logger.info(f"Запись #{result.appointment_id} успешно добавлена")
+        return result.appointment_id
     except Exception as e:
         logger.error(f"Ошибка добавления записи: {e}")
         return None
-    finally:
-        conn.close()
 
 def update_appointment_status(appointment_id, status):
     """Обновляет статус записи"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''UPDATE appointments 
-                    SET status = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?''', 
-                (status, appointment_id))
-        
-        conn.commit()
+        repository.set_appointment_status(appointment_id, status)
         logger.info(f"Статус записи #{appointment_id} изменен на '{status}'")
         return True
     except Exception as e:
         logger.error(f"Ошибка обновления статуса записи #{appointment_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def mark_reminder_sent(appointment_id):
     """Помечает, что напоминание для записи было отправлено"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''UPDATE appointments 
-                    SET reminder_sent = 1
-                    WHERE id = ?''', 
-                (appointment_id,))
-        
-        conn.commit()
+        repository.mark_reminder_sent(appointment_id)
         logger.info(f"Напоминание для записи #{appointment_id} помечено как отправленное")
         return True
     except Exception as e:
         logger.error(f"Ошибка обновления статуса напоминания #{appointment_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_tomorrows_appointments():
-    """Возвращает активные записи на завтра"""
+    """Возвращает активные записи на завтра без отметки о напоминании"""
     try:
         tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''SELECT 
-                    a.id, a.client_id, a.client_name, a.time,
-                    m.name, s.name
-                    FROM appointments a
-                    JOIN masters m ON a.master_id = m.id
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.date = ? AND a.status = 'active' AND a.reminder_sent = 0''', 
-                (tomorrow,))
-        
-        return c.fetchall()
+        return repository.unreminded_appointments(tomorrow)
     except Exception as e:
         logger.error(f"Ошибка получения завтрашних записей: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_client_appointments(client_id, status='active'):
     """Возвращает записи клиента"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''SELECT 
-                    a.id, a.date, a.time, m.name, s.name 
-                    FROM appointments a
-                    JOIN masters m ON a.master_id = m.id
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.client_id = ? AND a.status = ?
-                    ORDER BY a.date, a.time''',
-                (client_id, status))
-        
-        return c.fetchall()
+        return repository.client_appointments(client_id, status)
     except Exception as e:
         logger.error(f"Ошибка получения записей клиента {client_id}: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_all_appointments(status=None):
     """Возвращает все записи (для администратора)"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        if status:
-            c.execute('''SELECT 
-                        a.id, a.client_name, a.phone, 
-                        m.name, s.name, a.date, a.time 
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id
-                        WHERE a.status = ?
-                        ORDER BY a.date, a.time''', (status,))
-        else:
-            c.execute('''SELECT 
-                        a.id, a.client_name, a.phone, 
-                        m.name, s.name, a.date, a.time, a.status
-                        FROM appointments a
-                        JOIN masters m ON a.master_id = m.id
-                        JOIN services s ON a.service_id = s.id
-                        ORDER BY a.date, a.time''')
-        
-        return c.fetchall()
+        return repository.list_appointments(status)
     except Exception as e:
         logger.error(f"Ошибка получения всех записей: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_appointment_details(appointment_id):
     """Возвращает детали записи по ID"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''SELECT 
-                    a.id, a.client_id, a.client_name, a.phone,
-                    a.master_id, m.name AS master_name,
-                    a.service_id, s.name AS service_name,
-                    a.date, a.time, a.status
-                    FROM appointments a
-                    JOIN masters m ON a.master_id = m.id
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.id = ?''', (appointment_id,))
-        
-        return c.fetchone()
+        return repository.appointment_details(appointment_id)
     except Exception as e:
         logger.error(f"Ошибка получения деталей записи #{appointment_id}: {e}")
         return None
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     # Инициализация БД при прямом запуске
@@ -0,0 +1,255 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from queue import LifoQueue, Empty
+
+logger = logging.getLogger('db_pool')
+
+# Настройки пула соединений
+DB_PATH = os.getenv("DB_PATH", "salon.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))                 # Максимум соединений в пуле
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", 10))              # Ожидание свободного соединения (сек)
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 10))        # Таймаут блокировки SQLite (сек)
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", 5))           # Повторы при "database is locked"
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16384))     # Кэш страниц на соединение (КБ)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 64 * 1024 * 1024))  # Размер mmap (байт)
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))   # Кэш подготовленных запросов
+
+
+def _is_busy_error(error):
+    """Проверяет, что ошибка вызвана блокировкой БД"""
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+class PoolStats:
+    """Счетчики работы пула соединений"""
+
+    __slots__ = ('checkouts', 'created', 'wait_time', 'max_wait', 'busy_retries', 'busy_failures')
+
+    def __init__(self):
+        self.checkouts = 0
+        self.created = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_retries = 0
+        self.busy_failures = 0
+
+
+class PooledCursor:
+    """Курсор с повтором запросов при блокировке БД"""
+
+    def __init__(self, pool, conn, cursor):
+        self._pool = pool
+        self._conn = conn
+        self._cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        self._pool.run_with_retry(self._conn, self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._pool.run_with_retry(self._conn, self._cursor.executemany, sql, seq_of_parameters)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    """Соединение из пула.
+
+    Поддерживает тот же интерфейс, что и sqlite3.Connection. Выход из блока
+    with фиксирует транзакцию и возвращает соединение в пул, close() только
+    возвращает соединение в пул. Во вложенных блоках with одного потока
+    (одно и то же соединение) транзакцию фиксирует только внешний блок.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def cursor(self):
+        return PooledCursor(self._pool, self._conn, self._conn.cursor())
+
+    def execute(self, sql, parameters=()):
+        return self._pool.run_with_retry(self._conn, self._conn.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._pool.run_with_retry(self._conn, self._conn.executemany, sql, seq_of_parameters)
+
+    def begin_write(self):
+        """Начинает пишущую транзакцию, сразу занимая блокировку записи"""
+        self.execute("BEGIN IMMEDIATE")
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            # Вложенный блок with того же потока не завершает транзакцию внешнего
+            if not self._released and self._pool.depth(self._conn) == 1:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite в режиме WAL.
+
+    Повторный запрос соединения в том же потоке возвращает уже выданное
+    соединение, поэтому вложенные вызовы не занимают дополнительных слотов.
+    """
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.stats = PoolStats()
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._in_use = 0
+
+    def _connect(self):
+        """Открывает новое соединение и настраивает PRAGMA"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA foreign_keys = ON")
+        with self._lock:
+            self.stats.created += 1
+        logger.info(f"Открыто новое соединение с {self.path}")
+        return conn
+
+    def acquire(self):
+        """Выдает соединение текущему потоку"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None:
+            holder[1] += 1
+            return holder[0]
+
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=DB_POOL_WAIT):
+            raise sqlite3.OperationalError("Нет свободных соединений в пуле")
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        waited = time.monotonic() - started
+
+        with self._lock:
+            self.stats.checkouts += 1
+            self.stats.wait_time += waited
+            self.stats.max_wait = max(self.stats.max_wait, waited)
+            self._in_use += 1
+
+        self._local.holder = [conn, 1]
+        return conn
+
+    def release(self, conn):
+        """Возвращает соединение в пул"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None or holder[0] is not conn:
+            return
+        holder[1] -= 1
+        if holder[1] > 0:
+            return
+
+        self._local.holder = None
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def depth(self, conn):
+        """Сколько раз соединение выдано текущему потоку (вложенность блоков with)"""
+        holder = getattr(self._local, 'holder', None)
+        return holder[1] if holder is not None and holder[0] is conn else 0
+
+    def connection(self):
+        """Возвращает соединение-обертку для использования в with"""
+        return PooledConnection(self, self.acquire())
+
+    def run_with_retry(self, conn, func, *args):
+        """Выполняет запрос, повторяя его при блокировке БД вне транзакции"""
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if not _is_busy_error(e) or conn.in_transaction or attempt >= DB_BUSY_RETRIES:
+                    if _is_busy_error(e):
+                        with self._lock:
+                            self.stats.busy_failures += 1
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.stats.busy_retries += 1
+                time.sleep(min(0.05 * 2 ** attempt, 1.0))
+
+    def get_stats(self):
+        """Возвращает снимок статистики пула"""
+        with self._lock:
+            checkouts = self.stats.checkouts
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'created': self.stats.created,
+                'checkouts': checkouts,
+                'avg_wait_ms': round(self.stats.wait_time / checkouts * 1000, 3) if checkouts else 0.0,
+                'max_wait_ms': round(self.stats.max_wait * 1000, 3),
+                'busy_retries': self.stats.busy_retries,
+                'busy_failures': self.stats.busy_failures,
+            }
+
+
+# Общий пул для bot.py и database.py
+POOL = ConnectionPool()
+
+
+def get_db_connection():
+    """Возвращает соединение из общего пула"""
+    return POOL.connection()
+
+
+def get_pool_stats():
+    """Возвращает статистику общего пула"""
+    return POOL.get_stats()
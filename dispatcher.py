@@ -0,0 +1,220 @@
+import os
+import time
+import itertools
+import threading
+import logging
+from queue import PriorityQueue
+from concurrent.futures import Future
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger('dispatcher')
+
+# Ограничения Telegram на исходящие сообщения
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", 4))              # Потоков отправки
+DISPATCH_GLOBAL_RATE = float(os.getenv("DISPATCH_GLOBAL_RATE", 30))   # Сообщений в секунду на бота
+DISPATCH_CHAT_RATE = float(os.getenv("DISPATCH_CHAT_RATE", 1))        # Сообщений в секунду в один чат
+DISPATCH_CHAT_BURST = int(os.getenv("DISPATCH_CHAT_BURST", 3))        # Допустимая пачка в один чат
+DISPATCH_RESERVE = float(os.getenv("DISPATCH_RESERVE", 0.2))          # Доля лимита под ответы пользователям
+DISPATCH_RETRIES = int(os.getenv("DISPATCH_RETRIES", 3))              # Повторы при 429 и сетевых ошибках
+
+# Приоритеты: меньше - раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_REMINDER = 2
+
+
+class TokenBucket:
+    """Ограничитель частоты "ведро токенов" """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, keep=0.0):
+        """Берет токен, если после этого останется не меньше keep.
+
+        Возвращает 0, если токен взят, иначе время ожидания в секундах.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens - 1 >= keep:
+                self.tokens -= 1
+                return 0.0
+            return (1 + keep - self.tokens) / self.rate
+
+    def acquire(self, keep=0.0):
+        """Ждет и берет токен"""
+        waited = 0.0
+        while True:
+            wait = self.reserve(keep)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """Запрещает выдачу токенов на seconds секунд (ответ 429).
+
+        Паузы из одновременных ответов не складываются: действует самая длинная.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle_for(self, now):
+        """Сколько секунд ведро полно и не используется"""
+        with self.lock:
+            self._refill(now)
+            if self.tokens < self.capacity:
+                return 0.0
+            return now - self.updated
+
+
+def _retry_after(error):
+    """Пауза из ответа 429 Too Many Requests или None"""
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        parameters = error.result_json.get('parameters') or {}
+        return float(parameters.get('retry_after', 1))
+    return None
+
+
+class MessageDispatcher:
+    """Централизованная отправка сообщений с ограничением частоты.
+
+    Фоновые сообщения (уведомления админам, напоминания) ставятся в
+    очереди с приоритетом и отправляются пулом потоков. Чат закреплен за
+    одним потоком, поэтому сообщения в один чат уходят по порядку. Общий
+    лимит бота и лимит на чат реализованы ведрами токенов; фоновые
+    отправки оставляют DISPATCH_RESERVE лимита под ответы пользователям,
+    которые отправляются сразу из обработчика через reply().
+    """
+
+    def __init__(self, bot, workers=DISPATCH_WORKERS):
+        self.bot = bot
+        self.global_bucket = TokenBucket(DISPATCH_GLOBAL_RATE, DISPATCH_GLOBAL_RATE)
+        self.background_keep = DISPATCH_GLOBAL_RATE * DISPATCH_RESERVE
+        self.queues = [PriorityQueue() for _ in range(workers)]
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self._chat_buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._seq = itertools.count()
+        self._threads = []
+        self._pruned_at = time.monotonic()
+
+    def _chat_bucket(self, chat_id):
+        now = time.monotonic()
+        with self._buckets_lock:
+            # Удаляем ведра давно молчащих чатов, чтобы словарь не рос
+            if now - self._pruned_at > 60:
+                self._chat_buckets = {
+                    key: bucket for key, bucket in self._chat_buckets.items()
+                    if bucket.idle_for(now) < 60
+                }
+                self._pruned_at = now
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(DISPATCH_CHAT_RATE, DISPATCH_CHAT_BURST)
+            return bucket
+
+    def _deliver(self, chat_id, text, kwargs, keep):
+        """Отправляет сообщение с учетом лимитов и повторами при 429"""
+        chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            chat_bucket.acquire()
+            self.global_bucket.acquire(keep)
+            try:
+                message = self.bot.send_message(chat_id, text, **kwargs)
+                with self._stats_lock:
+                    self.sent += 1
+                return message
+            except ApiTelegramException as e:
+                retry_after = _retry_after(e)
+                if retry_after is None or attempt >= DISPATCH_RETRIES:
+                    raise
+                with self._stats_lock:
+                    self.throttled += 1
+                logger.warning(f"Лимит Telegram (чат {chat_id}), пауза {retry_after} сек")
+                # Ограничение Telegram действует на бота целиком: останавливаем
+                # и общий поток отправки, а не только этот чат
+                chat_bucket.pause(retry_after)
+                self.global_bucket.pause(retry_after)
+            except (ConnectionError, TimeoutError, OSError) as e:
+                if attempt >= DISPATCH_RETRIES:
+                    raise
+                logger.warning(f"Сетевая ошибка отправки в чат {chat_id}: {e}")
+                time.sleep(2 ** attempt)
+            attempt += 1
+
+    def reply(self, chat_id, text, **kwargs):
+        """Синхронно отправляет ответ пользователю с наивысшим приоритетом"""
+        try:
+            return self._deliver(chat_id, text, kwargs, keep=0.0)
+        except Exception:
+            with self._stats_lock:
+                self.failed += 1
+            raise
+
+    def send(self, chat_id, text, priority=PRIORITY_NOTIFY, on_error=None, **kwargs):
+        """Ставит сообщение в очередь фоновой отправки. Возвращает Future"""
+        self.start()
+        future = Future()
+        queue = self.queues[hash(chat_id) % len(self.queues)]
+        queue.put((priority, next(self._seq), chat_id, text, kwargs, on_error, future))
+        return future
+
+    def broadcast(self, chat_ids, text, priority=PRIORITY_NOTIFY, **kwargs):
+        """Рассылает сообщение нескольким чатам через очередь"""
+        def log_error(chat_id, error):
+            logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {error}")
+
+        return [self.send(chat_id, text, priority, on_error=log_error, **kwargs) for chat_id in chat_ids]
+
+    def _worker(self, queue):
+        while True:
+            priority, seq, chat_id, text, kwargs, on_error, future = queue.get()
+            keep = 0.0 if priority == PRIORITY_INTERACTIVE else self.background_keep
+            try:
+                future.set_result(self._deliver(chat_id, text, kwargs, keep))
+            except Exception as e:
+                with self._stats_lock:
+                    self.failed += 1
+                future.set_exception(e)
+                if on_error:
+                    try:
+                        on_error(chat_id, e)
+                    except Exception as handler_error:
+                        logger.error(f"Ошибка обработчика неудачной отправки: {handler_error}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if self._threads:
+            return
+        with self._buckets_lock:
+            if self._threads:
+                return
+            for number, queue in enumerate(self.queues):
+                thread = threading.Thread(target=self._worker, args=(queue,),
+                                          name=f'dispatcher-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                'queued': sum(queue.qsize() for queue in self.queues),
+                'sent': self.sent,
+                'failed': self.failed,
+                'throttled': self.throttled,
+            }
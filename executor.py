@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+from telebot import util
+
+logger = logging.getLogger('executor')
+
+# Режим обработки обновлений: ordered - пул с порядком по чатам,
+# pool - стандартный пул telebot, sync - обработка в потоке опроса
+BOT_EXECUTION_MODE = os.getenv("BOT_EXECUTION_MODE", "ordered")
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 8))                        # Потоков обработки
+HANDLER_SLOW_MS = float(os.getenv("HANDLER_SLOW_MS", 2000))           # Порог медленного обработчика (мс)
+LATENCY_SAMPLES = 500                                                 # Окно для перцентилей
+
+
+def chat_key(update):
+    """Чат, к которому относится обновление, или None"""
+    chat = getattr(update, 'chat', None)
+    if chat is None:
+        # CallbackQuery: чат исходного сообщения, иначе пользователь
+        message = getattr(update, 'message', None)
+        chat = getattr(message, 'chat', None) or getattr(update, 'from_user', None)
+    return getattr(chat, 'id', None)
+
+
+class ChatOrderedPool:
+    """Пул обработчиков с сохранением порядка внутри чата.
+
+    Совместим с интерфейсом util.ThreadPool из telebot и подставляется в
+    bot.worker_pool. Обновления одного чата выполняются строго по очереди,
+    разные чаты обрабатываются параллельно. У каждого чата своя очередь;
+    в общую очередь готовых попадает чат, а не задача, поэтому долгий
+    обработчик задерживает только свой чат. После каждой задачи чат
+    возвращается в конец общей очереди, чтобы активный чат не занимал
+    поток надолго.
+    """
+
+    def __init__(self, telebot, num_threads=BOT_WORKERS):
+        self.telebot = telebot
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self._chats = {}
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._busy = 0
+        self._queued = 0
+        self._processed = 0
+        self._failed = 0
+        self._slow = 0
+        self._max_queued = 0
+        self._total_wait = 0.0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'handler-{number}', daemon=True)
+            for number in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, func, *args, **kwargs):
+        """Ставит обработчик в очередь его чата"""
+        key = chat_key(args[0]) if args else None
+        if key is None:
+            # Обновления без чата не упорядочиваем
+            key = object()
+        with self._cond:
+            tasks = self._chats.get(key)
+            if tasks is None:
+                tasks = self._chats[key] = deque()
+                self._ready.append(key)
+                self._cond.notify()
+            tasks.append((time.monotonic(), func, args, kwargs))
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+
+    def _take(self):
+        """Ждет чат с задачами и забирает его первую задачу"""
+        with self._cond:
+            while self._running and not self._ready:
+                self._cond.wait(0.5)
+            if not self._running:
+                return None, None
+            key = self._ready.popleft()
+            self._queued -= 1
+            self._busy += 1
+            return key, self._chats[key].popleft()
+
+    def _release(self, key):
+        """Возвращает чат в очередь готовых или забывает его"""
+        with self._cond:
+            self._busy -= 1
+            if self._chats[key]:
+                self._ready.append(key)
+                self._cond.notify()
+            else:
+                del self._chats[key]
+
+    def _worker(self):
+        while True:
+            key, task = self._take()
+            if task is None:
+                return
+            queued_at, func, args, kwargs = task
+            started = time.monotonic()
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                self.on_exception(e)
+            finally:
+                finished = time.monotonic()
+                self._record(started - queued_at, finished - started, failed)
+                self._release(key)
+
+    def _record(self, wait, latency, failed):
+        with self._cond:
+            self._processed += 1
+            self._failed += failed
+            self._total_wait += wait
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+            self._latencies.append(latency)
+            if latency * 1000 >= HANDLER_SLOW_MS:
+                self._slow += 1
+        if latency * 1000 >= HANDLER_SLOW_MS:
+            logger.warning(f"Медленный обработчик: {latency * 1000:.0f} мс (ожидал в очереди {wait * 1000:.0f} мс)")
+
+    def on_exception(self, exception):
+        """Передает ошибку обработчику исключений бота или циклу опроса"""
+        handled = False
+        if self.telebot.exception_handler is not None:
+            handled = self.telebot.exception_handler.handle(exception)
+        if not handled:
+            logger.error(f"Ошибка в обработчике обновления: {exception}")
+            self.exception_info = exception
+            self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_info = None
+        self.exception_event.clear()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def get_stats(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            processed = self._processed or 1
+            p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+            return {
+                'workers': len(self._threads),
+                'busy': self._busy,
+                'queued': self._queued,
+                'max_queued': self._max_queued,
+                'chats': len(self._chats),
+                'processed': self._processed,
+                'failed': self._failed,
+                'slow': self._slow,
+                'avg_wait_ms': round(self._total_wait / processed * 1000, 1),
+                'avg_latency_ms': round(self._total_latency / processed * 1000, 1),
+                'p95_latency_ms': round(p95 * 1000, 1),
+                'max_latency_ms': round(self._max_latency * 1000, 1),
+            }
+
+
+def configure_execution(bot, mode=BOT_EXECUTION_MODE, workers=BOT_WORKERS):
+    """Настраивает обработку обновлений бота. Возвращает ChatOrderedPool или None"""
+    if mode == 'ordered':
+        if bot.threaded and bot.worker_pool:
+            bot.worker_pool.close()
+        bot.threaded = True
+        bot.worker_pool = ChatOrderedPool(bot, workers)
+        return bot.worker_pool
+    if mode == 'sync':
+        if bot.threaded and bot.worker_pool:
+            bot.worker_pool.close()
+        bot.threaded = False
+        return None
+    if mode != 'pool':
+        logger.warning(f"Неизвестный режим BOT_EXECUTION_MODE={mode}, используется стандартный пул")
+    if not bot.threaded:
+        bot.threaded = True
+        bot.worker_pool = util.ThreadPool(bot, num_threads=workers)
+    return None
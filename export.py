@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import tempfile
+import logging
+from queue import Queue
+from collections import namedtuple
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from telebot.apihelper import ApiTelegramException
+import repository
+from storage import get_db_connection
+from timeutil import format_date
+
+logger = logging.getLogger('export')
+
+# Настройки выгрузки в Excel
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", 1))                           # Потоков выгрузки
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 1000))                  # Строк за одну выборку из БД
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX", 8 * 1024 * 1024))         # Файл в памяти до сброса на диск (байт)
+EXPORT_MAX_WIDTH = int(os.getenv("EXPORT_MAX_WIDTH", 50))                      # Максимальная ширина колонки
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "export_cache")               # Каталог готовых файлов
+EXPORT_CACHE_MAX_MB = float(os.getenv("EXPORT_CACHE_MAX_MB", 200))             # Предел размера кэша (0 - без кэша)
+EXPORT_CACHE_MAX_AGE = int(os.getenv("EXPORT_CACHE_MAX_AGE", 7 * 24 * 3600))   # Срок хранения файла (сек)
+
+HEADERS = ("ID", "Дата", "Время", "Клиент", "Телефон", "Мастер", "Услуга", "Статус")
+
+STATUS_LABELS = {'active': 'Активна', 'canceled': 'Отменена', 'completed': 'Завершена'}
+
+# Параметры выгрузки (status=None - все статусы)
+ExportJob = namedtuple('ExportJob', 'chat_id status master_id date_from date_to')
+
+# Готовый файл в кэше: file_id - идентификатор уже загруженного в Telegram файла
+ExportEntry = namedtuple('ExportEntry', 'key path rows file_id')
+
+
+def export_row(app):
+    """Строка листа для записи"""
+    date_formatted = format_date(app.date)
+    return (app.id, date_formatted, app.time, app.client_name, app.phone,
+            app.master_name, app.service_name, STATUS_LABELS.get(app.status, app.status))
+
+
+def write_workbook(rows, output, sample_size=EXPORT_FETCH_SIZE):
+    """Пишет строки записей в output потоком. Возвращает число строк.
+
+    Книга write_only сбрасывает строки на диск по мере добавления, а
+    ширину колонок нужно задать до первой строки, поэтому она считается
+    по заголовку и первым sample_size строкам.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Расписание")
+
+    sample = []
+    for row in rows:
+        sample.append(export_row(row))
+        if len(sample) >= sample_size:
+            break
+
+    widths = [len(header) for header in HEADERS]
+    for values in sample:
+        for column, value in enumerate(values):
+            widths[column] = max(widths[column], len(str(value or '')))
+    for column, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(column)].width = min(width + 2, EXPORT_MAX_WIDTH)
+
+    bold = Font(bold=True)
+    header = []
+    for title in HEADERS:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = bold
+        header.append(cell)
+    ws.append(header)
+
+    count = 0
+    for values in sample:
+        ws.append(values)
+        count += 1
+    for row in rows:
+        ws.append(export_row(row))
+        count += 1
+
+    wb.save(output)
+    return count
+
+
+def build_export(job, output):
+    """Выгружает записи по фильтру задания в файл output. Возвращает число строк"""
+    rows = repository.stream_appointments(job.status, job.master_id, job.date_from, job.date_to,
+                                          EXPORT_FETCH_SIZE)
+    try:
+        return write_workbook(rows, output)
+    finally:
+        rows.close()
+
+
+def export_versions():
+    """Версии данных, от которых зависит файл: записи и справочники (имена мастеров и услуг)"""
+    with get_db_connection() as conn:
+        return repository.data_version('appointments', conn), repository.data_version('catalog', conn)
+
+
+class ExportCache:
+    """Готовые файлы выгрузки на диске.
+
+    Ключ - фильтр и версии данных (счетчики data_versions ведут
+    триггеры), поэтому любое изменение записей или справочников дает
+    новый ключ, а устаревшие файлы просто перестают запрашиваться и
+    удаляются по возрасту и общему размеру. Рядом с файлом хранится
+    число строк и file_id Telegram после первой отправки.
+    """
+
+    def __init__(self, directory=EXPORT_CACHE_DIR, max_mb=EXPORT_CACHE_MAX_MB, max_age=EXPORT_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, job, versions):
+        raw = '|'.join(str(part) for part in (job.status, job.master_id, job.date_from, job.date_to, *versions))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.xlsx', base + '.json'
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = f"{meta_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def get(self, key):
+        """Файл из кэша или None"""
+        path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            # Обращение продлевает жизнь файла
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return ExportEntry(key, path, meta['rows'], meta.get('file_id'))
+
+    def new_file(self):
+        """Временный файл для новой выгрузки в каталоге кэша: (файл, путь)"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        return os.fdopen(fd, 'w+b'), tmp_path
+
+    def put(self, key, tmp_path, rows):
+        """Кладет готовый временный файл в кэш под ключом key"""
+        path, meta_path = self._paths(key)
+        self._write_meta(meta_path, {'rows': rows, 'file_id': None})
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return ExportEntry(key, path, rows, None)
+
+    def set_file_id(self, entry, file_id):
+        """Запоминает file_id отправленного файла для повторной отправки без загрузки"""
+        try:
+            self._write_meta(self._paths(entry.key)[1], {'rows': entry.rows, 'file_id': file_id})
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить file_id выгрузки: {e}")
+
+    def _remove(self, path):
+        for name in (path, os.path.splitext(path)[0] + '.json'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """Удаляет файлы старше max_age и самые давние сверх max_bytes (кроме keep)"""
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        files = []
+        total = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                # Недописанные файлы прерванных выгрузок
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(path)
+            elif path == keep:
+                total += stat.st_size
+            elif name.endswith('.xlsx'):
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        for mtime, size, path in sorted(files, reverse=True):
+            if now - mtime <= self.max_age and total + size <= self.max_bytes:
+                total += size
+                continue
+            self._remove(path)
+            removed += 1
+        if removed:
+            with self._lock:
+                self.evicted += removed
+            logger.info(f"Из кэша выгрузок удалено файлов: {removed}")
+        return removed
+
+    def get_stats(self):
+        files = 0
+        size = 0
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.xlsx'):
+                    files += 1
+                    size += entry.stat().st_size
+        except OSError:
+            pass
+        with self._lock:
+            return {
+                'files': files,
+                'size_mb': round(size / 1024 / 1024, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+            }
+
+
+def export_caption(job, count):
+    """Подпись к файлу выгрузки"""
+    caption = "📊 Расписание записей"
+    filters = []
+    if job.status:
+        filters.append(STATUS_LABELS.get(job.status, job.status).lower())
+    if job.date_from or job.date_to:
+        filters.append(f"{job.date_from or '…'} — {job.date_to or '…'}")
+    if filters:
+        caption += f" ({', '.join(filters)})"
+    return f"{caption}\nЗаписей: {count}"
+
+
+class ExcelExporter:
+    """Выгрузка записей в Excel в фоновых потоках.
+
+    Обработчик только ставит задание в очередь и сразу освобождается;
+    поток выгрузки читает записи из БД пачками, пишет книгу потоком и
+    отправляет готовый файл в чат. Память не растет с числом записей.
+    Если данные с прошлой такой же выгрузки не менялись, файл берется из
+    кэша, а уже загруженный в Telegram - отправляется по file_id.
+    """
+
+    def __init__(self, bot, dispatcher, cache=None, workers=EXPORT_WORKERS):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.cache = cache if cache is not None else ExportCache()
+        self.workers = workers
+        self.queue = Queue()
+        self.exported = 0
+        self.reused = 0
+        self.failed = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, status=None, master_id=None, date_from=None, date_to=None):
+        """Отправляет файл сразу, если он уже загружен в Telegram, иначе ставит
+        выгрузку в очередь. Возвращает None (файл отправлен) или число заданий перед ней"""
+        job = ExportJob(chat_id, status, master_id, date_from, date_to)
+        try:
+            if self.cache.enabled and self._send_cached(job, self.cache.key(job, export_versions()), upload=False):
+                return None
+        except Exception as e:
+            logger.error(f"Ошибка отправки выгрузки из кэша: {e}")
+        self.start()
+        waiting = self.queue.unfinished_tasks
+        self.queue.put(job)
+        return waiting
+
+    def _send_cached(self, job, key, upload):
+        """Отправляет файл из кэша. False - файла нет или его нужно загружать, а upload=False"""
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        caption = export_caption(job, entry.rows)
+        sent = False
+        if entry.file_id:
+            try:
+                self.bot.send_document(job.chat_id, entry.file_id, caption=caption)
+                sent = True
+            except ApiTelegramException as e:
+                logger.warning(f"Telegram не принял file_id выгрузки: {e}")
+                self.cache.set_file_id(entry, None)
+        if not sent:
+            if not upload:
+                return False
+            self._upload(job, entry, caption)
+        with self._lock:
+            self.reused += 1
+        return True
+
+    def _upload(self, job, entry, caption):
+        """Загружает файл из кэша в чат и запоминает его file_id"""
+        filename = f"schedule_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        with open(entry.path, 'rb') as f:
+            message = self.bot.send_document(job.chat_id, f, caption=caption, visible_file_name=filename)
+        document = getattr(message, 'document', None)
+        if document is not None:
+            self.cache.set_file_id(entry, document.file_id)
+
+    def _build(self, job):
+        """Новая выгрузка: в кэш или (кэш выключен) в буфер в памяти"""
+        if not self.cache.enabled:
+            output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX, suffix='.xlsx')
+            try:
+                count = build_export(job, output)
+                if count:
+                    output.seek(0)
+                    filename = f"schedule_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+                    self.bot.send_document(job.chat_id, output, caption=export_caption(job, count),
+                                           visible_file_name=filename)
+                return count
+            finally:
+                output.close()
+
+        # Версии читаются до выборки: если данные изменятся во время
+        # выгрузки, файл ляжет под старым ключом и просто не будет найден
+        key = self.cache.key(job, export_versions())
+        if self._send_cached(job, key, upload=True):
+            return None
+        output, tmp_path = self.cache.new_file()
+        try:
+            with output:
+                count = build_export(job, output)
+            if not count:
+                os.remove(tmp_path)
+                return 0
+            entry = self.cache.put(key, tmp_path, count)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._upload(job, entry, export_caption(job, count))
+        return count
+
+    def _export(self, job):
+        started = time.monotonic()
+        count = self._build(job)
+        if count is None:
+            return
+        if not count:
+            self.dispatcher.send(job.chat_id, "Нет записей для экспорта")
+            return
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.exported += 1
+            self.rows += count
+            self.total_time += elapsed
+        logger.info(f"Выгрузка для чата {job.chat_id}: {count} строк за {elapsed:.1f} сек")
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._export(job)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Ошибка экспорта в Excel: {e}")
+                self.dispatcher.send(job.chat_id, "❌ Ошибка при экспорте данных")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'export-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                'queued': self.queue.qsize(),
+                'exported': self.exported,
+                'reused': self.reused,
+                'failed': self.failed,
+                'rows': self.rows,
+                'avg_sec': round(self.total_time / self.exported, 2) if self.exported else 0.0,
+            }
+        stats['cache'] = self.cache.get_stats()
+        return stats
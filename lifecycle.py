@@ -0,0 +1,108 @@
+import os
+import time
+import datetime
+import threading
+import logging
+import repository
+
+logger = logging.getLogger('lifecycle')
+
+# Жизненный цикл записей: завершение прошедших и перенос старых в архив
+LIFECYCLE_INTERVAL = float(os.getenv("LIFECYCLE_INTERVAL", 3600))      # Период обхода (сек)
+LIFECYCLE_BATCH = int(os.getenv("LIFECYCLE_BATCH", 500))               # Записей в одной транзакции
+LIFECYCLE_BATCH_PAUSE = float(os.getenv("LIFECYCLE_BATCH_PAUSE", 0.05))  # Пауза между пачками (сек)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))          # Возраст записи для архива (дней)
+
+
+class AppointmentLifecycle:
+    """Фоновое завершение прошедших записей и перенос старых в архив.
+
+    Активные записи, время окончания которых прошло, получают статус
+    'completed' и ставятся в очередь Google Sheets. Завершенные и отмененные записи старше ARCHIVE_AFTER_DAYS
+    переносятся в appointments_archive, так что в рабочей таблице остаются
+    только актуальные записи. Архив читают выгрузки и пересборка Google
+    Sheets. Обе операции идут пачками по LIFECYCLE_BATCH в коротких
+    транзакциях, поэтому бот продолжает писать в таблицу во время обхода.
+
+    В кластерном режиме работает только в ведущем процессе.
+    """
+
+    def __init__(self, tz, interval=LIFECYCLE_INTERVAL, batch_size=LIFECYCLE_BATCH,
+                 archive_after_days=ARCHIVE_AFTER_DAYS):
+        self.tz = tz
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archive_after_days = archive_after_days
+        self.completed = 0
+        self.archived = 0
+        self.last_run = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _drain(self, step):
+        """Повторяет пачки, пока step возвращает полную пачку. Возвращает сумму"""
+        total = 0
+        while not self._stopped.is_set():
+            count = step()
+            total += count
+            if count < self.batch_size:
+                break
+            time.sleep(LIFECYCLE_BATCH_PAUSE)
+        return total
+
+    def run_once(self):
+        """Один обход. Возвращает (завершено, перенесено в архив)"""
+        now = datetime.datetime.now(self.tz)
+        now_ts = int(now.timestamp())
+        completed = self._drain(lambda: repository.complete_past_appointments(now_ts, self.batch_size))
+
+        before_date = (now - datetime.timedelta(days=self.archive_after_days)).strftime('%Y-%m-%d')
+        archived_at = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        archived = self._drain(lambda: repository.archive_appointments(
+            before_date, archived_at, self.batch_size))
+
+        with self._lock:
+            self.completed += completed
+            self.archived += archived
+            self.last_run = now
+        if completed or archived:
+            logger.info(f"Записей завершено: {completed}, перенесено в архив: {archived}")
+        return completed, archived
+
+    def run(self):
+        """Основной цикл потока"""
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка обхода записей: {e}")
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, name='lifecycle', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'completed': self.completed,
+                'archived': self.archived,
+                'last_run': self.last_run.strftime('%d.%m %H:%M') if self.last_run else None,
+            }
+
+
+if __name__ == '__main__':
+    # Разовый обход без запуска бота: python lifecycle.py
+    from database import init_db
+    from timeutil import SALON_TZ
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    init_db()
+    completed, archived = AppointmentLifecycle(SALON_TZ).run_once()
+    print(f"Завершено записей: {completed}, перенесено в архив: {archived}")
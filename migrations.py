@@ -0,0 +1,391 @@
+import os
+import time
+import logging
+from collections import namedtuple
+from storage import STORAGE, ARCHIVE_INDEXES, EPOCH_INDEXES, get_db_connection, index_statements
+from timeutil import to_epoch
+
+logger = logging.getLogger('migrations')
+
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", 500))                  # Строк в одной транзакции заполнения
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", 0.05))   # Пауза между пачками (сек)
+MIGRATION_LOCK = 20250101                                                 # Ключ advisory-блокировки PostgreSQL
+
+# version - номер, до которого поднимается схема; apply - функция от
+# курсора (изменение схемы в одной транзакции) или Backfill
+Migration = namedtuple('Migration', 'version description apply')
+
+
+class Backfill:
+    """Пакетное заполнение колонки в большой таблице.
+
+    Строки выбираются по возрастанию id пачками по batch_size, каждая
+    пачка обновляется в своей короткой транзакции, между пачками делается
+    пауза. Таблица не блокируется надолго, и бот (или другие процессы)
+    продолжает писать в нее во время заполнения. select_sql получает
+    (последний id, размер пачки) и возвращает строки с id первым полем;
+    compute превращает строку в параметры update_sql или None.
+    Если процесс прервать, заполнение продолжится с начала при следующем
+    запуске: выборка берет только еще не заполненные строки.
+    """
+
+    def __init__(self, select_sql, update_sql, compute, batch_size=MIGRATION_BATCH):
+        self.select_sql = select_sql
+        self.update_sql = update_sql
+        self.compute = compute
+        self.batch_size = batch_size
+
+    def run(self):
+        """Заполняет все строки. Возвращает число обновленных"""
+        last_id = 0
+        updated = 0
+        while True:
+            with get_db_connection() as conn:
+                conn.begin_write()
+                rows = conn.execute(self.select_sql, (last_id, self.batch_size)).fetchall()
+                updates = [params for params in map(self.compute, rows) if params is not None]
+                if updates:
+                    conn.executemany(self.update_sql, updates)
+            if not rows:
+                return updated
+            last_id = rows[-1][0]
+            updated += len(updates)
+            time.sleep(MIGRATION_BATCH_PAUSE)
+
+
+def create_sqlite_tables(c):
+    """Таблицы SQLite, включая добавление колонок в базы старых версий"""
+    # Таблица мастеров
+    c.execute('''CREATE TABLE IF NOT EXISTS masters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                is_active BOOLEAN DEFAULT 1)''')
+    
+    # Таблица услуг
+    c.execute('''CREATE TABLE IF NOT EXISTS services (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                duration INTEGER DEFAULT 60 CHECK(duration > 0 AND duration <= 240),
+                price REAL CHECK(price >= 0),
+                is_active BOOLEAN DEFAULT 1)''')
+    
+    # Таблица записей
+    c.execute('''CREATE TABLE IF NOT EXISTS appointments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id INTEGER NOT NULL,
+                client_name TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                master_id INTEGER NOT NULL,
+                service_id INTEGER NOT NULL,
+                date TEXT NOT NULL,  -- Формат: YYYY-MM-DD
+                time TEXT NOT NULL,  -- Формат: HH:MM
+                end_time TEXT,       -- Формат: HH:MM, время окончания услуги
+                status TEXT DEFAULT 'active' CHECK(status IN ('active', 'canceled', 'completed')),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                reminder_sent BOOLEAN DEFAULT 0,
+                cancel_reason TEXT DEFAULT '',
+                FOREIGN KEY(master_id) REFERENCES masters(id) ON DELETE RESTRICT,
+                FOREIGN KEY(service_id) REFERENCES services(id) ON DELETE RESTRICT)''')
+
+    
+    
+    # Проверяем наличие столбца reminder_sent и добавляем если нужно
+    c.execute("PRAGMA table_info(appointments)")
+    columns = [col[1] for col in c.fetchall()]
+    
+    if 'reminder_sent' not in columns:
+        c.execute("ALTER TABLE appointments ADD COLUMN reminder_sent BOOLEAN DEFAULT 0")
+        logger.info("Добавлен столбец reminder_sent")
+
+    if 'cancel_reason' not in columns:
+        c.execute("ALTER TABLE appointments ADD COLUMN cancel_reason TEXT DEFAULT ''")
+        logger.info("Добавлен столбец cancel_reason")
+
+    if 'end_time' not in columns:
+        c.execute("ALTER TABLE appointments ADD COLUMN end_time TEXT")
+        logger.info("Добавлен столбец end_time")
+
+    # Очередь выгрузки изменений в Google Sheets
+    c.execute('''CREATE TABLE IF NOT EXISTS sheet_outbox (
+                appointment_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 1,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT DEFAULT '',
+                enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    # Отправленные напоминания (по одному флагу на тип)
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_log (
+                appointment_id INTEGER NOT NULL,
+                kind INTEGER NOT NULL,  -- За сколько часов до записи
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (appointment_id, kind))''')
+    
+    # Индекс строк листа Google Sheets и состояние синхронизации
+    c.execute('''CREATE TABLE IF NOT EXISTS sheet_rows (
+                appointment_id INTEGER PRIMARY KEY,
+                row_number INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT)''')
+    
+    # Состояния незавершенных диалогов (STATE_BACKEND=sqlite)
+    c.execute('''CREATE TABLE IF NOT EXISTS user_state (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,        -- JSON-массив полей BookingState
+                updated_at REAL NOT NULL   -- UNIX-время последнего шага
+                )''')
+    
+    # Любое изменение записи обновляет updated_at (для дельта-синхронизации)
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_touch
+                AFTER UPDATE ON appointments
+                WHEN NEW.updated_at IS OLD.updated_at
+                BEGIN
+                    UPDATE appointments SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+                    WHERE id = NEW.id;
+                END''')
+    
+    # Счетчики версий данных для инвалидации кэшей
+    c.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0)''')
+    c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('catalog', 0)")
+    c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('appointments', 0)")
+
+    for table in ('masters', 'services'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                        AFTER {event} ON {table}
+                        BEGIN
+                            UPDATE data_versions SET version = version + 1 WHERE name = 'catalog';
+                        END''')
+
+    # Изменения записей, влияющие на расписание (для кэшей других процессов)
+    for event, target in (('insert', 'INSERT'), ('update', 'UPDATE OF status, date, time, end_time, master_id'),
+                          ('delete', 'DELETE')):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_appointments_{event}_version
+                    AFTER {target} ON appointments
+                    BEGIN
+                        UPDATE data_versions SET version = version + 1 WHERE name = 'appointments';
+                    END''')
+    
+    # Аренда ведущего процесса в кластерном режиме
+    c.execute('''CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL)''')
+
+
+def create_baseline(c):
+    """Версия 1: таблицы, триггеры и начальные справочники"""
+    if STORAGE.dialect == 'postgresql':
+        STORAGE.create_schema(c)
+    else:
+        create_sqlite_tables(c)
+
+    default_masters = [('Анна',), ('Мария',), ('Екатерина',)]
+    c.executemany("INSERT INTO masters (name) VALUES (?) ON CONFLICT DO NOTHING", default_masters)
+
+    default_services = [
+        ('Маникюр', 60, 1200),
+        ('Покрытие гель-лаком', 60, 1800),
+        ('Наращивание ногтей', 90, 2500),
+        ('Дизайн ногтей', 30, 500)
+    ]
+    c.executemany("""INSERT INTO services (name, duration, price) VALUES (?, ?, ?)
+                  ON CONFLICT DO NOTHING""", default_services)
+
+
+def end_time_row(row):
+    """Время окончания и выровненное время начала для записи старой версии"""
+    app_id, time_str, duration = row
+    hours, minutes = map(int, time_str.split(':'))
+    end = hours * 60 + minutes + duration
+    return f"{hours:02d}:{minutes:02d}", f"{end // 60:02d}:{end % 60:02d}", app_id
+
+
+def create_indexes(c):
+    """Версия 3: составные индексы вместо одноколоночных"""
+    for statement in index_statements():
+        c.execute(statement)
+
+
+# Архив завершенных и отмененных записей (lifecycle.py). Колонки как в
+# appointments, id сохраняется, поэтому id записи уникален в обеих таблицах.
+# Типы общие для SQLite и PostgreSQL
+ARCHIVE_TABLE = """CREATE TABLE IF NOT EXISTS appointments_archive (
+                id INTEGER PRIMARY KEY,
+                client_id BIGINT NOT NULL,
+                client_name TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                master_id INTEGER NOT NULL,
+                service_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL,
+                end_time TEXT,
+                status TEXT NOT NULL,
+                created_at TEXT,
+                updated_at TEXT,
+                reminder_sent INTEGER DEFAULT 0,
+                cancel_reason TEXT DEFAULT '',
+                archived_at TEXT NOT NULL)"""
+
+
+def create_archive(c):
+    """Версия 4: таблица архива записей и ее индексы"""
+    c.execute(ARCHIVE_TABLE)
+    for name, target in ARCHIVE_INDEXES:
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+def add_epoch_columns(c):
+    """Версия 5: начало и конец записи в UNIX-времени.
+
+    Сравнения интервалов (пересечения, напоминания, завершение) идут по
+    целым числам вместо разбора текстовых date/time в каждой строке.
+    Заполняются отдельными миграциями, индексы создаются после заполнения.
+    Базовая схема PostgreSQL уже содержит эти колонки и ограничение
+    appointments_no_overlap; в базах, созданных раньше, ограничение по
+    колонке slot заменяется ограничением по start_ts/end_ts.
+    """
+    if STORAGE.dialect == 'sqlite':
+        for table in ('appointments', 'appointments_archive'):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN start_ts BIGINT")
+            c.execute(f"ALTER TABLE {table} ADD COLUMN end_ts BIGINT")
+        return
+
+    for table in ('appointments', 'appointments_archive'):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS start_ts BIGINT")
+        c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS end_ts BIGINT")
+    c.execute("""SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'appointments' AND column_name = 'slot'""")
+    if c.fetchone():
+        # Строки до заполнения start_ts в новом ограничении не участвуют
+        c.execute("ALTER TABLE appointments DROP CONSTRAINT IF EXISTS appointments_no_overlap")
+        c.execute("ALTER TABLE appointments DROP COLUMN slot")
+        c.execute("DROP FUNCTION IF EXISTS minute_of_day(TEXT)")
+        c.execute("""ALTER TABLE appointments ADD CONSTRAINT appointments_no_overlap
+                     EXCLUDE USING gist (master_id WITH =, int8range(start_ts, end_ts) WITH &&)
+                     WHERE (status = 'active' AND start_ts IS NOT NULL)""")
+
+
+def epoch_row(row):
+    """start_ts и end_ts записи по ее date, time и end_time"""
+    app_id, date_str, time_str, end_time = row
+    start_ts = to_epoch(date_str, time_str)
+    duration = 0
+    if end_time:
+        # Через длительность: end_time бывает '24:00' у записей до полуночи
+        start_h, start_m = map(int, time_str.split(':'))
+        end_h, end_m = map(int, end_time.split(':'))
+        duration = (end_h - start_h) * 60 + end_m - start_m
+    return start_ts, start_ts + duration * 60, app_id
+
+
+def epoch_backfill(table):
+    """Заполнение start_ts/end_ts таблицы записей"""
+    return Backfill(f"""SELECT id, date, time, end_time FROM {table}
+                        WHERE start_ts IS NULL AND id > ?
+                        ORDER BY id LIMIT ?""",
+                    f"UPDATE {table} SET start_ts = ?, end_ts = ? WHERE id = ?",
+                    epoch_row)
+
+
+def create_epoch_indexes(c):
+    """Версия 8: индексы по start_ts/end_ts вместо индекса по текстовым дате и времени"""
+    for statement in index_statements(EPOCH_INDEXES):
+        c.execute(statement)
+
+
+# Миграции по возрастанию версии. Новые шаги только добавляются в конец
+MIGRATIONS = (
+    Migration(1, "базовая схема", create_baseline),
+    Migration(2, "время окончания старых записей", Backfill(
+        """SELECT a.id, a.time, s.duration
+           FROM appointments a
+           JOIN services s ON a.service_id = s.id
+           WHERE a.end_time IS NULL AND a.id > ?
+           ORDER BY a.id LIMIT ?""",
+        "UPDATE appointments SET time = ?, end_time = ? WHERE id = ?",
+        end_time_row)),
+    Migration(3, "составные индексы", create_indexes),
+    Migration(4, "архив записей", create_archive),
+    Migration(5, "колонки start_ts/end_ts", add_epoch_columns),
+    Migration(6, "start_ts/end_ts записей", epoch_backfill('appointments')),
+    Migration(7, "start_ts/end_ts архива", epoch_backfill('appointments_archive')),
+    Migration(8, "индексы по start_ts/end_ts", create_epoch_indexes),
+)
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def schema_version(conn):
+    """Текущая версия схемы: PRAGMA user_version в SQLite, data_versions в PostgreSQL"""
+    if STORAGE.dialect == 'sqlite':
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    try:
+        row = conn.execute("SELECT version FROM data_versions WHERE name = 'schema'").fetchone()
+    except Exception:
+        # Пустая база: таблиц еще нет
+        conn.rollback()
+        return 0
+    return row[0] if row else 0
+
+
+def set_schema_version(conn, version):
+    if STORAGE.dialect == 'sqlite':
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+    else:
+        conn.execute("""INSERT INTO data_versions (name, version) VALUES ('schema', ?)
+                     ON CONFLICT(name) DO UPDATE SET version = excluded.version""", (version,))
+
+
+def lock_migrations(conn):
+    """Не дает двум процессам применять одну миграцию одновременно"""
+    conn.begin_write()
+    if STORAGE.dialect == 'postgresql':
+        conn.execute("SELECT pg_advisory_xact_lock(?)", (MIGRATION_LOCK,))
+
+
+def migrate(migrations=MIGRATIONS):
+    """Применяет недостающие миграции. Возвращает версию схемы.
+
+    Если схема актуальна, это одно чтение версии. Каждая миграция схемы
+    выполняется в своей транзакции вместе с записью новой версии, поэтому
+    прерванный запуск продолжит с той же миграции. Backfill заполняет
+    строки пачками до записи версии.
+    """
+    with get_db_connection() as conn:
+        current = schema_version(conn)
+    if current >= migrations[-1].version:
+        return current
+
+    for migration in migrations:
+        if migration.version <= current:
+            continue
+        started = time.monotonic()
+        updated = None
+        if isinstance(migration.apply, Backfill):
+            updated = migration.apply.run()
+        with get_db_connection() as conn:
+            lock_migrations(conn)
+            current = schema_version(conn)
+            if migration.version > current:
+                if updated is None:
+                    migration.apply(conn.cursor())
+                set_schema_version(conn, migration.version)
+                current = migration.version
+        logger.info(f"Миграция {migration.version} ({migration.description}) применена "
+                    f"за {time.monotonic() - started:.2f} с"
+                    + (f", заполнено строк: {updated}" if updated else ""))
+    return current
+
+
+if __name__ == '__main__':
+    # Применение миграций без запуска бота: python migrations.py
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with get_db_connection() as conn:
+        before = schema_version(conn)
+    print(f"Версия схемы: {before}, последняя: {SCHEMA_VERSION}")
+    if before < SCHEMA_VERSION:
+        print(f"Схема обновлена до версии {migrate()}")
@@ -0,0 +1,182 @@
+import os
+import time
+import heapq
+import datetime
+import threading
+import logging
+from storage import get_db_connection
+from repository import reminder_details, upcoming_appointments
+from timeutil import day_bounds, to_epoch
+
+logger = logging.getLogger('reminders')
+
+# Напоминания: тип (за сколько часов) -> смещение до начала записи в секундах
+REMINDER_OFFSETS = {12: 12 * 3600, 1: 3600}
+REMINDER_HORIZON_DAYS = int(os.getenv("REMINDER_HORIZON_DAYS", 2))     # Дней вперед в куче
+REMINDER_RELOAD = float(os.getenv("REMINDER_RELOAD", 3600))             # Перечитывание из БД (сек)
+REMINDER_RETRY = float(os.getenv("REMINDER_RETRY", 300))                # Повтор после ошибки (сек)
+REMINDER_TOLERANCE = float(os.getenv("REMINDER_TOLERANCE", 1800))       # Допустимое опоздание напоминания (сек)
+
+
+class ReminderScheduler:
+    """Планировщик напоминаний на минимальной куче сроков отправки.
+
+    В куче лежат (срок, id записи, тип, начало записи) для записей на
+    ближайшие REMINDER_HORIZON_DAYS дней. Поток спит до ближайшего срока,
+    новые записи и отмены обновляют кучу сразу. Факт отправки каждого типа
+    напоминания хранится в reminder_log, поэтому после перезапуска
+    напоминания не дублируются.
+
+    В кластерном режиме планировщик работает только в ведущем процессе,
+    а записи, созданные другими процессами, он замечает по счетчику
+    data_versions('appointments') (watch) и перечитывает кучу.
+    """
+
+    def __init__(self, send, tz, watch=None):
+        self.send = send
+        self.tz = tz
+        self.watch = watch
+        self._stopped = threading.Event()
+        self._heap = []
+        self._starts = {}
+        self._cond = threading.Condition()
+        self._reload_at = 0.0
+        self._thread = None
+
+    def _expires_at(self, kind, start):
+        """Момент, после которого напоминание теряет смысл.
+
+        Текст напоминания называет срок ("через 12 часов", "через 1 час"),
+        поэтому опоздавшее больше чем на REMINDER_TOLERANCE (запись сделана
+        позже срока, простой бота, повторы после ошибок) не отправляется.
+        """
+        return start - REMINDER_OFFSETS[kind] + REMINDER_TOLERANCE
+
+    def _push(self, appointment_id, start):
+        """Кладет в кучу напоминания записи. Вызывать под self._cond"""
+        self._starts[appointment_id] = start
+        for kind, offset in REMINDER_OFFSETS.items():
+            heapq.heappush(self._heap, (start - offset, appointment_id, kind, start))
+
+    def load(self):
+        """Перечитывает активные записи на горизонт планирования"""
+        now = time.time()
+        last_day = datetime.datetime.now(self.tz).date() + datetime.timedelta(days=REMINDER_HORIZON_DAYS)
+        # Начало записи уже хранится в start_ts: отбор и сравнение - по целым числам
+        rows = upcoming_appointments(int(now) + 1, day_bounds(last_day.isoformat(), self.tz)[1])
+
+        with self._cond:
+            self._heap = []
+            self._starts = {}
+            for appointment_id, start in rows:
+                self._push(appointment_id, start)
+            self._reload_at = now + REMINDER_RELOAD
+            self._cond.notify()
+        logger.info(f"Планировщик напоминаний: загружено {len(self._starts)} записей")
+
+    def running(self):
+        """Работает ли поток планировщика (в кластере - только у ведущего)"""
+        return not self._stopped.is_set() and self._thread is not None and self._thread.is_alive()
+
+    def schedule(self, appointment_id, date_str, time_str):
+        """Добавляет напоминания для новой записи.
+
+        Без работающего потока запись не запоминается: куча все равно
+        перечитывается при запуске, а записи других процессов ведущий
+        замечает сам.
+        """
+        if not self.running():
+            return
+        start = to_epoch(date_str, time_str, self.tz)
+        horizon = time.time() + REMINDER_HORIZON_DAYS * 86400
+        if start > horizon:
+            return
+        with self._cond:
+            self._push(appointment_id, start)
+            self._cond.notify()
+
+    def cancel(self, appointment_id):
+        """Снимает напоминания отмененной записи"""
+        with self._cond:
+            self._starts.pop(int(appointment_id), None)
+
+    def _next_due(self):
+        """Ждет и возвращает ближайшее актуальное напоминание.
+
+        None - пора перечитать записи, False - пора проверить чужие изменения
+        или планировщик остановлен.
+        """
+        with self._cond:
+            while not self._stopped.is_set():
+                now = time.time()
+                if now >= self._reload_at:
+                    return None
+                while self._heap and self._starts.get(self._heap[0][1]) != self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)
+                wake_at = min(self._heap[0][0], self._reload_at) if self._heap else self._reload_at
+                if self.watch is not None and now + self.watch.interval < wake_at:
+                    self._cond.wait(self.watch.interval)
+                    return False
+                self._cond.wait(wake_at - now)
+            return False
+
+    def _fire(self, appointment_id, kind, start):
+        """Отправляет напоминание, если оно еще актуально и не отправлялось"""
+        if time.time() >= self._expires_at(kind, start):
+            return
+
+        with get_db_connection() as conn:
+            claimed = conn.execute("""INSERT INTO reminder_log (appointment_id, kind) VALUES (?, ?)
+                                   ON CONFLICT DO NOTHING""", (appointment_id, kind)).rowcount
+            details = reminder_details(appointment_id, conn) if claimed else None
+        if not details:
+            return
+
+        try:
+            self.send(details, kind)
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминания за {kind} ч. по записи #{appointment_id}: {e}")
+            self.retry(appointment_id, kind)
+
+    def retry(self, appointment_id, kind):
+        """Снимает отметку об отправке и повторяет напоминание через REMINDER_RETRY"""
+        with get_db_connection() as conn:
+            conn.execute("DELETE FROM reminder_log WHERE appointment_id = ? AND kind = ?",
+                         (appointment_id, kind))
+        retry_at = time.time() + REMINDER_RETRY
+        with self._cond:
+            start = self._starts.get(appointment_id)
+            if start is not None and retry_at < self._expires_at(kind, start):
+                heapq.heappush(self._heap, (retry_at, appointment_id, kind, start))
+                self._cond.notify()
+
+    def run(self):
+        """Основной цикл потока напоминаний"""
+        while not self._stopped.is_set():
+            try:
+                item = self._next_due()
+                if item is None or (item is False and self.watch is not None and self.watch.changed()):
+                    self.load()
+                    continue
+                if item is False:
+                    continue
+                due, appointment_id, kind, start = item
+                self._fire(appointment_id, kind, start)
+            except Exception as e:
+                logger.error(f"Ошибка в потоке напоминаний: {e}")
+                time.sleep(60)
+
+    def start(self):
+        with self._cond:
+            self._stopped.clear()
+            self._reload_at = 0.0
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name='reminders', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped.set()
+            self._cond.notify()
@@ -0,0 +1,564 @@
+import os
+import time
+import threading
+import logging
+import itertools
+from collections import namedtuple
+from storage import STORAGE, get_db_connection
+from timeutil import day_bounds
+
+logger = logging.getLogger('repository')
+
+REPO_SLOW_MS = float(os.getenv("REPO_SLOW_MS", 100))          # Порог медленного запроса для лога (мс)
+REPO_STREAM_BATCH = int(os.getenv("REPO_STREAM_BATCH", 1000))  # Строк за одну выборку при потоковом чтении
+
+# Наибольшая длительность услуги (CHECK в таблице services), мин. Ограничивает
+# снизу поиск пересечений по start_ts
+MAX_SERVICE_MINUTES = 240
+
+# Строки результатов. namedtuple не хранит __dict__ и распаковывается как кортеж
+MasterRow = namedtuple('MasterRow', 'id name')
+ServiceRow = namedtuple('ServiceRow', 'id name duration price')
+BookedSlot = namedtuple('BookedSlot', 'id start duration')  # start - минута от начала суток
+AppointmentRow = namedtuple('AppointmentRow', 'id client_name phone master_name service_name date time status')
+ClientAppointment = namedtuple('ClientAppointment', 'id date time master_name service_name')
+AppointmentDetails = namedtuple('AppointmentDetails', 'id client_id client_name phone master_id master_name '
+                                                      'service_id service_name date time end_time status')
+Conflict = namedtuple('Conflict', 'appointment_id time end_time')
+UpcomingAppointment = namedtuple('UpcomingAppointment', 'id start_ts')
+AppointmentPage = namedtuple('AppointmentPage', 'rows has_prev has_next')
+ReminderDetails = namedtuple('ReminderDetails', 'id client_id client_name date time master_name service_name')
+
+# Общее соединение записей с мастерами и услугами
+APPOINTMENT_JOIN = """FROM appointments a
+                   JOIN masters m ON a.master_id = m.id
+                   JOIN services s ON a.service_id = s.id"""
+
+# То же для архива (lifecycle.py): отчеты и выгрузки читают обе таблицы
+ARCHIVE_JOIN = """FROM appointments_archive a
+               JOIN masters m ON a.master_id = m.id
+               JOIN services s ON a.service_id = s.id"""
+
+
+class QueryStats:
+    """Число вызовов и время выполнения по каждому запросу"""
+
+    def __init__(self, slow_ms=REPO_SLOW_MS):
+        self.slow_ms = slow_ms
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        if elapsed * 1000 >= self.slow_ms:
+            logger.warning(f"Медленный запрос {name}: {elapsed * 1000:.1f} мс")
+
+    def get_stats(self):
+        """Статистика запросов, самые затратные первыми"""
+        with self._lock:
+            stats = [
+                {
+                    'name': name,
+                    'calls': calls,
+                    'total_ms': round(total * 1000, 3),
+                    'avg_ms': round(total / calls * 1000, 3),
+                    'max_ms': round(longest * 1000, 3),
+                }
+                for name, (calls, total, longest) in self._timings.items()
+            ]
+        return sorted(stats, key=lambda item: item['total_ms'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+
+
+QUERY_STATS = QueryStats()
+
+
+class Query:
+    """Именованный запрос репозитория.
+
+    Текст запроса собирается один раз при импорте и не меняется между
+    вызовами, поэтому кэш подготовленных запросов SQLite и PREPARE в
+    PostgreSQL срабатывают на каждом вызове. Каждый вызов (вместе с
+    чтением строк) учитывается в QUERY_STATS.
+    """
+
+    __slots__ = ('name', 'sql', 'row')
+
+    def __init__(self, name, sql, row=None):
+        self.name = name
+        self.sql = sql
+        self.row = row
+
+    def _run(self, conn, parameters, fetch):
+        started = time.perf_counter()
+        try:
+            cursor = conn.execute(self.sql, parameters)
+            return fetch(cursor)
+        finally:
+            QUERY_STATS.record(self.name, time.perf_counter() - started)
+
+    def all(self, parameters=(), conn=None):
+        """Все строки результата"""
+        if conn is None:
+            with get_db_connection() as conn:
+                return self.all(parameters, conn)
+        make = self.row._make if self.row else tuple
+        return self._run(conn, parameters, lambda cursor: [make(row) for row in cursor.fetchall()])
+
+    def one(self, parameters=(), conn=None):
+        """Первая строка результата или None"""
+        if conn is None:
+            with get_db_connection() as conn:
+                return self.one(parameters, conn)
+        row = self._run(conn, parameters, lambda cursor: cursor.fetchone())
+        if row is None or self.row is None:
+            return row
+        return self.row._make(row)
+
+    def scalar(self, parameters=(), conn=None, default=None):
+        """Первое значение первой строки"""
+        row = self.one(parameters, conn)
+        return row[0] if row else default
+
+    def stream(self, parameters=(), batch_size=REPO_STREAM_BATCH, conn=None):
+        """Строки результата по мере чтения, пачками по batch_size.
+
+        В памяти одновременно не больше одной пачки. В QUERY_STATS
+        учитывается только время выборки, без обработки строк вызывающим.
+        """
+        if conn is None:
+            with get_db_connection() as conn:
+                yield from self.stream(parameters, batch_size, conn)
+            return
+        make = self.row._make if self.row else tuple
+        batches = STORAGE.stream(conn, self.sql, parameters, batch_size)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                rows = next(batches, None)
+                elapsed += time.perf_counter() - started
+                if rows is None:
+                    return
+                for row in rows:
+                    yield make(row)
+        finally:
+            batches.close()
+            QUERY_STATS.record(self.name, elapsed)
+
+    def run(self, parameters=(), conn=None):
+        """Выполняет изменяющий запрос, возвращает число затронутых строк"""
+        if conn is None:
+            with get_db_connection() as conn:
+                return self.run(parameters, conn)
+        return self._run(conn, parameters, lambda cursor: cursor.rowcount)
+
+    def run_many(self, seq_of_parameters, conn):
+        """Выполняет изменяющий запрос для каждого набора параметров"""
+        started = time.perf_counter()
+        try:
+            conn.executemany(self.sql, seq_of_parameters)
+        finally:
+            QUERY_STATS.record(self.name, time.perf_counter() - started)
+
+
+DATA_VERSION = Query('data_version', "SELECT version FROM data_versions WHERE name = ?")
+
+ACTIVE_MASTERS = Query('active_masters', "SELECT id, name FROM masters WHERE is_active = 1 ORDER BY id",
+                       MasterRow)
+ALL_MASTERS = Query('all_masters', "SELECT id, name FROM masters ORDER BY id", MasterRow)
+ACTIVE_SERVICES = Query('active_services', """SELECT id, name, duration, price FROM services
+                                           WHERE is_active = 1 ORDER BY id""", ServiceRow)
+ALL_SERVICES = Query('all_services', "SELECT id, name, duration, price FROM services ORDER BY id", ServiceRow)
+
+SERVICE_DURATION = Query('service_duration', "SELECT duration FROM services WHERE id = ?")
+# Пересечение [start_ts, end_ts) с новой записью. Нижняя граница по start_ts
+# (не раньше начала минус самая длинная услуга) ограничивает просмотр индекса
+FIND_CONFLICT = Query('find_conflict', """SELECT id, time, end_time FROM appointments
+                                       WHERE master_id = ? AND status = 'active'
+                                       AND start_ts > ? AND start_ts < ? AND end_ts > ?
+                                       ORDER BY start_ts LIMIT 1""", Conflict)
+
+# Длительность берется из самой записи (end_ts - start_ts), как ее
+# рассчитали при бронировании, поэтому соединение с услугами не нужно
+BOOKED_SLOTS = Query('booked_slots', """SELECT id, start_ts, end_ts FROM appointments
+                                     WHERE master_id = ? AND status = ?
+                                     AND start_ts >= ? AND start_ts < ?""")
+
+APPOINTMENT_COLUMNS = "a.id, a.client_name, a.phone, m.name, s.name, a.date, a.time, a.status"
+ALL_APPOINTMENTS = Query('all_appointments', f"""SELECT {APPOINTMENT_COLUMNS} {APPOINTMENT_JOIN}
+                                              ORDER BY a.date, a.time""", AppointmentRow)
+APPOINTMENTS_BY_STATUS = Query('appointments_by_status', f"""SELECT {APPOINTMENT_COLUMNS} {APPOINTMENT_JOIN}
+                                                          WHERE a.status = ?
+                                                          ORDER BY a.date, a.time""", AppointmentRow)
+
+
+def _page_query(by_status, by_master, backward):
+    """Запрос страницы записей по ключу (date, time, id) для набора фильтров"""
+    conditions = ["a.date BETWEEN ? AND ?"]
+    if by_status:
+        conditions.append("a.status = ?")
+    if by_master:
+        conditions.append("a.master_id = ?")
+    conditions.append(f"(a.date, a.time, a.id) {'<' if backward else '>'} (?, ?, ?)")
+    order = " DESC" if backward else ""
+    name = "appointments_page" + "_status" * by_status + "_master" * by_master + "_back" * backward
+    return Query(name, f"""SELECT {APPOINTMENT_COLUMNS} {APPOINTMENT_JOIN}
+                        WHERE {' AND '.join(conditions)}
+                        ORDER BY a.date{order}, a.time{order}, a.id{order} LIMIT ?""", AppointmentRow)
+
+
+# Все сочетания фильтров собираются заранее: текст запроса не зависит от значений
+PAGE_QUERIES = {key: _page_query(*key) for key in itertools.product((False, True), repeat=3)}
+
+
+
+def _export_query(by_status, by_master):
+    """Запрос выгрузки записей за период в порядке расписания.
+
+    Читает рабочую таблицу и архив; обе части идут по своим индексам в
+    нужном порядке и сливаются без общей сортировки (MERGE UNION ALL в
+    SQLite, Merge Append в PostgreSQL). Параметры фильтра передаются
+    дважды - для каждой части.
+    """
+    conditions = ["a.date BETWEEN ? AND ?"]
+    if by_status:
+        conditions.append("a.status = ?")
+    if by_master:
+        conditions.append("a.master_id = ?")
+    where = ' AND '.join(conditions)
+    name = "export_appointments" + "_status" * by_status + "_master" * by_master
+    return Query(name, f"""SELECT {APPOINTMENT_COLUMNS} {APPOINTMENT_JOIN} WHERE {where}
+                        UNION ALL
+                        SELECT {APPOINTMENT_COLUMNS} {ARCHIVE_JOIN} WHERE {where}
+                        ORDER BY 6, 7, 1""", AppointmentRow)
+
+
+EXPORT_QUERIES = {key: _export_query(*key) for key in itertools.product((False, True), repeat=2)}
+
+CLIENT_APPOINTMENTS = Query('client_appointments', f"""SELECT a.id, a.date, a.time, m.name, s.name
+                                                    {APPOINTMENT_JOIN}
+                                                    WHERE a.client_id = ? AND a.status = ?
+                                                    ORDER BY a.date, a.time""", ClientAppointment)
+APPOINTMENT_DETAILS = Query('appointment_details', f"""SELECT
+                                                    a.id, a.client_id, a.client_name, a.phone,
+                                                    a.master_id, m.name, a.service_id, s.name,
+                                                    a.date, a.time, a.end_time, a.status
+                                                    {APPOINTMENT_JOIN}
+                                                    WHERE a.id = ?""", AppointmentDetails)
+UPCOMING_APPOINTMENTS = Query('upcoming_appointments', """SELECT id, start_ts FROM appointments
+                                                      WHERE status = 'active'
+                                                      AND start_ts >= ? AND start_ts < ?""",
+                              UpcomingAppointment)
+REMINDER_DETAILS = Query('reminder_details', f"""SELECT
+                                              a.id, a.client_id, a.client_name, a.date, a.time,
+                                              m.name, s.name
+                                              {APPOINTMENT_JOIN}
+                                              WHERE a.id = ? AND a.status = 'active'""", ReminderDetails)
+CANCEL_APPOINTMENT = Query('cancel_appointment', """UPDATE appointments
+                                                 SET status = 'canceled', cancel_reason = ?
+                                                 WHERE id = ? AND status = 'active'""")
+SET_APPOINTMENT_STATUS = Query('set_appointment_status', "UPDATE appointments SET status = ? WHERE id = ?")
+
+# Флаг reminder_sent остался от напоминаний до reminder_log
+UNREMINDED_APPOINTMENTS = Query('unreminded_appointments', f"""SELECT
+                                                            a.id, a.client_id, a.client_name, a.time,
+                                                            m.name, s.name
+                                                            {APPOINTMENT_JOIN}
+                                                            WHERE a.date = ? AND a.status = 'active'
+                                                            AND a.reminder_sent = 0""")
+MARK_REMINDER_SENT = Query('mark_reminder_sent', "UPDATE appointments SET reminder_sent = 1 WHERE id = ?")
+
+# Жизненный цикл записей (lifecycle.py)
+COMPLETE_CANDIDATES = Query('complete_candidates', """SELECT id FROM appointments
+                                                   WHERE status = 'active' AND start_ts < ? AND end_ts <= ?
+                                                   LIMIT ?""")
+COMPLETE_APPOINTMENT = Query('complete_appointment', """UPDATE appointments SET status = 'completed'
+                                                     WHERE id = ? AND status = 'active'""")
+# Постановка записи в очередь выгрузки Google Sheets (sheets.SheetSyncWorker)
+SHEET_ENQUEUE = Query('sheet_enqueue', """INSERT INTO sheet_outbox (appointment_id) VALUES (?)
+                                       ON CONFLICT(appointment_id) DO UPDATE SET
+                                          version = sheet_outbox.version + 1,
+                                          attempts = 0,
+                                          next_attempt_at = 0""")
+# В архив попадают только записи, уже выгруженные в Google Sheets: их нет
+# в очереди, и дельта-синхронизация прошла их updated_at (граница sheet_hwm)
+ARCHIVE_CANDIDATES = Query('archive_candidates', """SELECT a.id FROM appointments a
+                                                 WHERE a.status IN ('completed', 'canceled') AND a.date < ?
+                                                 AND a.updated_at <= (SELECT value FROM sync_state
+                                                                      WHERE key = 'sheet_hwm')
+                                                 AND NOT EXISTS (SELECT 1 FROM sheet_outbox o
+                                                                 WHERE o.appointment_id = a.id)
+                                                 LIMIT ?""")
+ARCHIVE_COLUMNS = ("id, client_id, client_name, phone, master_id, service_id, date, time, end_time, "
+                   "start_ts, end_ts, status, created_at, updated_at, reminder_sent, cancel_reason")
+ARCHIVE_COPY = Query('archive_copy', f"""INSERT INTO appointments_archive ({ARCHIVE_COLUMNS}, archived_at)
+                                     SELECT {ARCHIVE_COLUMNS}, ? FROM appointments WHERE id = ?
+                                     ON CONFLICT (id) DO NOTHING""")
+ARCHIVE_FORGET_REMINDERS = Query('archive_forget_reminders', "DELETE FROM reminder_log WHERE appointment_id = ?")
+ARCHIVE_DELETE = Query('archive_delete', "DELETE FROM appointments WHERE id = ?")
+
+
+def data_version(name, conn=None):
+    """Текущее значение счетчика data_versions"""
+    return DATA_VERSION.scalar((name,), conn, default=0)
+
+
+def masters(only_active=True, conn=None):
+    """Мастера по порядку id"""
+    return (ACTIVE_MASTERS if only_active else ALL_MASTERS).all(conn=conn)
+
+
+def services(only_active=True, conn=None):
+    """Услуги по порядку id"""
+    return (ACTIVE_SERVICES if only_active else ALL_SERVICES).all(conn=conn)
+
+
+def booked_slots(master_id, date, status='active'):
+    """Записи мастера на дату: начало (минута суток) и длительность в минутах"""
+    day_start, day_end = day_bounds(date)
+    return [BookedSlot(app_id, (start_ts - day_start) // 60, (end_ts - start_ts) // 60)
+            for app_id, start_ts, end_ts in BOOKED_SLOTS.all((master_id, status, day_start, day_end))]
+
+
+def find_conflict(master_id, start_ts, end_ts, conn=None):
+    """Первая активная запись мастера, пересекающаяся с [start_ts, end_ts), или None"""
+    return FIND_CONFLICT.one((master_id, start_ts - MAX_SERVICE_MINUTES * 60, end_ts, start_ts), conn)
+
+
+def list_appointments(status=None):
+    """Записи с именами мастера и услуги, по дате и времени. status=None - все"""
+    if status is None:
+        return ALL_APPOINTMENTS.all()
+    return APPOINTMENTS_BY_STATUS.all((status,))
+
+
+def appointments_page(status=None, master_id=None, date_from=None, date_to=None,
+                      after=None, before=None, limit=20):
+    """Страница записей, упорядоченных по (date, time, id).
+
+    after - ключ (date, time, id) последней строки предыдущей страницы
+    (листание вперед), before - ключ первой строки текущей (назад), без
+    ключа - первая страница. Каждая страница - один запрос с LIMIT по
+    индексу, независимо от того, сколько записей до нее.
+    """
+    backward = before is not None
+    period = (date_from, date_to)
+    date_from, date_to = date_from or '0000-01-01', date_to or '9999-12-31'
+    # SQLite начинает поиск по индексу с одной границы по date: подтягиваем ее
+    # к ключу, иначе каждая следующая страница перебирает все предыдущие
+    if backward:
+        date_to = min(date_to, before[0])
+    elif after is not None:
+        date_from = max(date_from, after[0])
+    parameters = [date_from, date_to]
+    if status:
+        parameters.append(status)
+    if master_id:
+        parameters.append(master_id)
+    parameters.extend(before if backward else after or ('', '', 0))
+    parameters.append(limit + 1)
+    rows = PAGE_QUERIES[(bool(status), bool(master_id), backward)].all(tuple(parameters))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not backward:
+        return AppointmentPage(rows, after is not None, more)
+    if not more:
+        # До начала осталось меньше страницы: показываем первую страницу целиком
+        return appointments_page(status, master_id, *period, limit=limit)
+    rows.reverse()
+    return AppointmentPage(rows, True, True)
+
+
+def stream_appointments(status=None, master_id=None, date_from=None, date_to=None,
+                        batch_size=REPO_STREAM_BATCH):
+    """Записи за период в порядке расписания, по мере чтения из БД"""
+    parameters = [date_from or '0000-01-01', date_to or '9999-12-31']
+    if status:
+        parameters.append(status)
+    if master_id:
+        parameters.append(master_id)
+    query = EXPORT_QUERIES[(bool(status), bool(master_id))]
+    return query.stream(tuple(parameters) * 2, batch_size)
+
+
+def client_appointments(client_id, status='active'):
+    """Записи клиента по дате и времени"""
+    return CLIENT_APPOINTMENTS.all((client_id, status))
+
+
+def appointment_details(appointment_id, conn=None):
+    """Полные данные записи или None"""
+    return APPOINTMENT_DETAILS.one((appointment_id,), conn)
+
+
+def upcoming_appointments(first_ts, last_ts):
+    """Активные записи, начинающиеся в [first_ts, last_ts)"""
+    return UPCOMING_APPOINTMENTS.all((first_ts, last_ts))
+
+
+def reminder_details(appointment_id, conn=None):
+    """Данные активной записи для текста напоминания или None"""
+    return REMINDER_DETAILS.one((appointment_id,), conn)
+
+
+def cancel_appointment(appointment_id, reason='', client_id=None):
+    """Отменяет активную запись.
+
+    С client_id отменяет только запись этого клиента. Возвращает данные
+    записи до отмены или None, если активной записи нет.
+    """
+    with get_db_connection() as conn:
+        conn.begin_write()
+        details = appointment_details(appointment_id, conn)
+        if details is None or details.status != 'active':
+            return None
+        if client_id is not None and details.client_id != client_id:
+            return None
+        if not CANCEL_APPOINTMENT.run((reason, appointment_id), conn):
+            return None
+    return details
+
+
+def set_appointment_status(appointment_id, status):
+    """Меняет статус записи. Возвращает True, если запись найдена"""
+    return SET_APPOINTMENT_STATUS.run((status, appointment_id)) > 0
+
+
+def unreminded_appointments(date):
+    """Активные записи на дату без флага reminder_sent"""
+    return UNREMINDED_APPOINTMENTS.all((date,))
+
+
+def mark_reminder_sent(appointment_id):
+    return MARK_REMINDER_SENT.run((appointment_id,)) > 0
+
+
+def complete_past_appointments(now_ts, limit):
+    """Переводит в 'completed' до limit активных записей, закончившихся к now_ts.
+
+    В той же транзакции записи ставятся в очередь Google Sheets, чтобы
+    новый статус попал в таблицу до переноса записи в архив. Возвращает
+    число завершенных записей.
+    """
+    with get_db_connection() as conn:
+        conn.begin_write()
+        ids = [(row[0],) for row in COMPLETE_CANDIDATES.all((now_ts, now_ts, limit), conn)]
+        if ids:
+            COMPLETE_APPOINTMENT.run_many(ids, conn)
+            SHEET_ENQUEUE.run_many(ids, conn)
+        return len(ids)
+
+
+def archive_appointments(before_date, archived_at, limit):
+    """Переносит до limit завершенных и отмененных записей до before_date в архив.
+
+    Копирование и удаление идут в одной пишущей транзакции. Записи, еще
+    не выгруженные в Google Sheets (есть в sheet_outbox или изменены после
+    прошлой дельта-синхронизации), остаются до выгрузки, чтобы в таблицу
+    попал их итоговый статус.
+    """
+    with get_db_connection() as conn:
+        conn.begin_write()
+        ids = [(row[0],) for row in ARCHIVE_CANDIDATES.all((before_date, limit), conn)]
+        if ids:
+            ARCHIVE_COPY.run_many([(archived_at, app_id) for app_id, in ids], conn)
+            ARCHIVE_FORGET_REMINDERS.run_many(ids, conn)
+            ARCHIVE_DELETE.run_many(ids, conn)
+        return len(ids)
+
+
+def get_stats():
+    """Статистика времени выполнения запросов"""
+    return QUERY_STATS.get_stats()
+
+
+# Горячие запросы: примерные параметры и индекс, на который рассчитан
+# запрос. В плане не должно быть полного просмотра таблицы (SCAN),
+# сортировки во временном B-дереве и выборки мимо ожидаемого индекса
+HOT_QUERIES = (
+    (FIND_CONFLICT, (1, 1893470400, 1893488400, 1893484800), 'idx_appointments_master_start'),
+    (BOOKED_SLOTS, (1, 'active', 1893438000, 1893524400), 'idx_appointments_master_start'),
+    (CLIENT_APPOINTMENTS, (1, 'active'), 'idx_appointments_client'),
+    (UPCOMING_APPOINTMENTS, (1893438000, 1893610800), 'idx_appointments_start'),
+    (APPOINTMENTS_BY_STATUS, ('active',), 'idx_appointments_upcoming'),
+    (PAGE_QUERIES[(False, False, False)], ('2030-01-01', '2030-02-01', '2030-01-01', '10:00', 1, 11),
+     'idx_appointments_schedule'),
+    (PAGE_QUERIES[(True, False, True)], ('2030-01-01', '2030-02-01', 'active', '2030-02-01', '10:00', 1, 11),
+     'idx_appointments_upcoming'),
+    (APPOINTMENT_DETAILS, (1,), 'INTEGER PRIMARY KEY'),
+    (REMINDER_DETAILS, (1,), 'INTEGER PRIMARY KEY'),
+    (EXPORT_QUERIES[(False, False)], ('2030-01-01', '2030-02-01') * 2, 'idx_appointments_schedule'),
+    (EXPORT_QUERIES[(True, False)], ('2030-01-01', '2030-02-01', 'active') * 2, 'idx_appointments_upcoming'),
+    (COMPLETE_CANDIDATES, (1893484800, 1893484800, 500), 'idx_appointments_start'),
+    (ARCHIVE_CANDIDATES, ('2030-01-01', 500), 'idx_appointments_upcoming'),
+)
+
+
+def explain(query, parameters=(), conn=None):
+    """План выполнения запроса SQLite (EXPLAIN QUERY PLAN)"""
+    if conn is None:
+        with get_db_connection() as conn:
+            return explain(query, parameters, conn)
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query.sql}", parameters).fetchall()]
+
+
+def plan_problems(plan, index):
+    """Шаги плана с полным просмотром или временной сортировкой.
+
+    Первая выборка (из appointments) должна идти по индексу index.
+    Служебные шаги составных запросов (MERGE, LEFT, RIGHT) пропускаются.
+    """
+    problems = [step for step in plan if step.startswith('SCAN ') or 'TEMP B-TREE' in step]
+    lookups = [step for step in plan if step.startswith(('SEARCH ', 'SCAN '))]
+    if lookups and index not in lookups[0] and lookups[0] not in problems:
+        problems.append(lookups[0])
+    return problems
+
+
+def check_plans(queries=HOT_QUERIES):
+    """Проверяет планы запросов. Возвращает [(запрос, план, проблемы)]"""
+    with get_db_connection() as conn:
+        return [(query, plan, plan_problems(plan, index))
+                for query, parameters, index in queries
+                for plan in [explain(query, parameters, conn)]]
+
+
+if __name__ == '__main__':
+    # Проверка планов горячих запросов: python repository.py --explain
+    # База не изменяется: схема должна быть уже обновлена (python migrations.py)
+    import sys
+    from migrations import SCHEMA_VERSION, schema_version
+
+    if sys.argv[1:] != ['--explain']:
+        print("Использование: python repository.py --explain")
+        sys.exit(1)
+    if STORAGE.dialect != 'sqlite':
+        print("Проверка планов поддерживается только для SQLite")
+        sys.exit(1)
+    if not os.path.exists(STORAGE.pool.path):
+        print(f"База {STORAGE.pool.path} не найдена")
+        sys.exit(1)
+    with get_db_connection() as conn:
+        version = schema_version(conn)
+    if version != SCHEMA_VERSION:
+        print(f"Версия схемы {version}, ожидается {SCHEMA_VERSION}: сначала выполните python migrations.py")
+        sys.exit(1)
+
+    failed = 0
+    for query, plan, problems in check_plans():
+        failed += bool(problems)
+        print(f"{'✗' if problems else '✓'} {query.name}")
+        for step in plan:
+            print(f"    {step}{'   <-- ' if step in problems else ''}")
+    print(f"\nЗапросов с полным просмотром или сортировкой: {failed}")
+    sys.exit(1 if failed else 0)
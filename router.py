@@ -0,0 +1,120 @@
+import logging
+
+logger = logging.getLogger('router')
+
+
+class MessageRouter:
+    """Маршрутизатор текстовых сообщений по словарям.
+
+    Вместо цепочки обработчиков с lambda-условиями, которые telebot
+    проверяет по очереди, сообщение ищется в словарях:
+      1. кнопки, прерывающие любой сценарий (interrupt=True), по тексту;
+      2. обработчик текущего шага пользователя;
+      3. остальные кнопки по тексту, в том числе админские.
+    Стоимость выбора обработчика не зависит от числа сценариев.
+    """
+
+    def __init__(self, get_step, admin_ids=frozenset()):
+        self.get_step = get_step
+        self.admin_ids = frozenset(admin_ids)
+        self.interrupts = {}
+        self.steps = {}
+        self.texts = {}
+        self.admin_texts = {}
+
+    def text(self, text, interrupt=False, admin=False):
+        """Декоратор: обработчик кнопки с точным текстом"""
+        def decorator(handler):
+            if interrupt:
+                self.interrupts[text] = handler
+            elif admin:
+                self.admin_texts[text] = handler
+            else:
+                self.texts[text] = handler
+            return handler
+        return decorator
+
+    def step(self, step):
+        """Декоратор: обработчик шага сценария"""
+        def decorator(handler):
+            self.steps[step] = handler
+            return handler
+        return decorator
+
+    def resolve(self, message):
+        """Обработчик для сообщения или None"""
+        text = message.text
+        handler = self.interrupts.get(text)
+        if handler:
+            return handler
+        step = self.get_step(message.chat.id)
+        if step is not None:
+            handler = self.steps.get(step)
+            if handler:
+                return handler
+        handler = self.texts.get(text)
+        if handler:
+            return handler
+        if message.chat.id in self.admin_ids:
+            return self.admin_texts.get(text)
+        return None
+
+    def match(self, message):
+        """Фильтр для bot.message_handler.
+
+        Найденный обработчик запоминается в сообщении: dispatch не ищет его
+        заново и не читает шаг пользователя второй раз.
+        """
+        message.route_handler = self.resolve(message)
+        return message.route_handler is not None
+
+    def dispatch(self, message):
+        """Вызывает найденный обработчик"""
+        handler = getattr(message, 'route_handler', None) or self.resolve(message)
+        if handler:
+            handler(message)
+
+    def attach(self, bot):
+        """Регистрирует маршрутизатор одним обработчиком бота"""
+        bot.register_message_handler(self.dispatch, func=self.match)
+
+
+if __name__ == '__main__':
+    # Микро-бенчмарк: цепочка lambda-условий против словарей
+    import timeit
+    from types import SimpleNamespace
+
+    state = {}
+    admins = list(range(1000, 1010))
+    noop = lambda message: None
+
+    def make_flows(count):
+        chain = []
+        router = MessageRouter(lambda chat_id: state.get(chat_id, {}).get('step'), admins)
+        for number in range(count):
+            text = f"button_{number}"
+            step = f"step_{number}"
+            chain.append(lambda m, text=text: m.text == text)
+            chain.append(lambda m, step=step: state.get(m.chat.id, {}).get('step') == step)
+            chain.append(lambda m, text=f"admin_{number}": m.text == text and m.chat.id in admins)
+            router.text(text)(noop)
+            router.step(step)(noop)
+            router.text(f"admin_{number}", admin=True)(noop)
+        return chain, router
+
+    def chain_dispatch(chain, message):
+        for predicate in chain:
+            if predicate(message):
+                return predicate
+        return None
+
+    message = SimpleNamespace(text="free text", chat=SimpleNamespace(id=1))
+    print(f"{'сценариев':>10} {'lambda, мкс':>12} {'словари, мкс':>13}")
+    for flows in (5, 20, 100):
+        chain, router = make_flows(flows)
+        state[1] = {'step': f"step_{flows - 1}"}
+        runs = 20000
+        chain_time = timeit.timeit(lambda: chain_dispatch(chain, message), number=runs) / runs
+        # Как в боте: фильтр match, затем dispatch с уже найденным обработчиком
+        router_time = timeit.timeit(lambda: router.match(message) and router.dispatch(message), number=runs) / runs
+        print(f"{flows:>10} {chain_time * 1e6:>12.2f} {router_time * 1e6:>13.2f}")
@@ -0,0 +1,593 @@
+import os
+import re
+import json
+import time
+import datetime
+import threading
+import logging
+import gspread
+from google.auth.exceptions import RefreshError
+from google.oauth2.service_account import Credentials
+from storage import get_db_connection
+from repository import APPOINTMENT_JOIN, ARCHIVE_JOIN, SHEET_ENQUEUE
+from timeutil import format_date
+
+logger = logging.getLogger('sheets')
+
+GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
+GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "K1")
+GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE", "credentials.json")
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+# Настройки фоновой записи в таблицу
+SHEET_SYNC_DELAY = float(os.getenv("SHEET_SYNC_DELAY", 2))          # Окно склейки изменений (сек)
+SHEET_SYNC_INTERVAL = float(os.getenv("SHEET_SYNC_INTERVAL", 30))   # Проверка очереди без сигналов (сек)
+SHEET_SYNC_BATCH = int(os.getenv("SHEET_SYNC_BATCH", 200))          # Записей за один проход
+SHEET_RETRY_BASE = float(os.getenv("SHEET_RETRY_BASE", 5))          # Начальная пауза повтора (сек)
+SHEET_RETRY_MAX = float(os.getenv("SHEET_RETRY_MAX", 900))          # Максимальная пауза повтора (сек)
+SHEET_QUOTA_PAUSE = float(os.getenv("SHEET_QUOTA_PAUSE", 60))       # Пауза при превышении квоты (сек)
+SHEET_DELTA_LOOKBACK = int(os.getenv("SHEET_DELTA_LOOKBACK", 120))   # Перекрытие окна дельты (сек)
+SHEET_VERIFY_WRITES = os.getenv("SHEET_VERIFY_WRITES", "0") == "1"  # Сверять ID перед каждым обновлением строк
+SHEET_VERIFY_INTERVAL = float(os.getenv("SHEET_VERIFY_INTERVAL", 3600))  # Плановая сверка индекса строк (сек)
+
+SHEET_HEADERS = [
+    "ID", "Дата записи", "Время", "Клиент", "Телефон",
+    "Мастер", "Услуга", "Длительность", "Цена", "Статус", "Причина отмены"
+]
+LAST_COLUMN = chr(ord('A') + len(SHEET_HEADERS) - 1)
+
+# Запись в лист (очередь и полная пересборка) выполняется по одной
+SHEET_WRITE_LOCK = threading.RLock()
+
+SHEET_COLUMNS = """a.id, a.date, a.time, a.client_name, a.phone,
+                m.name, s.name, s.duration, s.price, a.status, a.cancel_reason"""
+SHEET_ROWS_QUERY = f"SELECT {SHEET_COLUMNS} {APPOINTMENT_JOIN}"
+
+# Полная пересборка: рабочая таблица и архив (lifecycle.py) по id
+SHEET_REBUILD_QUERY = f"""{SHEET_ROWS_QUERY}
+                       UNION ALL
+                       SELECT {SHEET_COLUMNS} {ARCHIVE_JOIN}
+                       ORDER BY 1"""
+
+
+def _status_code(error):
+    """HTTP-код ответа Google API из исключения, если он есть"""
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def is_auth_error(error):
+    """Ошибка авторизации, после которой нужно переподключиться"""
+    return isinstance(error, RefreshError) or _status_code(error) in (401, 403)
+
+
+class SheetClient:
+    """Долгоживущее подключение к Google Sheets.
+
+    Учетные данные, авторизованная сессия gspread (токен обновляется
+    только по истечении) и объект листа создаются один раз и переиспользуются
+    всеми потоками. После ошибки авторизации подключение сбрасывается и
+    создается заново при следующем обращении.
+    """
+
+    def __init__(self, sheet_id=GOOGLE_SHEET_ID, sheet_name=GOOGLE_SHEET_NAME,
+                 credentials_file=GOOGLE_CREDENTIALS_FILE):
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+        self.credentials_file = credentials_file
+        self.connects = 0
+        self.auth_refreshes = 0
+        self.api_calls = 0
+        self.api_errors = 0
+        self._worksheet = None
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+
+    def _count_response(self, response, *args, **kwargs):
+        with self._lock:
+            self.api_calls += 1
+            if response.status_code >= 400:
+                self.api_errors += 1
+        return response
+
+    def _connect(self):
+        """Авторизуется и открывает лист"""
+        creds = Credentials.from_service_account_file(self.credentials_file, scopes=GOOGLE_SCOPES)
+
+        refresh = creds.refresh
+
+        def counted_refresh(request):
+            with self._lock:
+                self.auth_refreshes += 1
+            return refresh(request)
+
+        creds.refresh = counted_refresh
+
+        client = gspread.authorize(creds)
+        client.http_client.session.hooks['response'].append(self._count_response)
+        worksheet = client.open_by_key(self.sheet_id).worksheet(self.sheet_name)
+        with self._lock:
+            self.connects += 1
+        logger.info(f"Подключение к Google Sheets установлено (лист {self.sheet_name})")
+        return worksheet
+
+    def worksheet(self):
+        """Возвращает объект листа, подключаясь при необходимости"""
+        worksheet = self._worksheet
+        if worksheet is None:
+            with self._connect_lock:
+                if self._worksheet is None:
+                    self._worksheet = self._connect()
+                worksheet = self._worksheet
+        return worksheet
+
+    def reset(self):
+        """Сбрасывает подключение, следующее обращение авторизуется заново"""
+        with self._lock:
+            self._worksheet = None
+
+    def handle_error(self, error):
+        """Сбрасывает подключение, если ошибка связана с авторизацией"""
+        if is_auth_error(error):
+            logger.warning(f"Ошибка авторизации Google Sheets, переподключаемся: {error}")
+            self.reset()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'connected': self._worksheet is not None,
+                'connects': self.connects,
+                'auth_refreshes': self.auth_refreshes,
+                'api_calls': self.api_calls,
+                'api_errors': self.api_errors,
+            }
+
+
+# Общее подключение к Google Sheets
+SHEET_CLIENT = SheetClient()
+
+
+def get_google_sheet():
+    """Доступ к таблице через общее подключение"""
+    try:
+        return SHEET_CLIENT.worksheet()
+    except Exception as e:
+        logger.error(f"Ошибка доступа к Google Sheets: {e}")
+        SHEET_CLIENT.handle_error(e)
+        return None
+
+
+def to_sheet_row(appointment):
+    """Преобразует строку записи из БД в строку таблицы"""
+    row = list(appointment)
+    row[1] = format_date(row[1])
+    return row
+
+
+def fetch_sheet_rows(appointment_ids):
+    """Читает строки таблицы для указанных записей"""
+    if not appointment_ids:
+        return {}
+    placeholders = ','.join('?' * len(appointment_ids))
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"{SHEET_ROWS_QUERY} WHERE a.id IN ({placeholders})", list(appointment_ids))
+        return {app[0]: to_sheet_row(app) for app in c.fetchall()}
+
+
+def get_sync_state(key, default=None):
+    """Читает значение из таблицы состояния синхронизации"""
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_sync_state(conn, key, value):
+    """Сохраняет значение состояния синхронизации в текущей транзакции"""
+    conn.execute("""INSERT INTO sync_state (key, value) VALUES (?, ?)
+                 ON CONFLICT(key) DO UPDATE SET value = excluded.value""", (key, value))
+
+
+def lookback_bound(high_water_mark):
+    """Начало окна перекрытия: граница дельты минус SHEET_DELTA_LOOKBACK секунд"""
+    mark = datetime.datetime.fromisoformat(high_water_mark)
+    return (mark - datetime.timedelta(seconds=SHEET_DELTA_LOOKBACK)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def recent_window(conn, high_water_mark):
+    """Версии записей из окна перекрытия перед границей дельты (JSON)"""
+    c = conn.cursor()
+    c.execute("SELECT id, updated_at FROM appointments WHERE updated_at >= ?",
+              (lookback_bound(high_water_mark),))
+    return json.dumps({str(app_id): updated_at for app_id, updated_at in c.fetchall()})
+
+
+def parse_start_row(response):
+    """Номер первой строки из ответа append_rows"""
+    updated_range = response['updates']['updatedRange']
+    return int(re.match(r'^[A-Z]+(\d+)', updated_range.split('!')[-1]).group(1))
+
+
+def load_row_index(appointment_ids):
+    """Номера строк листа для записей из сохраненного индекса"""
+    if not appointment_ids:
+        return {}
+    placeholders = ','.join('?' * len(appointment_ids))
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT appointment_id, row_number FROM sheet_rows WHERE appointment_id IN ({placeholders})",
+                  list(appointment_ids))
+        return dict(c.fetchall())
+
+
+def replace_row_index(conn, pairs):
+    """Полностью заменяет индекс строк листа"""
+    conn.execute("DELETE FROM sheet_rows")
+    conn.executemany("INSERT INTO sheet_rows (appointment_id, row_number) VALUES (?, ?)", pairs)
+
+
+def read_row_index(worksheet):
+    """Читает индекс строк из столбца A листа"""
+    pairs = {}
+    for row_number, value in enumerate(worksheet.col_values(1), start=1):
+        if value and str(value).isdigit():
+            app_id = int(value)
+            if app_id in pairs:
+                logger.warning(f"Запись #{app_id} встречается в листе повторно (строки "
+                               f"{pairs[app_id]} и {row_number}), используется первая")
+                continue
+            pairs[app_id] = row_number
+    return list(pairs.items())
+
+
+def verify_row_index(worksheet):
+    """Сверяет сохраненный индекс строк со столбцом A и исправляет его.
+
+    Читает только столбец A. Возвращает число исправленных записей индекса.
+    """
+    actual = dict(read_row_index(worksheet))
+    with get_db_connection() as conn:
+        stored = dict(conn.execute("SELECT appointment_id, row_number FROM sheet_rows").fetchall())
+        drift = sum(1 for app_id in stored.keys() | actual.keys() if stored.get(app_id) != actual.get(app_id))
+        if drift:
+            replace_row_index(conn, actual.items())
+    if drift:
+        logger.warning(f"Индекс строк Google Sheets восстановлен: исправлено {drift} записей")
+    return drift
+
+
+def rows_match(worksheet, index):
+    """Проверяет одним запросом, что в строках индекса стоят ожидаемые ID"""
+    if not index:
+        return True
+    items = sorted(index.items(), key=lambda item: item[1])
+    cells = worksheet.batch_get([f"A{row_number}" for app_id, row_number in items])
+    for (app_id, row_number), value_range in zip(items, cells):
+        value = value_range[0][0] if value_range and value_range[0] else None
+        if str(value) != str(app_id):
+            logger.warning(f"В строке {row_number} листа ожидалась запись #{app_id}, найдено: {value}")
+            return False
+    return True
+
+
+def init_google_sheet():
+    """Инициализация структуры таблицы: заголовки без очистки данных"""
+    try:
+        worksheet = get_google_sheet()
+        if not worksheet:
+            return
+
+        with SHEET_WRITE_LOCK:
+            first_row = worksheet.row_values(1)
+            if first_row != SHEET_HEADERS:
+                worksheet.update(values=[SHEET_HEADERS], range_name=f"A1:{LAST_COLUMN}1",
+                                 value_input_option='RAW')
+            # Лист могли править вручную, пока бот был остановлен
+            verify_row_index(worksheet)
+        logger.info("Google Sheet инициализирована")
+    except Exception as e:
+        logger.error(f"Ошибка инициализации Google Sheet: {e}")
+        SHEET_CLIENT.handle_error(e)
+
+
+def sync_all_to_google():
+    """Полная пересборка листа (ручное восстановление администратором)"""
+    try:
+        worksheet = get_google_sheet()
+        if not worksheet:
+            return False
+
+        with SHEET_WRITE_LOCK:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute(SHEET_REBUILD_QUERY)
+                appointments = c.fetchall()
+                c.execute("SELECT MAX(updated_at) FROM appointments")
+                high_water_mark = c.fetchone()[0] or ''
+
+            batch = [SHEET_HEADERS] + [to_sheet_row(app) for app in appointments]
+            worksheet.clear()
+            worksheet.append_rows(batch, value_input_option='RAW')
+
+            with get_db_connection() as conn:
+                replace_row_index(conn, [(app[0], row_number)
+                                         for row_number, app in enumerate(appointments, start=2)])
+                conn.execute("DELETE FROM sheet_outbox")
+                set_sync_state(conn, 'sheet_hwm', high_water_mark)
+                set_sync_state(conn, 'sheet_recent', recent_window(conn, high_water_mark))
+
+        logger.info(f"Полная пересборка Google Sheets выполнена: {len(appointments)} строк")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка полной синхронизации: {e}")
+        SHEET_CLIENT.handle_error(e)
+        return False
+
+
+def sync_changes_to_google():
+    """Ставит в очередь записи, измененные после прошлой синхронизации.
+
+    Граница хранится в sync_state как максимальный updated_at. Окно
+    перекрывается на SHEET_DELTA_LOOKBACK секунд, чтобы не потерять записи,
+    зафиксированные позже своего updated_at; уже отправленные версии из
+    перекрытия пропускаются. Возвращает число поставленных в очередь записей.
+    """
+    high_water_mark = get_sync_state('sheet_hwm', '')
+    recent = json.loads(get_sync_state('sheet_recent', '{}'))
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        if high_water_mark:
+            c.execute("""SELECT id, updated_at FROM appointments
+                       WHERE updated_at >= ?
+                       ORDER BY updated_at, id""",
+                      (lookback_bound(high_water_mark),))
+        else:
+            c.execute("SELECT id, updated_at FROM appointments ORDER BY updated_at, id")
+        changed = c.fetchall()
+
+    if not changed:
+        return 0
+
+    fresh = [app_id for app_id, updated_at in changed if recent.get(str(app_id)) != updated_at]
+    new_mark = max(high_water_mark, changed[-1][1])
+
+    with get_db_connection() as conn:
+        SHEET_SYNC.enqueue_many(fresh, conn)
+        set_sync_state(conn, 'sheet_hwm', new_mark)
+        set_sync_state(conn, 'sheet_recent', recent_window(conn, new_mark))
+
+    if fresh:
+        logger.info(f"Дельта-синхронизация: {len(fresh)} измененных записей в очереди")
+    return len(fresh)
+
+
+class MemoryWorksheet:
+    """Таблица в памяти с подмножеством API gspread.Worksheet.
+
+    Позволяет проверять очередь синхронизации локально, без Google API.
+    """
+
+    def __init__(self, title=GOOGLE_SHEET_NAME):
+        self.title = title
+        self.rows = []
+        self.api_calls = 0
+
+    def clear(self):
+        self.api_calls += 1
+        self.rows = []
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self.api_calls += 1
+        start = len(self.rows) + 1
+        self.rows.extend(list(row) for row in values)
+        end = len(self.rows)
+        return {'updates': {'updatedRange': f"{self.title}!A{start}:{LAST_COLUMN}{end}"}}
+
+    def batch_update(self, data, **kwargs):
+        self.api_calls += 1
+        for item in data:
+            first_row = int(re.match(r'^[A-Z]+(\d+)', item['range']).group(1))
+            for offset, values in enumerate(item['values']):
+                index = first_row - 1 + offset
+                while len(self.rows) <= index:
+                    self.rows.append([])
+                self.rows[index] = list(values)
+        return {}
+
+    def batch_get(self, ranges, **kwargs):
+        self.api_calls += 1
+        result = []
+        for range_name in ranges:
+            match = re.match(r'^([A-Z]+)(\d+)$', range_name)
+            col = ord(match.group(1)) - ord('A')
+            row = int(match.group(2)) - 1
+            if row < len(self.rows) and col < len(self.rows[row]) and self.rows[row][col] != '':
+                result.append([[str(self.rows[row][col])]])
+            else:
+                result.append([])
+        return result
+
+    def update(self, values, range_name, **kwargs):
+        return self.batch_update([{'range': range_name, 'values': values}])
+
+    def row_values(self, row, **kwargs):
+        self.api_calls += 1
+        return [str(value) for value in self.rows[row - 1]] if row <= len(self.rows) else []
+
+    def col_values(self, col, **kwargs):
+        self.api_calls += 1
+        return [str(row[col - 1]) if len(row) >= col and row[col - 1] != '' else None
+                for row in self.rows]
+
+    def get_all_values(self, **kwargs):
+        self.api_calls += 1
+        return [[str(value) for value in row] for row in self.rows]
+
+
+class SheetSyncWorker:
+    """Фоновая запись изменений в Google Sheets через очередь в БД.
+
+    Обработчики только отмечают запись в таблице sheet_outbox. Поток
+    склеивает несколько изменений одной записи, читает актуальные строки из
+    БД и отправляет их одним batch_update для существующих строк и одним
+    append_rows для новых. Ошибки откладывают повтор с экспоненциальной
+    паузой, превышение квоты (HTTP 429) - не меньше SHEET_QUOTA_PAUSE.
+    """
+
+    def __init__(self, worksheet_factory=get_google_sheet, batch_size=SHEET_SYNC_BATCH):
+        self.worksheet_factory = worksheet_factory
+        self.batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._worksheet = None
+        self._verify_at = 0.0
+
+    def _needs_verify(self, worksheet, items):
+        """Нужно ли сверять индекс строк перед записью.
+
+        Сверка - лишний запрос к API, поэтому она выполняется только при
+        подозрении на расхождение: первая запись и новое подключение,
+        повтор после неудачной записи, плановая проверка раз в
+        SHEET_VERIFY_INTERVAL. SHEET_VERIFY_WRITES=1 включает ее всегда.
+        """
+        if SHEET_VERIFY_WRITES or worksheet is not self._worksheet:
+            return True
+        if any(attempts for app_id, version, attempts in items):
+            return True
+        return time.monotonic() >= self._verify_at
+
+    def enqueue(self, appointment_id):
+        """Ставит запись в очередь на выгрузку в таблицу"""
+        try:
+            with get_db_connection() as conn:
+                self.enqueue_many([appointment_id], conn)
+        except Exception as e:
+            logger.error(f"Ошибка постановки записи #{appointment_id} в очередь Google Sheets: {e}")
+
+    def enqueue_many(self, appointment_ids, conn):
+        """Ставит записи в очередь в транзакции соединения conn"""
+        SHEET_ENQUEUE.run_many([(int(app_id),) for app_id in appointment_ids], conn)
+        if appointment_ids:
+            self._wakeup.set()
+
+    def pending(self):
+        """Количество записей в очереди"""
+        with get_db_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sheet_outbox").fetchone()[0]
+
+    def _complete(self, items):
+        """Удаляет выгруженные записи, если их не изменили во время выгрузки"""
+        with get_db_connection() as conn:
+            conn.executemany("DELETE FROM sheet_outbox WHERE appointment_id = ? AND version = ?",
+                             [(app_id, version) for app_id, version, attempts in items])
+
+    def _defer(self, items, error):
+        """Откладывает повтор выгрузки"""
+        quota = _status_code(error) == 429
+        now = time.time()
+        updates = []
+        for app_id, version, attempts in items:
+            delay = min(SHEET_RETRY_BASE * 2 ** attempts, SHEET_RETRY_MAX)
+            if quota:
+                delay = max(delay, SHEET_QUOTA_PAUSE)
+            updates.append((now + delay, str(error), app_id))
+        with get_db_connection() as conn:
+            conn.executemany("""UPDATE sheet_outbox
+                             SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                             WHERE appointment_id = ?""", updates)
+        logger.warning(f"Выгрузка {len(items)} записей в Google Sheets отложена: {error}")
+
+    def flush(self):
+        """Выгружает одну пачку готовых к отправке записей. Возвращает их число"""
+        with SHEET_WRITE_LOCK:
+            return self._flush()
+
+    def _flush(self):
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""SELECT appointment_id, version, attempts FROM sheet_outbox
+                       WHERE next_attempt_at <= ?
+                       ORDER BY appointment_id LIMIT ?""", (time.time(), self.batch_size))
+            items = c.fetchall()
+        if not items:
+            return 0
+
+        try:
+            worksheet = self.worksheet_factory()
+            if worksheet is None:
+                raise RuntimeError("Google Sheets недоступна")
+
+            app_ids = [app_id for app_id, version, attempts in items]
+            rows = fetch_sheet_rows(app_ids)
+            index = load_row_index(app_ids)
+            if index and self._needs_verify(worksheet, items):
+                if not rows_match(worksheet, index):
+                    verify_row_index(worksheet)
+                    index = load_row_index(app_ids)
+                self._worksheet = worksheet
+                self._verify_at = time.monotonic() + SHEET_VERIFY_INTERVAL
+            updates, appends = [], []
+            for app_id, version, attempts in items:
+                row = rows.get(app_id)
+                if row is None:
+                    continue
+                row_number = index.get(app_id)
+                if row_number:
+                    updates.append({
+                        'range': f"A{row_number}:{LAST_COLUMN}{row_number}",
+                        'values': [row]
+                    })
+                else:
+                    appends.append(row)
+
+            if updates:
+                worksheet.batch_update(updates, value_input_option='RAW')
+            if appends:
+                start_row = parse_start_row(worksheet.append_rows(appends, value_input_option='RAW'))
+                with get_db_connection() as conn:
+                    conn.executemany("""INSERT INTO sheet_rows (appointment_id, row_number) VALUES (?, ?)
+                                     ON CONFLICT(appointment_id) DO UPDATE SET row_number = excluded.row_number""",
+                                     [(row[0], start_row + offset) for offset, row in enumerate(appends)])
+        except Exception as e:
+            SHEET_CLIENT.handle_error(e)
+            self._defer(items, e)
+            return 0
+
+        self._complete(items)
+        logger.info(f"Google Sheets: обновлено {len(updates)}, добавлено {len(appends)} строк")
+        return len(items)
+
+    def run(self):
+        """Основной цикл потока синхронизации"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(SHEET_SYNC_INTERVAL)
+            self._wakeup.clear()
+            # Даем накопиться соседним изменениям, чтобы отправить их одной пачкой
+            self._stopped.wait(SHEET_SYNC_DELAY)
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Ошибка в потоке синхронизации Google Sheets: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, name='sheet-sync', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+
+# Общая очередь выгрузки в Google Sheets
+SHEET_SYNC = SheetSyncWorker()
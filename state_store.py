@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import atexit
+import threading
+import logging
+from collections import OrderedDict
+from storage import get_db_connection
+from cluster import BOT_CLUSTER
+
+logger = logging.getLogger('state_store')
+
+# Хранилище состояний диалогов. В кластерном режиме по умолчанию состояния
+# пишутся в SQLite сразу и всегда сверяются с БД: следующее сообщение
+# пользователя может попасть в другой процесс
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite" if BOT_CLUSTER else "memory")          # memory или sqlite
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", 10000))                                 # Максимум состояний в памяти
+STATE_TTL = float(os.getenv("STATE_TTL", 24 * 3600))                                       # Время жизни брошенного диалога (сек)
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 0 if BOT_CLUSTER else 1))   # Период записи в БД, 0 - сразу (сек)
+STATE_CACHE_SECONDS = float(os.getenv("STATE_CACHE_SECONDS", 0 if BOT_CLUSTER else 300))   # Доверие к локальной копии (сек)
+
+
+class BookingState:
+    """Состояние сценария записи одного пользователя"""
+
+    __slots__ = ('step', 'master_id', 'master_name', 'service_id', 'service_name', 'duration',
+                 'price', 'client_name', 'phone', 'date', 'time', 'touched', 'loaded')
+
+    # Поля, которые сохраняются в БД
+    FIELDS = __slots__[:-2]
+
+    def __init__(self, step=None, **fields):
+        self.step = step
+        for name in self.FIELDS[1:]:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"Неизвестные поля состояния: {', '.join(fields)}")
+        self.touched = time.time()
+        self.loaded = time.monotonic()
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            if name not in self.FIELDS:
+                raise TypeError(f"Неизвестное поле состояния: {name}")
+            setattr(self, name, value)
+        self.touched = time.time()
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    @classmethod
+    def from_tuple(cls, values, touched):
+        state = cls(**dict(zip(cls.FIELDS, values)))
+        state.touched = touched
+        return state
+
+
+class MemoryStateStore:
+    """Состояния в памяти процесса: LRU с ограничением размера и TTL.
+
+    Записи упорядочены по последнему обращению, поэтому самые старые
+    (и первыми истекающие) лежат в начале OrderedDict и удаляются за O(1)
+    при каждой вставке.
+    """
+
+    def __init__(self, max_size=STATE_MAX_USERS, ttl=STATE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.RLock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire(self, now):
+        """Удаляет истекшие и лишние записи. Вызывать под self._lock"""
+        while self._states:
+            chat_id, state = next(iter(self._states.items()))
+            if now - state.touched > self.ttl:
+                self.expired += 1
+            elif len(self._states) > self.max_size:
+                self.evicted += 1
+            else:
+                break
+            self._drop(chat_id)
+
+    def _drop(self, chat_id):
+        self._states.pop(chat_id, None)
+
+    def _lookup(self, chat_id):
+        """Живая запись из памяти или None. Вызывать под self._lock"""
+        state = self._states.get(chat_id)
+        if state is None:
+            return None
+        if time.time() - state.touched > self.ttl:
+            self.expired += 1
+            self._drop(chat_id)
+            return None
+        self._states.move_to_end(chat_id)
+        return state
+
+    def _store(self, chat_id, state):
+        """Кладет запись в память. Вызывать под self._lock"""
+        self._states[chat_id] = state
+        self._states.move_to_end(chat_id)
+        self._expire(time.time())
+
+    def get(self, chat_id):
+        """Состояние пользователя или None"""
+        with self._lock:
+            return self._lookup(chat_id)
+
+    def get_step(self, chat_id):
+        state = self.get(chat_id)
+        return state.step if state else None
+
+    def begin(self, chat_id, step, **fields):
+        """Начинает новый сценарий, заменяя прежнее состояние"""
+        with self._lock:
+            state = BookingState(step, **fields)
+            self._store(chat_id, state)
+            return state
+
+    def update(self, chat_id, **fields):
+        """Меняет поля состояния. KeyError, если состояния нет"""
+        with self._lock:
+            state = self._lookup(chat_id)
+            if state is None:
+                raise KeyError(chat_id)
+            state.update(**fields)
+            self._store(chat_id, state)
+            return state
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._drop(chat_id)
+
+    def flush(self):
+        return 0
+
+    def start(self):
+        pass
+
+    def __len__(self):
+        return len(self._states)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'size': len(self._states),
+                'max_size': self.max_size,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """Состояния в SQLite с отложенной записью.
+
+    Память работает как LRU-кэш, изменения копятся в _dirty и пишутся
+    пачкой раз в STATE_FLUSH_INTERVAL секунд и при остановке, поэтому
+    шаги диалога не ждут диска. При промахе кэша состояние читается из
+    таблицы user_state, так что диалог продолжается после перезапуска.
+    Локальной копии доверяем STATE_CACHE_SECONDS секунд, после чего она
+    сверяется с БД: так несколько процессов бота видят общие состояния.
+    При STATE_FLUSH_INTERVAL=0 каждое изменение пишется в БД сразу.
+    """
+
+    def __init__(self, max_size=STATE_MAX_USERS, ttl=STATE_TTL,
+                 flush_interval=STATE_FLUSH_INTERVAL, cache_seconds=STATE_CACHE_SECONDS):
+        super().__init__(max_size, ttl)
+        self.flush_interval = flush_interval
+        self.cache_seconds = cache_seconds
+        self._dirty = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.reads = 0
+        self.writes = 0
+
+    def _read(self, chat_id):
+        """Читает состояние из БД"""
+        self.reads += 1
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT data, updated_at FROM user_state WHERE chat_id = ?",
+                               (chat_id,)).fetchone()
+        if not row or time.time() - row[1] > self.ttl:
+            return None
+        return BookingState.from_tuple(json.loads(row[0]), row[1])
+
+    def _lookup(self, chat_id):
+        if chat_id in self._dirty:
+            state = self._dirty[chat_id]
+            if state is not None:
+                self._states[chat_id] = state
+        return super()._lookup(chat_id)
+
+    def _is_fresh(self, chat_id):
+        """Локальной копии можно верить без БД. Вызывать под self._lock"""
+        if chat_id in self._dirty:
+            return True
+        state = super()._lookup(chat_id)
+        return state is not None and time.monotonic() - state.loaded < self.cache_seconds
+
+    def _sync(self, chat_id):
+        """Сверяет локальную копию с БД, если ей больше нельзя доверять.
+
+        Чтение из БД идет без блокировки хранилища, чтобы обращения других
+        пользователей не ждали диска (при STATE_CACHE_SECONDS=0 читается
+        каждое обращение).
+        """
+        with self._lock:
+            if self._is_fresh(chat_id):
+                return
+        stored = self._read(chat_id)
+        with self._lock:
+            if chat_id in self._dirty:
+                # Пока читали, состояние изменили в этом процессе
+                return
+            state = super()._lookup(chat_id)
+            if stored is None:
+                self._states.pop(chat_id, None)
+                return
+            if state is None or stored.touched > state.touched:
+                state = stored
+            state.loaded = time.monotonic()
+            self._states[chat_id] = state
+            self._expire(time.time())
+
+    def get(self, chat_id):
+        self._sync(chat_id)
+        return super().get(chat_id)
+
+    def _store(self, chat_id, state):
+        super()._store(chat_id, state)
+        self._dirty[chat_id] = state
+
+    def begin(self, chat_id, step, **fields):
+        state = super().begin(chat_id, step, **fields)
+        self._write_through()
+        return state
+
+    def update(self, chat_id, **fields):
+        self._sync(chat_id)
+        state = super().update(chat_id, **fields)
+        self._write_through()
+        return state
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+            self._dirty[chat_id] = None
+        self._write_through()
+
+    def _write_through(self):
+        """При STATE_FLUSH_INTERVAL=0 пишет изменение в БД сразу"""
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные изменения в БД"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        upserts = [(chat_id, json.dumps(state.to_tuple(), ensure_ascii=False), state.touched)
+                   for chat_id, state in dirty.items() if state is not None]
+        deletes = [(chat_id,) for chat_id, state in dirty.items() if state is None]
+        try:
+            with get_db_connection() as conn:
+                conn.executemany("""INSERT INTO user_state (chat_id, data, updated_at) VALUES (?, ?, ?)
+                                 ON CONFLICT(chat_id) DO UPDATE SET
+                                 data = excluded.data, updated_at = excluded.updated_at
+                                 WHERE excluded.updated_at >= user_state.updated_at""", upserts)
+                conn.executemany("DELETE FROM user_state WHERE chat_id = ?", deletes)
+                conn.execute("DELETE FROM user_state WHERE updated_at < ?", (time.time() - self.ttl,))
+        except Exception:
+            # Возвращаем изменения в очередь, не затирая более новые
+            with self._lock:
+                for chat_id, state in dirty.items():
+                    self._dirty.setdefault(chat_id, state)
+            raise
+        self.writes += len(dirty)
+        return len(dirty)
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояний диалогов: {e}")
+
+    def start(self):
+        if self.flush_interval <= 0:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name='state-store', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        with self._lock:
+            stats.update(backend='sqlite', pending=len(self._dirty), reads=self.reads, writes=self.writes)
+        return stats
+
+
+def create_state_store(backend=STATE_BACKEND):
+    """Создает хранилище состояний по названию бэкенда"""
+    if backend == 'sqlite':
+        return SQLiteStateStore()
+    if backend != 'memory':
+        logger.warning(f"Неизвестный STATE_BACKEND={backend}, состояния хранятся в памяти")
+    return MemoryStateStore()
@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# Модули бота читают настройки из окружения при импорте: тесты работают
+# с отдельной базой во временном каталоге (туда же пишутся логи)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='salon-tests-')
+sys.path.insert(0, ROOT)
+os.chdir(WORKDIR)
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'salon.db')
+os.environ.pop('DATABASE_URL', None)
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('ADMIN_CHAT_IDS', '[1]')
+os.environ.setdefault('GOOGLE_SHEET_ID', 'test')
+
+# Таблицы с данными тестов; справочники мастеров и услуг остаются
+DATA_TABLES = ('appointments', 'appointments_archive', 'reminder_log', 'sheet_outbox',
+               'sheet_rows', 'sync_state', 'user_state')
+
+
+@pytest.fixture
+def db():
+    """Схема актуальной версии и пустые таблицы записей"""
+    from database import init_db
+    from storage import get_db_connection
+    from availability import AVAILABILITY
+
+    init_db()
+    with get_db_connection() as conn:
+        for table in DATA_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+    AVAILABILITY.invalidate()
+    yield
+    AVAILABILITY.invalidate()
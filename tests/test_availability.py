@@ -0,0 +1,22 @@
+from availability import AVAILABILITY, get_free_slots
+from booking import reserve_slot
+
+
+def test_booking_and_cancel_update_cached_day(db):
+    # Рабочий день 9-19, сетка 60 минут, услуга 1 длится 60 минут
+    assert get_free_slots(1, '2030-01-01', 60)[:3] == ['09:00', '10:00', '11:00']
+
+    result = reserve_slot(1, 'Клиент', '+79990000000', 1, 1, '2030-01-01', '10:00')
+    assert result.ok
+    slots = get_free_slots(1, '2030-01-01', 60)
+    assert '10:00' not in slots and '09:00' in slots and '11:00' in slots
+    assert '09:00' not in get_free_slots(1, '2030-01-01', 120)
+
+    AVAILABILITY.on_canceled(result.appointment_id, 1, '2030-01-01')
+    assert '10:00' in get_free_slots(1, '2030-01-01', 60)
+
+
+def test_day_loaded_from_database(db):
+    assert reserve_slot(1, 'Клиент', '+79990000000', 2, 1, '2030-01-01', '18:00').ok
+    AVAILABILITY.invalidate()
+    assert get_free_slots(2, '2030-01-01', 60)[-1] == '17:00'
@@ -0,0 +1,46 @@
+import threading
+from booking import reserve_slot
+from storage import get_db_connection
+
+
+def reserve(client_id, time_str, master_id=1, service_id=1, date='2030-01-01'):
+    return reserve_slot(client_id, 'Клиент', '+79990000000', master_id, service_id, date, time_str)
+
+
+def test_parallel_bookings_of_one_slot(db):
+    barrier = threading.Barrier(8)
+    results = []
+
+    def book(client_id):
+        barrier.wait()
+        results.append(reserve(client_id, '10:00'))
+
+    threads = [threading.Thread(target=book, args=(300 + index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [result for result in results if result.ok]
+    assert len(results) == 8 and len(winners) == 1
+    assert {result.conflict.appointment_id for result in results if not result.ok} == {winners[0].appointment_id}
+    with get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM appointments WHERE status = 'active'").fetchone()[0] == 1
+
+
+def test_overlap_rules(db):
+    # Услуга 1 длится 60 минут
+    assert reserve(1, '10:00').ok
+    assert not reserve(2, '10:30').ok
+    assert not reserve(3, '9:30').ok
+    assert reserve(4, '11:00').ok
+    assert reserve(5, '09:00').ok
+    assert reserve(6, '10:00', master_id=2).ok
+    assert reserve(7, '10:00', date='2030-01-02').ok
+
+
+def test_canceled_slot_can_be_booked_again(db):
+    first = reserve(1, '10:00')
+    with get_db_connection() as conn:
+        conn.execute("UPDATE appointments SET status = 'canceled' WHERE id = ?", (first.appointment_id,))
+    assert reserve(2, '10:00').ok
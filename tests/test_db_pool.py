@@ -0,0 +1,51 @@
+import threading
+import pytest
+from db_pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=2)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE items (name TEXT)")
+    return pool
+
+
+def names(pool):
+    # Читаем из другого потока: видны только зафиксированные данные
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(
+        row[0] for row in pool.connection().execute("SELECT name FROM items ORDER BY name")))
+    thread.start()
+    thread.join()
+    return result
+
+
+def test_nested_block_does_not_commit_outer_transaction(pool):
+    with pool.connection() as outer:
+        outer.begin_write()
+        outer.execute("INSERT INTO items VALUES ('outer')")
+        with pool.connection() as inner:
+            assert inner.raw is outer.raw
+            inner.execute("INSERT INTO items VALUES ('inner')")
+        assert outer.in_transaction
+        assert names(pool) == []
+    assert names(pool) == ['inner', 'outer']
+
+
+def test_error_after_nested_block_rolls_back_everything(pool):
+    with pytest.raises(RuntimeError):
+        with pool.connection() as outer:
+            outer.begin_write()
+            with pool.connection() as inner:
+                inner.execute("INSERT INTO items VALUES ('inner')")
+            raise RuntimeError("сбой")
+    assert names(pool) == []
+
+
+def test_connection_returned_after_nesting(pool):
+    with pool.connection():
+        with pool.connection():
+            assert pool.get_stats()['in_use'] == 1
+    stats = pool.get_stats()
+    assert stats['in_use'] == 0 and stats['idle'] == 1
@@ -0,0 +1,61 @@
+import time
+import threading
+from types import SimpleNamespace
+from telebot.apihelper import ApiTelegramException
+from dispatcher import MessageDispatcher, TokenBucket
+
+
+def too_many_requests(retry_after):
+    return ApiTelegramException('sendMessage', None, {
+        'error_code': 429, 'description': 'Too Many Requests',
+        'parameters': {'retry_after': retry_after}})
+
+
+class FloodBot:
+    """Бот, отвечающий 429 на первую отправку"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.throttled = threading.Event()
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, 0
+            self.throttled.set()
+            raise too_many_requests(retry_after)
+        self.sent.append(chat_id)
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+def test_flood_limit_pauses_other_chats():
+    bot = FloodBot(retry_after=0.3)
+    dispatcher = MessageDispatcher(bot, workers=1)
+    first = threading.Thread(target=dispatcher.reply, args=(1, 'первое'))
+    first.start()
+    assert bot.throttled.wait(1)
+    deadline = time.monotonic() + 1
+    while dispatcher.get_stats()['throttled'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    time.sleep(0.01)
+
+    # Лимит действует на бота целиком: сообщение в другой чат тоже ждет паузу
+    started = time.monotonic()
+    dispatcher.reply(2, 'второе')
+    assert time.monotonic() - started >= 0.25
+    first.join()
+    assert sorted(bot.sent) == [1, 2]
+    assert dispatcher.get_stats()['throttled'] == 1
+
+
+def test_global_bucket_paused_for_other_chats():
+    dispatcher = MessageDispatcher(FloodBot(retry_after=0), workers=1)
+    dispatcher.global_bucket.pause(0.5)
+    assert dispatcher.global_bucket.reserve() > 0.4
+
+
+def test_pauses_do_not_stack():
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.pause(1)
+    bucket.pause(1)
+    assert bucket.reserve() <= 1.1 + 1 / 10
@@ -0,0 +1,52 @@
+import time
+import threading
+from types import SimpleNamespace
+import telebot
+from telebot import util
+from executor import ChatOrderedPool, configure_execution
+
+
+def message(chat_id, number):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), number=number)
+
+
+def test_chat_order_kept_and_chats_run_in_parallel():
+    bot = telebot.TeleBot('1:x', threaded=False)
+    pool = ChatOrderedPool(bot, num_threads=4)
+    handled = {1: [], 2: []}
+    inside = {1: 0, 2: 0}
+    lock = threading.Lock()
+    # Первые обработчики обоих чатов ждут друг друга: пройдут только вместе
+    barrier = threading.Barrier(2, timeout=2)
+
+    def handle(update):
+        chat_id = update.chat.id
+        with lock:
+            inside[chat_id] += 1
+            assert inside[chat_id] == 1
+        if update.number == 0:
+            barrier.wait()
+        time.sleep(0.001)
+        with lock:
+            inside[chat_id] -= 1
+            handled[chat_id].append(update.number)
+
+    try:
+        for number in range(20):
+            pool.put(handle, message(1, number))
+            pool.put(handle, message(2, number))
+        deadline = time.monotonic() + 5
+        while pool.get_stats()['processed'] < 40 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pool.close()
+
+    assert handled == {1: list(range(20)), 2: list(range(20))}
+    assert pool.get_stats()['failed'] == 0
+
+
+def test_unknown_mode_falls_back_to_thread_pool():
+    bot = telebot.TeleBot('1:x', threaded=False)
+    assert configure_execution(bot, mode='ordred', workers=2) is None
+    assert bot.threaded and isinstance(bot.worker_pool, util.ThreadPool)
+    bot.worker_pool.close()
@@ -0,0 +1,91 @@
+import io
+import os
+import time
+from types import SimpleNamespace
+from openpyxl import load_workbook
+import repository
+from booking import reserve_slot
+from export import ExportCache, ExcelExporter, ExportJob, HEADERS, write_workbook
+from repository import AppointmentRow
+
+
+def appointment(app_id, status):
+    return AppointmentRow(app_id, 'Клиент', '+79990000000', 'Анна', 'Маникюр',
+                          '2030-01-02', '10:00', status)
+
+
+def test_workbook_rows_and_status_labels():
+    statuses = ['active', 'canceled', 'completed', 'active', 'unknown']
+    rows = (appointment(app_id, status) for app_id, status in enumerate(statuses, 1))
+    output = io.BytesIO()
+    # Выборка для ширины колонок меньше числа строк: пишутся и она, и остаток
+    assert write_workbook(rows, output, sample_size=2) == 5
+
+    sheet = load_workbook(output).active
+    values = list(sheet.values)
+    assert values[0] == HEADERS
+    assert [row[0] for row in values[1:]] == [1, 2, 3, 4, 5]
+    assert [row[7] for row in values[1:]] == ['Активна', 'Отменена', 'Завершена', 'Активна', 'unknown']
+    assert values[1][1] == '02.01.2030'
+
+
+def cached(cache, key, size=1000):
+    output, tmp_path = cache.new_file()
+    with output:
+        output.write(b'x' * size)
+    return cache.put(key, tmp_path, 1)
+
+
+def test_cache_put_get_and_file_id(tmp_path):
+    cache = ExportCache(directory=str(tmp_path), max_mb=1)
+    assert cache.get('a') is None
+    entry = cached(cache, 'a')
+    assert cache.get('a') == entry and entry.file_id is None
+    cache.set_file_id(entry, 'F1')
+    assert cache.get('a').file_id == 'F1'
+    assert cache.get_stats()['hits'] == 2 and cache.get_stats()['misses'] == 1
+
+
+def test_cache_evicts_by_age_and_size(tmp_path):
+    cache = ExportCache(directory=str(tmp_path), max_mb=2500 / 1024 / 1024, max_age=3600)
+    old = cached(cache, 'old')
+    stale = time.time() - 7200
+    os.utime(old.path, (stale, stale))
+    first = cached(cache, 'first')
+    assert cache.get('old') is None
+
+    # В предел помещаются два файла: самый давний вытесняется
+    second = cached(cache, 'second')
+    for entry, age in ((first, 20), (second, 10)):
+        os.utime(entry.path, (time.time() - age, time.time() - age))
+    cached(cache, 'third')
+    assert cache.get('first') is None
+    assert cache.get('second') is not None and cache.get('third') is not None
+    assert sorted(os.listdir(tmp_path)) == sorted(['second.xlsx', 'second.json', 'third.xlsx', 'third.json'])
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_document(self, chat_id, document, **kwargs):
+        if isinstance(document, str):
+            self.sent.append(document)
+            return SimpleNamespace(document=SimpleNamespace(file_id=document))
+        self.sent.append('upload')
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"F{len(self.sent)}"))
+
+
+def test_build_reuses_file_id_until_data_changes(db, tmp_path):
+    result = reserve_slot(100, 'Клиент', '+79990000000', 1, 1, '2030-01-02', '10:00')
+    bot = FakeBot()
+    exporter = ExcelExporter(bot, dispatcher=None, cache=ExportCache(directory=str(tmp_path)))
+    job = ExportJob(1, None, None, '2030-01-01', '2030-01-31')
+
+    assert exporter._build(job) == 1
+    assert exporter._build(job) is None
+    assert bot.sent == ['upload', 'F1']
+
+    repository.set_appointment_status(result.appointment_id, 'canceled')
+    assert exporter._build(job) == 1
+    assert bot.sent[-1] == 'upload'
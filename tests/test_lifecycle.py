@@ -0,0 +1,63 @@
+import time
+import repository
+from booking import reserve_slot
+from sheets import MemoryWorksheet, SheetSyncWorker, SHEET_HEADERS, sync_changes_to_google
+from storage import get_db_connection
+
+
+def book_past(count):
+    """Активные записи в прошлом у разных мастеров. Возвращает их id"""
+    ids = []
+    for index in range(count):
+        result = reserve_slot(100 + index, 'Клиент', '+79990000000', 1 + index % 2, 1,
+                              '2020-01-01', f"{10 + index // 2:02d}:00")
+        assert result.ok
+        ids.append(result.appointment_id)
+    return ids
+
+
+def rows_by_id(worksheet):
+    return {row[0]: row for row in worksheet.rows[1:]}
+
+
+def test_completed_rows_reach_sheet_before_archive(db):
+    ids = book_past(4)
+    with get_db_connection() as conn:
+        conn.execute("INSERT INTO reminder_log (appointment_id, kind) VALUES (?, 1)", (ids[0],))
+
+    assert repository.complete_past_appointments(int(time.time()), 3) == 3
+    assert repository.complete_past_appointments(int(time.time()), 3) == 1
+    with get_db_connection() as conn:
+        queued = {row[0] for row in conn.execute("SELECT appointment_id FROM sheet_outbox")}
+    assert queued == set(ids)
+
+    # Пока записи не выгружены в таблицу, архив их не трогает
+    assert repository.archive_appointments('2030-01-01', '2030-01-01 00:00:00', 100) == 0
+
+    worksheet = MemoryWorksheet()
+    worksheet.append_row(SHEET_HEADERS)
+    worker = SheetSyncWorker(worksheet_factory=lambda: worksheet)
+    assert worker.flush() == 4
+    assert {row[9] for row in rows_by_id(worksheet).values()} == {'completed'}
+    # Выгружены, но дельта-синхронизация еще не прошла их updated_at
+    assert repository.archive_appointments('2030-01-01', '2030-01-01 00:00:00', 100) == 0
+
+    sync_changes_to_google()
+    worker.flush()
+    assert repository.archive_appointments('2030-01-01', '2030-01-01 00:00:00', 100) == 4
+    with get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM reminder_log").fetchone()[0] == 0
+        archived = conn.execute("SELECT id, status FROM appointments_archive ORDER BY id").fetchall()
+    assert archived == [(app_id, 'completed') for app_id in ids]
+
+
+def test_archive_keeps_recent_and_active(db):
+    old_id, active_id = book_past(2)
+    repository.set_appointment_status(old_id, 'canceled')
+    sync_changes_to_google()
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM sheet_outbox")
+    assert repository.archive_appointments('2019-12-31', '2030-01-01 00:00:00', 100) == 0
+    assert repository.archive_appointments('2020-01-02', '2030-01-01 00:00:00', 100) == 1
+    assert repository.appointment_details(active_id).status == 'active'
@@ -0,0 +1,69 @@
+import pytest
+import repository
+from booking import reserve_slot
+
+bot = pytest.importorskip('bot')
+
+
+@pytest.fixture
+def schedule(db):
+    """Записи трех мастеров за несколько дней, с совпадающими датой и временем"""
+    for day in range(1, 6):
+        for hour in (9, 11, 13):
+            for master_id in (1, 2, 3):
+                result = reserve_slot(master_id, 'Клиент', '+79990000000', master_id, 1,
+                                      f"2030-01-{day:02d}", f"{hour:02d}:00")
+                assert result.ok
+    return [row.id for row in repository.list_appointments('active')]
+
+
+def load(flt, after=None, before=None, limit=4):
+    return repository.appointments_page(flt.status, flt.master_id, flt.date_from, flt.date_to,
+                                        after=after, before=before, limit=limit)
+
+
+def test_forward_and_back_through_callbacks(schedule):
+    flt = bot.AppointmentFilter('active', None, '2030-01-01', '2030-01-31')
+    pages = [load(flt)]
+    while pages[-1].has_next:
+        data = bot.page_callback(flt, 'n', pages[-1].rows[-1])
+        assert len(data.encode()) <= 64
+        flt, after, before = bot.parse_page_callback(data)
+        pages.append(load(flt, after, before))
+    assert [row.id for page in pages for row in page.rows] == schedule
+    assert not pages[0].has_prev and all(page.has_prev for page in pages[1:])
+
+    # Обратно с последней страницы: те же страницы в обратном порядке
+    page = pages[-1]
+    for expected in reversed(pages[:-1]):
+        flt, after, before = bot.parse_page_callback(bot.page_callback(flt, 'p', page.rows[0]))
+        page = load(flt, after, before)
+        assert [row.id for row in page.rows] == [row.id for row in expected.rows]
+
+
+def test_filters_survive_round_trip(schedule):
+    flt = bot.AppointmentFilter(None, 2, '2030-01-02', '2030-01-03')
+    page = load(flt, limit=2)
+    parsed, after, before = bot.parse_page_callback(bot.page_callback(flt, 'n', page.rows[-1]))
+    assert parsed == flt and before is None
+    rest = load(parsed, after, limit=10)
+    assert [row.date for row in page.rows + rest.rows] == ['2030-01-02'] * 3 + ['2030-01-03'] * 3
+    assert {row.master_name for row in rest.rows} == {page.rows[0].master_name}
+
+
+def test_back_after_cancel_keeps_period(db):
+    """До начала меньше страницы: первая страница строится по всему периоду"""
+    ids = []
+    for day in range(1, 5):
+        result = reserve_slot(1, 'Клиент', '+79990000000', 1, 1, f"2030-01-{day:02d}", '09:00')
+        ids.append(result.appointment_id)
+    flt = bot.AppointmentFilter('active', None, '2030-01-01', '2030-01-31')
+    first = load(flt, limit=2)
+    second = load(flt, after=bot.parse_page_callback(bot.page_callback(flt, 'n', first.rows[-1]))[1], limit=2)
+    assert repository.cancel_appointment(ids[0])
+
+    flt, after, before = bot.parse_page_callback(bot.page_callback(flt, 'p', second.rows[0]))
+    page = load(flt, after, before, limit=2)
+    fresh = load(flt, limit=2)
+    assert [row.id for row in page.rows] == [row.id for row in fresh.rows] == ids[1:3]
+    assert (page.has_prev, page.has_next) == (fresh.has_prev, fresh.has_next) == (False, True)
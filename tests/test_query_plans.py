@@ -0,0 +1,24 @@
+import pytest
+from repository import HOT_QUERIES, check_plans, plan_problems
+from storage import STORAGE
+
+pytestmark = pytest.mark.skipif(STORAGE.dialect != 'sqlite', reason="планы проверяются только для SQLite")
+
+
+def test_hot_queries_use_expected_indexes(db):
+    failed = {query.name: (plan, problems) for query, plan, problems in check_plans() if problems}
+    assert failed == {}
+
+
+def test_every_hot_query_checked(db):
+    assert len(check_plans()) == len(HOT_QUERIES)
+
+
+def test_full_scan_reported():
+    plan = ['SCAN a', 'SEARCH m USING INTEGER PRIMARY KEY (rowid=?)']
+    assert plan_problems(plan, 'idx_appointments_schedule') == ['SCAN a']
+
+
+def test_wrong_index_reported():
+    plan = ['SEARCH a USING INDEX idx_appointments_client (client_id=?)']
+    assert plan_problems(plan, 'idx_appointments_schedule') == plan
@@ -0,0 +1,75 @@
+import time
+import datetime
+from booking import reserve_slot
+from reminders import ReminderScheduler, REMINDER_RETRY
+from timeutil import SALON_TZ, to_epoch
+
+
+def book_in(minutes, master_id=1):
+    """Запись через minutes минут. Возвращает (id, начало в UNIX-времени)"""
+    start = datetime.datetime.now(SALON_TZ) + datetime.timedelta(minutes=minutes)
+    date_str, time_str = start.strftime('%Y-%m-%d'), start.strftime('%H:%M')
+    result = reserve_slot(100, 'Клиент', '+79990000000', master_id, 1, date_str, time_str)
+    assert result.ok
+    return result.appointment_id, to_epoch(date_str, time_str)
+
+
+def scheduler():
+    sent = []
+    return ReminderScheduler(lambda details, kind: sent.append((details.id, kind)), SALON_TZ), sent
+
+
+def test_late_booking_skips_twelve_hour_reminder(db):
+    reminders, sent = scheduler()
+    appointment_id, start = book_in(5 * 60)
+    reminders._fire(appointment_id, 12, start)
+    assert sent == []
+
+
+def test_one_hour_reminder_sent_near_its_time(db):
+    reminders, sent = scheduler()
+    appointment_id, start = book_in(65)
+    reminders._fire(appointment_id, 1, start)
+    reminders._fire(appointment_id, 1, start)
+    assert sent == [(appointment_id, 1)]
+
+
+def test_one_hour_reminder_dropped_for_imminent_booking(db):
+    reminders, sent = scheduler()
+    appointment_id, start = book_in(20)
+    reminders._fire(appointment_id, 1, start)
+    assert sent == []
+
+
+def test_retry_only_within_tolerance(db):
+    reminders, _ = scheduler()
+    in_time, in_time_start = book_in(60 + REMINDER_RETRY // 60)
+    late, late_start = book_in(32, master_id=2)
+    with reminders._cond:
+        reminders._starts.update({in_time: in_time_start, late: late_start})
+        reminders._heap = []
+    reminders.retry(in_time, 1)
+    reminders.retry(late, 1)
+    assert [item[1] for item in reminders._heap] == [in_time]
+
+
+def test_schedule_ignored_until_started(db):
+    reminders, _ = scheduler()
+    start = datetime.datetime.now(SALON_TZ) + datetime.timedelta(hours=2)
+    date_str, time_str = start.strftime('%Y-%m-%d'), start.strftime('%H:%M')
+    reminders.schedule(999, date_str, time_str)
+    assert reminders._heap == []
+
+    reminders.start()
+    try:
+        # Ждем первой загрузки, она заменяет кучу целиком
+        deadline = time.monotonic() + 2
+        while not reminders._reload_at and time.monotonic() < deadline:
+            time.sleep(0.01)
+        reminders.schedule(999, date_str, time_str)
+        with reminders._cond:
+            assert {item[1] for item in reminders._heap} == {999}
+    finally:
+        reminders.stop()
+    reminders.schedule(1000, date_str, time_str)
+    assert 1000 not in reminders._starts
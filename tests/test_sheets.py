@@ -0,0 +1,157 @@
+from types import SimpleNamespace
+import pytest
+import repository
+import sheets
+from booking import reserve_slot
+from sheets import (MemoryWorksheet, SheetClient, SheetSyncWorker, SHEET_HEADERS,
+                    load_row_index, sync_changes_to_google)
+from storage import get_db_connection
+
+
+def api_error(status_code):
+    error = Exception(f"HTTP {status_code}")
+    error.response = SimpleNamespace(status_code=status_code)
+    return error
+
+
+@pytest.fixture
+def worksheet():
+    sheet = MemoryWorksheet()
+    sheet.append_row(SHEET_HEADERS)
+    return sheet
+
+
+def book(count):
+    ids = []
+    for index in range(count):
+        result = reserve_slot(200 + index, f"Клиент {index}", '+79990000000', 1, 1,
+                              '2030-01-01', f"{9 + index:02d}:00")
+        assert result.ok
+        ids.append(result.appointment_id)
+    return ids
+
+
+def outbox_attempts():
+    with get_db_connection() as conn:
+        return dict(conn.execute("SELECT appointment_id, attempts FROM sheet_outbox").fetchall())
+
+
+def test_new_rows_appended_in_one_call_and_indexed(db, worksheet):
+    ids = book(3)
+    worker = SheetSyncWorker(worksheet_factory=lambda: worksheet)
+    with get_db_connection() as conn:
+        worker.enqueue_many(ids, conn)
+    calls = worksheet.api_calls
+
+    assert worker.flush() == 3
+    assert worksheet.api_calls - calls == 1
+    assert [row[0] for row in worksheet.rows[1:]] == ids
+    assert load_row_index(ids) == {app_id: row for row, app_id in enumerate(ids, start=2)}
+    assert worker.pending() == 0
+
+
+def test_changed_row_updated_in_place(db, worksheet):
+    ids = book(3)
+    worker = SheetSyncWorker(worksheet_factory=lambda: worksheet)
+    with get_db_connection() as conn:
+        worker.enqueue_many(ids, conn)
+    worker.flush()
+
+    repository.set_appointment_status(ids[1], 'canceled')
+    worker.enqueue(ids[1])
+    assert worker.flush() == 1
+    assert len(worksheet.rows) == 4
+    assert worksheet.rows[2][0] == ids[1] and worksheet.rows[2][9] == 'canceled'
+
+
+def test_row_index_repaired_after_manual_edit(db, worksheet, monkeypatch):
+    # Плановая сверка при каждой записи
+    monkeypatch.setattr(sheets, 'SHEET_VERIFY_INTERVAL', 0)
+    ids = book(2)
+    worker = SheetSyncWorker(worksheet_factory=lambda: worksheet)
+    with get_db_connection() as conn:
+        worker.enqueue_many(ids, conn)
+    worker.flush()
+
+    # Администратор вставил строку над записями
+    worksheet.rows.insert(1, ['заметка'])
+    repository.set_appointment_status(ids[0], 'canceled')
+    worker.enqueue(ids[0])
+    worker.flush()
+    assert worksheet.rows[2][0] == ids[0] and worksheet.rows[2][9] == 'canceled'
+    assert worksheet.rows[1] == ['заметка']
+    assert load_row_index(ids) == {ids[0]: 3, ids[1]: 4}
+
+
+def test_row_index_verified_only_when_suspected(db, worksheet, monkeypatch):
+    ids = book(2)
+    worker = SheetSyncWorker(worksheet_factory=lambda: worksheet)
+    with get_db_connection() as conn:
+        worker.enqueue_many(ids, conn)
+    worker.flush()
+
+    def update_status(status):
+        repository.set_appointment_status(ids[0], status)
+        worker.enqueue(ids[0])
+        calls = worksheet.api_calls
+        assert worker.flush() == 1
+        return worksheet.api_calls - calls
+
+    # Первое обновление сверяет индекс, следующие - только пишут
+    assert update_status('canceled') == 2
+    assert update_status('completed') == 1
+
+    # Повтор после неудачной записи снова сверяет
+    def failing_update(*args, **kwargs):
+        raise api_error(500)
+
+    monkeypatch.setattr(worksheet, 'batch_update', failing_update)
+    repository.set_appointment_status(ids[0], 'active')
+    worker.enqueue(ids[0])
+    assert worker.flush() == 0
+    monkeypatch.undo()
+    with get_db_connection() as conn:
+        conn.execute("UPDATE sheet_outbox SET next_attempt_at = 0")
+    calls = worksheet.api_calls
+    assert worker.flush() == 1
+    assert worksheet.api_calls - calls == 2
+
+
+def test_auth_error_defers_and_resets_client(db, monkeypatch):
+    client = SheetClient()
+    connects = []
+    monkeypatch.setattr(client, '_connect', lambda: connects.append(1) or MemoryWorksheet())
+    monkeypatch.setattr(sheets, 'SHEET_CLIENT', client)
+    client.worksheet()
+
+    def failing_sheet():
+        raise api_error(401)
+
+    ids = book(1)
+    worker = SheetSyncWorker(worksheet_factory=failing_sheet)
+    worker.enqueue(ids[0])
+    assert worker.flush() == 0
+    assert outbox_attempts() == {ids[0]: 1}
+    assert client.get_stats()['connected'] is False
+
+    client.worksheet()
+    assert len(connects) == 2
+
+
+def test_other_errors_keep_connection(monkeypatch):
+    client = SheetClient()
+    monkeypatch.setattr(client, '_connect', MemoryWorksheet)
+    client.worksheet()
+    client.handle_error(api_error(500))
+    assert client.get_stats()['connected'] is True
+
+
+def test_delta_sync_enqueues_only_changes(db, worksheet):
+    ids = book(2)
+    assert sync_changes_to_google() == 2
+    SheetSyncWorker(worksheet_factory=lambda: worksheet).flush()
+    assert sync_changes_to_google() == 0
+
+    repository.set_appointment_status(ids[0], 'canceled')
+    assert sync_changes_to_google() == 1
+    assert list(outbox_attempts()) == [ids[0]]
@@ -0,0 +1,57 @@
+import threading
+from types import SimpleNamespace
+import pytest
+from router import MessageRouter
+from state_store import SQLiteStateStore
+
+
+@pytest.fixture
+def stores(db):
+    """Два хранилища над одной базой, как в двух процессах кластера"""
+    return (SQLiteStateStore(flush_interval=0, cache_seconds=0),
+            SQLiteStateStore(flush_interval=0, cache_seconds=0))
+
+
+def test_states_shared_between_processes(stores):
+    first, second = stores
+    first.begin(1, 'select_master')
+    assert second.get_step(1) == 'select_master'
+    second.update(1, master_id=2)
+    assert first.get(1).master_id == 2
+    first.delete(1)
+    assert second.get(1) is None
+
+
+def test_database_read_outside_store_lock(stores):
+    store, _ = stores
+    store.begin(1, 'get_name')
+    read = store._read
+    lock_free = []
+
+    def checked_read(chat_id):
+        # Блокировку хранилища должен суметь взять другой поток
+        probe = threading.Thread(target=lambda: lock_free.append(store._lock.acquire(timeout=0.5)
+                                                                 and store._lock.release() is None))
+        probe.start()
+        probe.join()
+        return read(chat_id)
+
+    store._read = checked_read
+    assert store.get_step(1) == 'get_name'
+    assert lock_free == [True]
+
+
+def test_router_reads_step_once():
+    calls = []
+
+    def get_step(chat_id):
+        calls.append(chat_id)
+        return 'get_name'
+
+    router = MessageRouter(get_step)
+    handled = []
+    router.step('get_name')(handled.append)
+    message = SimpleNamespace(text='Иван', chat=SimpleNamespace(id=7))
+    assert router.match(message)
+    router.dispatch(message)
+    assert handled == [message] and calls == [7]
@@ -0,0 +1,64 @@
+import json
+import time
+import http.client
+import pytest
+from webhook import WebhookServer, SECRET_HEADER
+
+
+class FakeBot:
+    token = '1:x'
+
+    def __init__(self):
+        self.updates = []
+
+    def process_new_updates(self, updates):
+        self.updates.extend(update.update_id for update in updates)
+
+
+@pytest.fixture
+def server():
+    bot = FakeBot()
+    server = WebhookServer(bot, host='127.0.0.1', port=0, path='/telegram', secret='s3cret',
+                           queue_size=10, reuse_port=False)
+    server.start()
+    yield server
+    server.stop()
+
+
+def post(server, body, secret='s3cret', length=None):
+    connection = http.client.HTTPConnection(*server.httpd.server_address[:2], timeout=5)
+    connection.putrequest('POST', '/telegram')
+    connection.putheader(SECRET_HEADER, secret)
+    connection.putheader('Content-Length', str(len(body)) if length is None else length)
+    connection.endheaders()
+    connection.send(body)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def update(update_id):
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'text': 'привет'}}).encode()
+
+
+def test_updates_and_duplicates(server):
+    assert post(server, update(1)) == 200
+    assert post(server, update(1)) == 200
+    assert post(server, update(2)) == 200
+    deadline = time.monotonic() + 2
+    while len(server.bot.updates) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.bot.updates == [1, 2]
+    stats = server.get_stats()
+    assert (stats['received'], stats['duplicates']) == (2, 1)
+
+
+def test_rejected_requests(server):
+    assert post(server, update(1), secret='wrong') == 403
+    assert post(server, update(1), secret='секрет'.encode('utf-8')) == 403
+    assert post(server, update(1), length='abc') == 400
+    assert post(server, update(1), length='-5') == 400
+    assert post(server, b'{not json') == 400
+    assert server.get_stats()['rejected'] == 2
+    assert server.get_stats()['received'] == 0
@@ -0,0 +1,35 @@
+import os
+import datetime
+from functools import lru_cache
+import pytz
+
+# Часовой пояс салона: дата и время записей хранятся в нем (Оренбург, UTC+5)
+SALON_TZ = pytz.timezone(os.getenv("SALON_TZ", "Asia/Yekaterinburg"))
+
+
+@lru_cache(maxsize=16384)
+def to_epoch(date_str, time_str, tz=SALON_TZ):
+    """Начало записи ('ГГГГ-ММ-ДД', 'ЧЧ:ММ' в поясе салона) как UNIX-время"""
+    start = datetime.datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
+    return int(tz.localize(start).timestamp())
+
+
+@lru_cache(maxsize=1024)
+def day_bounds(date_str, tz=SALON_TZ):
+    """UNIX-время начала суток date_str и начала следующих суток"""
+    next_day = datetime.date.fromisoformat(date_str) + datetime.timedelta(days=1)
+    return to_epoch(date_str, '00:00', tz), to_epoch(next_day.isoformat(), '00:00', tz)
+
+
+def appointment_span(date_str, time_str, duration, tz=SALON_TZ):
+    """(start_ts, end_ts) записи длительностью duration минут"""
+    start_ts = to_epoch(date_str, time_str, tz)
+    return start_ts, start_ts + duration * 60
+
+
+@lru_cache(maxsize=4096)
+def format_date(date_str):
+    """'ГГГГ-ММ-ДД' -> 'ДД.ММ.ГГГГ' для показа. Дат в работе немного, поэтому
+    каждая разбирается один раз"""
+    year, month, day = date_str.split('-')
+    return f"{day}.{month}.{year}"
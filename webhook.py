@@ -0,0 +1,219 @@
+import os
+import sys
+import hmac
+import hashlib
+import socket
+import threading
+import logging
+from collections import deque
+from queue import Queue, Full, Empty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import types
+from cluster import BOT_CLUSTER
+
+logger = logging.getLogger('webhook')
+
+# Прием обновлений через вебхук. Telegram требует HTTPS, поэтому сервер
+# рассчитан на работу за обратным прокси (nginx, балансировщик)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                         # Публичный адрес, например https://bot.example.com
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                   # По умолчанию выводится из BOT_TOKEN
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))    # Очередь необработанных обновлений
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT", "1" if BOT_CLUSTER else "0") == "1"  # Общий порт для процессов
+WEBHOOK_MAX_BODY = 1024 * 1024                                     # Максимальный размер обновления (байт)
+WEBHOOK_BATCH = 100                                                # Обновлений за один проход обработки
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """HTTP-сервер, разрешающий нескольким процессам слушать один порт (SO_REUSEPORT).
+
+    Ядро распределяет входящие соединения между процессами кластера.
+    """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def default_secret(token):
+    """Секрет вебхука, одинаковый для всех процессов бота"""
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+class WebhookServer:
+    """HTTP-сервер для приема обновлений Telegram.
+
+    Запрос проверяется по заголовку секрета и сразу кладется в
+    ограниченную очередь; ответ 200 уходит, не дожидаясь обработчиков.
+    При переполнении очереди сервер отвечает 503, и Telegram повторит
+    доставку позже. Отдельный поток забирает обновления пачками и передает
+    их в bot.process_new_updates, откуда они попадают в пул обработчиков.
+    Повторно доставленные update_id отбрасываются.
+    """
+
+    def __init__(self, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE, reuse_port=WEBHOOK_REUSE_PORT):
+        self.bot = bot
+        self.path = path
+        self.secret = secret or default_secret(bot.token)
+        self.queue = Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0
+        self.overflows = 0
+        self.duplicates = 0
+        self._recent = deque(maxlen=queue_size * 2)
+        self._recent_ids = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        server_class = ReusePortHTTPServer if reuse_port else ThreadingHTTPServer
+        self.httpd = server_class((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _respond(self, code, body=b''):
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != server.path:
+                    return self._respond(404)
+                # Проверка живости для балансировщика
+                self._respond(200, b'{"ok": true}')
+
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._respond(404)
+                # Сравниваем байты: compare_digest не принимает строки с не-ASCII символами
+                secret = self.headers.get(SECRET_HEADER, '').encode('utf-8')
+                if not hmac.compare_digest(secret, server.secret.encode('utf-8')):
+                    with server._lock:
+                        server.rejected += 1
+                    return self._respond(403)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    return self._respond(400)
+                if not 0 < length <= WEBHOOK_MAX_BODY:
+                    return self._respond(413 if length > WEBHOOK_MAX_BODY else 400)
+                self._respond(server.accept(self.rfile.read(length)))
+
+        return Handler
+
+    def accept(self, body):
+        """Разбирает тело запроса и ставит обновление в очередь. Возвращает HTTP-код"""
+        try:
+            update = types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            logger.warning(f"Некорректное обновление от вебхука: {e}")
+            return 400
+
+        with self._lock:
+            if update.update_id in self._recent_ids:
+                self.duplicates += 1
+                return 200
+            try:
+                self.queue.put_nowait(update)
+            except Full:
+                self.overflows += 1
+                logger.warning("Очередь вебхука переполнена, обновление отклонено")
+                return 503
+            if len(self._recent) == self._recent.maxlen:
+                self._recent_ids.discard(self._recent[0])
+            self._recent.append(update.update_id)
+            self._recent_ids.add(update.update_id)
+            self.received += 1
+        return 200
+
+    def _feed(self):
+        """Передает обновления из очереди боту пачками"""
+        while True:
+            updates = [self.queue.get()]
+            try:
+                while len(updates) < WEBHOOK_BATCH:
+                    updates.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.bot.process_new_updates(updates)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновлений вебхука: {e}")
+
+    def start(self):
+        """Запускает сервер и обработку очереди в фоновых потоках"""
+        if self._threads:
+            return
+        for target, name in ((self._feed, 'webhook-feed'), (self.httpd.serve_forever, 'webhook-http')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Вебхук слушает http://{host}:{port}{self.path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        """Запускает прием обновлений и блокирует текущий поток"""
+        self.start()
+        self._threads[-1].join()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'queued': self.queue.qsize(),
+                'capacity': self.queue.maxsize,
+                'received': self.received,
+                'rejected': self.rejected,
+                'overflows': self.overflows,
+                'duplicates': self.duplicates,
+            }
+
+
+def register_webhook(bot, url=WEBHOOK_URL, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    """Регистрирует вебхук в Telegram"""
+    if not url:
+        raise ValueError("WEBHOOK_URL не задан")
+    bot.remove_webhook()
+    bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret or default_secret(bot.token),
+                    max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info(f"Вебхук зарегистрирован: {url.rstrip('/')}{path}")
+
+
+def post_updates(paths, url=None, secret=None):
+    """Отправляет записанные обновления (JSON-файлы) на локальный вебхук"""
+    from urllib import request, error
+
+    url = url or f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    secret = secret or WEBHOOK_SECRET or default_secret(os.getenv("BOT_TOKEN", ""))
+    for path in paths:
+        with open(path, 'rb') as f:
+            body = f.read()
+        req = request.Request(url, data=body, method='POST',
+                              headers={'Content-Type': 'application/json', SECRET_HEADER: secret})
+        try:
+            with request.urlopen(req) as response:
+                print(f"{path}: {response.status}")
+        except error.HTTPError as e:
+            print(f"{path}: {e.code}")
+
+
+if __name__ == '__main__':
+    # Локальная проверка: python webhook.py update1.json [update2.json ...]
+    if len(sys.argv) < 2:
+        print("Использование: python webhook.py <update.json> [...]")
+        sys.exit(1)
+    post_updates(sys.argv[1:], url=os.getenv("WEBHOOK_TEST_URL"))